@@ -0,0 +1,35 @@
+# Times the de-vig methods on the markets of synthetic snapshots and checks that every market converged (its fair win probabilities sum to 1)
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+import ev
+import synthetic
+
+# Counts the solver iterations of every call of ev.newton_bisect()
+iterations = []
+solve = ev.newton_bisect
+def counted_solve(*args, **kwargs):
+    roots, count = solve(*args, **kwargs)
+    iterations.append(count)
+    return roots, count
+ev.newton_bisect = counted_solve
+
+if __name__ == '__main__':
+    for num_events in [1000, 10000]:
+        odds = ev.processed_data(ev.flattened_data(synthetic.snapshot(num_events=num_events, num_books=20)))
+        market_code = odds['market_code'].to_numpy()
+        num_markets = market_code.max() + 1
+        vig_win_dec = odds['vig_win_dec'].to_numpy()
+        for method in ev.DEVIG_METHODS:
+            iterations.clear()
+            times = []
+            for _ in range(3):
+                start = time.perf_counter()
+                fair_win_dec = ev.devig_probabilities(vig_win_dec, market_code, num_markets, method)
+                times.append(time.perf_counter() - start)
+            error = numpy.abs(numpy.bincount(market_code, weights=fair_win_dec, minlength=num_markets) - 1).max()
+            print(f'{num_markets:>8} markets  {method:<15}{min(times):8.4f}s  {num_markets / min(times) / 1e6:6.2f}M markets/s  iterations {max(iterations, default=0):>3}  max |sum - 1| {error:.1e}')
@@ -0,0 +1,33 @@
+# Compares the three-merge EV calculation with the fused ev_data() kernel for ev_type='both'
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas
+import ev
+import synthetic
+from bench_flatten import measure
+
+# avg_ev() + pinnacle_ev() + merge_ev() as they were before the fused kernel
+def merged_ev(book_odds):
+    means = ev.position_means(book_odds, ['num_outcomes'] + ev.AVERAGED_FIELDS)
+    average_odds = pandas.DataFrame({'position_code': range(len(means['num_outcomes'])), **means})
+    avg_merge = book_odds.merge(average_odds, how='inner', on=['position_code', 'num_outcomes'], suffixes=['_book', '_avg'], validate='m:1')
+    avg_merge['ev_pct_avg'] = (avg_merge['fair_win_dec_avg'] * avg_merge['amount_to_win_line_book']) - ((1 - avg_merge['fair_win_dec_avg']) * 100)
+
+    pinnacle_odds = book_odds.loc[book_odds['book_key'] == 'pinnacle']
+    drop_fields = ev.POSITION_FIELDS + ['sport_key', 'sport_title', 'commence_time', 'home_team', 'away_team', 'book_key', 'book_title', 'num_books', 'position_code', 'market_code']
+    pinnacle_merge = book_odds.merge(pinnacle_odds.drop(columns=drop_fields), how='inner', on=['position_key', 'num_outcomes'], suffixes=['_book', '_pinnacle'], validate='m:1')
+    pinnacle_merge['ev_pct_pinnacle'] = (pinnacle_merge['fair_win_dec_pinnacle'] * pinnacle_merge['amount_to_win_line_book']) - ((1 - pinnacle_merge['fair_win_dec_pinnacle']) * 100)
+
+    key_fields = ['market_code', 'position_code']
+    pinnacle_fields = key_fields + [field for field in pinnacle_merge.columns if field not in avg_merge.columns]
+    return avg_merge.merge(pinnacle_merge[pinnacle_fields], how='left', on=key_fields, validate='1:1')
+
+if __name__ == '__main__':
+    for num_events in [1000, 4000]:
+        book_odds = ev.processed_data(ev.flattened_data(synthetic.snapshot(num_events=num_events, num_books=20)))
+        _, old_time, old_peak = measure(merged_ev, book_odds)
+        _, new_time, new_peak = measure(ev.ev_data, book_odds, 'both')
+        print(f'{len(book_odds):>9} rows  merges {old_time:7.3f}s {old_peak / 2**20:8.1f}MB  ev_data {new_time:7.3f}s {new_peak / 2**20:8.1f}MB  speedup {old_time / new_time:5.1f}x')
@@ -0,0 +1,35 @@
+# Compares unpacked_data() with flattened_data() on synthetic snapshots of increasing size
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas
+import ev
+import synthetic
+
+# Times a function and records its peak traced memory
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+# Checks that both flatteners produced the same rows
+def same_rows(old, new):
+    fields = ['id', 'book_key', 'market', 'position', 'point', 'line']
+    old = old[fields].sort_values(fields).reset_index(drop=True)
+    new = new[fields].sort_values(fields).reset_index(drop=True)
+    return old.equals(new)
+
+if __name__ == '__main__':
+    for num_events in [100, 1000, 5000]:
+        odds_json = synthetic.snapshot(num_events=num_events, num_books=20, market_updates=False)
+        old, old_time, old_peak = measure(lambda j: ev.unpacked_data(pandas.DataFrame(j)), odds_json)
+        new, new_time, new_peak = measure(ev.flattened_data, odds_json)
+        print(f'{len(new):>9} rows  unpacked_data {old_time:7.3f}s {old_peak / 2**20:8.1f}MB  flattened_data {new_time:7.3f}s {new_peak / 2**20:8.1f}MB  speedup {old_time / new_time:5.1f}x  same rows {same_rows(old, new)}')
@@ -0,0 +1,72 @@
+# Compares grouping/joining on the string key fields with the integer group codes on 1M+ outcome rows
+# The string side runs on an object-dtype copy of the rows like the ones unpacked_data() built before group codes, the code side runs the shipped functions
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+import pandas
+import ev
+import synthetic
+
+KEY_FIELDS = ['id', 'sport_key', 'sport_title', 'commence_time', 'home_team', 'away_team', 'market', 'position', 'point']
+
+# Returns a copy of flattened rows as they were before group codes and the typed schema: object strings (times as the API's ISO strings) and no code columns
+def object_frame(df):
+    df = df.drop(columns=['position_key', 'position_code', 'market_code'])
+    for field in df.columns:
+        if isinstance(df[field].dtype, pandas.DatetimeTZDtype):
+            df[field] = df[field].dt.strftime('%Y-%m-%dT%H:%M:%SZ').astype(object)
+        elif isinstance(df[field].dtype, pandas.CategoricalDtype):
+            df[field] = df[field].astype(object)
+    return df.astype({'line': numpy.int64})
+
+# processed_data() as it was before group codes, grouping on the string fields
+def groupby_processed_data(df):
+    df['num_outcomes'] = df.groupby(by=['id', 'book_key', 'market'])['line'].transform('count')
+    df['above_below'] = numpy.where(df['num_outcomes'] != 2, numpy.nan, numpy.where(df['line'] > 0, df['line'] - 100, df['line'] + 100))
+    df['width'] = numpy.where(df['num_outcomes'] != 2, numpy.nan, (-1)*(df.groupby(by=['id', 'book_key', 'market'])['above_below'].transform('sum')))
+    df['num_books'] = df.groupby(by=KEY_FIELDS, dropna=False)['book_key'].transform('count')
+    df['vig_win_dec'] = numpy.where(df['line'] > 0, 100/(df['line'] + 100), abs(df['line'])/(abs(df['line']) + 100))
+    df['fair_win_dec'] = df['vig_win_dec']/df.groupby(by=['id', 'book_key', 'market'])['vig_win_dec'].transform('sum')
+    df['fair_line'] = numpy.where(df['fair_win_dec'] < 0.5, (100/df['fair_win_dec']) - 100, ((df['fair_win_dec']*100)/(1-df['fair_win_dec']))*(-1))
+    df['amount_to_win_line'] = numpy.where(df['line'] > 0, df['line'], (100/abs(df['line']))*100)
+    df['amount_to_win_fair'] = numpy.where(df['fair_line'] > 0, df['fair_line'], (100/abs(df['fair_line']))*100)
+    df['vig_dec'] = df.groupby(by=['id', 'book_key', 'market'])['vig_win_dec'].transform('sum') - df.groupby(by=['id', 'book_key', 'market'])['fair_win_dec'].transform('sum')
+    df['vig_pct'] = df['vig_dec'] * 100
+    return df
+
+# Average odds per position, the m:1 merge back onto the books on the string fields and the ev against the averages, as the avg ev was calculated before
+def groupby_average_merge(df):
+    average = df.groupby(KEY_FIELDS, dropna=False)[ev.AVERAGED_FIELDS + ['num_outcomes', 'num_books']].mean()
+    merged = df.merge(average, how='inner', on=KEY_FIELDS + ['num_outcomes', 'num_books'], suffixes=['_book', '_avg'], validate='m:1')
+    merged['ev_pct_avg'] = (merged['fair_win_dec_avg'] * merged['amount_to_win_line_book']) - ((1 - merged['fair_win_dec_avg']) * 100)
+    return merged
+
+# Returns how long a function takes to run
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    for num_events in [2000, 8000]:
+        flat = ev.flattened_data(synthetic.snapshot(num_events=num_events, num_books=20))
+        flat_objects = object_frame(flat)
+        # The codes are computed once at ingest, and every stage after it saves the string grouping
+        print(f'{len(flat):>9} rows  group_codes             {timed(ev.group_codes, flat.drop(columns=["position_key", "position_code", "market_code"])):7.3f}s once per snapshot')
+        old = timed(groupby_processed_data, flat_objects.copy())
+        new = timed(ev.processed_data, flat.copy())
+        print(f'{len(flat):>9} rows  processed_data  groupby {old:7.3f}s  codes {new:7.3f}s  speedup {old / new:5.1f}x')
+
+        processed = ev.processed_data(flat.copy())
+        processed_objects = groupby_processed_data(flat_objects.copy())
+        old = timed(groupby_average_merge, processed_objects)
+        new = timed(ev.ev_data, processed, 'avg')
+        print(f'{len(flat):>9} rows  avg ev          groupby {old:7.3f}s  codes {new:7.3f}s  speedup {old / new:5.1f}x')
+
+        old = timed(lambda df: df.groupby(KEY_FIELDS, dropna=False)[ev.AVERAGED_FIELDS].mean(), processed_objects)
+        new = timed(ev.position_means, processed, ev.AVERAGED_FIELDS)
+        print(f'{len(flat):>9} rows  position means  groupby {old:7.3f}s  codes {new:7.3f}s  speedup {old / new:5.1f}x')
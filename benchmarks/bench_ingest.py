@@ -0,0 +1,31 @@
+# Compares peak memory of loading a whole snapshot file with streaming it in chunks
+import os
+import sys
+import json
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ev
+import synthetic
+from bench_flatten import measure
+
+# Loads the whole file before flattening, like data(filename=...) used to
+def whole_file(filename):
+    with open(filename) as file:
+        odds_json = json.load(file)
+    return ev.processed_data(ev.flattened_data(odds_json))
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        for num_events in [1000, 4000]:
+            filename = os.path.join(directory, f'snapshot_{num_events}.json')
+            with open(filename, 'w') as file:
+                json.dump(synthetic.snapshot(num_events=num_events, num_books=20), file)
+            size = os.path.getsize(filename) / 2**20
+
+            df, elapsed, peak = measure(whole_file, filename)
+            print(f'{size:7.1f}MB file {len(df):>9} rows  json.load      {elapsed:7.3f}s {peak / 2**20:8.1f}MB peak')
+            for chunk_size in [100, 1000]:
+                df, elapsed, peak = measure(ev.file_to_processed_df, filename, chunk_size)
+                print(f'{size:7.1f}MB file {len(df):>9} rows  chunk_size {chunk_size:<4}{elapsed:7.3f}s {peak / 2**20:8.1f}MB peak')
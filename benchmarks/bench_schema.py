@@ -0,0 +1,54 @@
+# Compares the memory footprint and filter/sort time of the typed ev table with the same table stored as object strings, like it was before the typed schema
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+import pandas
+import dateutil.parser
+import ev
+import synthetic
+
+# Converts a typed ev table back to object strings, ISO timestamps and int64 counts
+def untyped_data(odds):
+    odds = odds.copy()
+    for field in odds.columns:
+        if isinstance(odds[field].dtype, pandas.CategoricalDtype):
+            odds[field] = odds[field].astype(object)
+        elif pandas.api.types.is_datetime64_any_dtype(odds[field]):
+            odds[field] = odds[field].dt.strftime('%Y-%m-%dT%H:%M:%SZ').astype(object)
+        elif pandas.api.types.is_integer_dtype(odds[field]) and field != 'position_key':
+            odds[field] = odds[field].astype(numpy.int64)
+    return odds
+
+# filter_ev(days_from_now=...) as it was before the typed schema, parsing every row
+def parsed_filter(odds, days):
+    date = pandas.Timestamp.now(tz='UTC') + pandas.Timedelta(days=days)
+    return odds.loc[odds['commence_time'].apply(lambda t: dateutil.parser.isoparse(t)) <= date]
+
+# Returns the fastest time of a few runs of a function
+def fastest(func, *args, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+if __name__ == '__main__':
+    for num_events in [1000, 4000]:
+        typed = ev.ev_data(ev.processed_data(ev.flattened_data(synthetic.snapshot(num_events=num_events, num_books=20))), 'both')
+        untyped = untyped_data(typed)
+
+        typed_report, untyped_report = ev.memory_report(typed), ev.memory_report(untyped)
+        print(f'{len(typed):>9} rows  memory   object {untyped_report.loc["total", "bytes"] / 2**20:8.1f}MB ({untyped_report.loc["total", "bytes_per_row"]:6.1f} B/row)  typed {typed_report.loc["total", "bytes"] / 2**20:8.1f}MB ({typed_report.loc["total", "bytes_per_row"]:6.1f} B/row)')
+        print(f'{len(typed):>9} rows  filter   object {fastest(parsed_filter, untyped, 2000, repeat=1):8.3f}s  typed {fastest(ev.filter_ev, typed, "both", None, None, 2000):8.3f}s')
+        default_sort = lambda odds: ev.sort_ev(odds.copy(), 'default', False)
+        print(f'{len(typed):>9} rows  sort     object {fastest(default_sort, untyped):8.3f}s  typed {fastest(default_sort, typed):8.3f}s')
+
+        # Biggest savings per column
+        savings = pandas.DataFrame({'object': untyped_report['bytes_per_row'], 'typed': typed_report['bytes_per_row']}).drop(index='total')
+        savings['saved'] = savings['object'] - savings['typed']
+        print(savings.sort_values('saved', ascending=False).head(8).round(1).to_string())
@@ -0,0 +1,39 @@
+# Compares the latency of EVService.query() on a materialized table with data(filename=...) on the same snapshot, for a few typical queries
+import os
+import sys
+import json
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ev
+import synthetic
+
+QUERIES = [
+    {'recommended': True},
+    {'books': ['fanduel', 'draftkings'], 'min_ev_pct': 1, 'sortby': 'ev_pct'},
+    {'sports': ['basketball_nba'], 'markets': ['h2h'], 'max_width': 45, 'expanded': True},
+    {'min_ev_pct': 0, 'sortby': 'ev_pct', 'top_k': 20},
+]
+
+# Returns the fastest time of a few runs of a function
+def fastest(func, repeat=3, **params):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(**params)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        for num_events in [500, 2000]:
+            filename = os.path.join(directory, f'snapshot_{num_events}.json')
+            with open(filename, 'w') as file:
+                json.dump(synthetic.snapshot(num_events=num_events, num_books=20), file)
+            service = ev.EVService(filename=filename, port=0)
+            service.refresh()
+            for params in QUERIES:
+                name = ','.join(params)
+                print(f'{num_events:>6} events  {name:<38} data {fastest(ev.data, filename=filename, **params):8.4f}s  service {fastest(service.query, **params):8.4f}s')
@@ -0,0 +1,40 @@
+# Times data(filename=...) with the pipeline sharded over 2, 4 and 8 processes (capped at the number of cores), to check that throughput scales with cores
+import os
+import sys
+import json
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ev
+import synthetic
+
+# Returns the fastest time of a few runs of data() on a file
+def fastest(filename, repeat=3, **params):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ev.data(filename=filename, **params)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+if __name__ == '__main__':
+    cores = os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as directory:
+        for num_events in [2000, 8000]:
+            events = synthetic.snapshot(num_events=num_events, num_books=20)
+            # JSON lists are parsed by the main process, newline-delimited files by the workers
+            for extension in ['json', 'jsonl']:
+                filename = os.path.join(directory, f'snapshot_{num_events}.{extension}')
+                with open(filename, 'w') as file:
+                    if extension == 'json':
+                        json.dump(events, file)
+                    else:
+                        file.writelines(json.dumps(event) + '\n' for event in events)
+                serial = fastest(filename, sortby='ev_pct', min_ev_pct=1)
+                print(f'{num_events:>6} events {extension:<5} serial       {serial:7.3f}s')
+                for processes in [count for count in [2, 4, 8] if count <= cores]:
+                    for shard_by in ['event', 'sport']:
+                        elapsed = fastest(filename, sortby='ev_pct', min_ev_pct=1, processes=processes, shard_by=shard_by)
+                        print(f'{num_events:>6} events {extension:<5} {processes} x {shard_by:<6}{elapsed:7.3f}s ({serial / elapsed:4.2f}x)')
@@ -0,0 +1,119 @@
+# Times and memory profiles every stage of data(filename=...) on synthetic snapshots from 1k to 1M outcome rows, fully offline
+# Results are written to a JSON file, and --compare flags stages that got slower or bigger than a stored baseline:
+#   python benchmarks/bench_stages.py --output baseline.json
+#   python benchmarks/bench_stages.py --output current.json --compare baseline.json
+import os
+import sys
+import json
+import time
+import inspect
+import argparse
+import platform
+import datetime
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+import pandas
+import ev
+import synthetic
+from bench_flatten import measure
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+# Filter and sort values of data(recommended=True), as the parameters of filter_ev() and sort_ev()
+RECOMMENDED_FILTER = {name: value for name, value in ev.RECOMMENDED.items() if name in inspect.signature(ev.filter_ev).parameters}
+RECOMMENDED_SORT = {name: value for name, value in ev.RECOMMENDED.items() if name in inspect.signature(ev.sort_ev).parameters}
+
+# Runs func on a fresh copy of its input repeat times and returns its output, fastest time and peak traced memory (of one extra traced run)
+def run_stage(func, prepare, repeat):
+    fastest = float('inf')
+    for _ in range(repeat):
+        args = prepare()
+        start = time.perf_counter()
+        result = func(*args)
+        fastest = min(fastest, time.perf_counter() - start)
+    _, _, peak = measure(func, *prepare())
+    return result, fastest, peak
+
+# Times every stage of the pipeline on one snapshot file
+def bench_file(filename, repeat):
+    stages = [
+        ('file_to_json', ev.file_to_json, lambda: (filename,)),
+        ('flattened_data', ev.flattened_data, lambda: (outputs['file_to_json'],)),
+        ('processed_data', ev.processed_data, lambda: (outputs['flattened_data'].copy(),)),
+        ('ev_data', ev.ev_data, lambda: (outputs['processed_data'], 'both')),
+        ('filter_ev', lambda odds: ev.filter_ev(odds, **RECOMMENDED_FILTER), lambda: (outputs['ev_data'],)),
+        ('sort_ev', lambda odds: ev.sort_ev(odds, **RECOMMENDED_SORT), lambda: (outputs['filter_ev'].copy(),)),
+        ('top_ev', lambda odds: ev.top_ev(odds, 100, **RECOMMENDED_SORT), lambda: (outputs['filter_ev'],)),
+        ('cleanup_ev', ev.cleanup_ev, lambda: (outputs['sort_ev'], 'both')),
+        ('file_to_processed_df', ev.file_to_processed_df, lambda: (filename,)),
+        ('data', lambda name: ev.data(filename=name, recommended=True), lambda: (filename,)),
+    ]
+    outputs = {}
+    results = []
+    for stage, func, prepare in stages:
+        outputs[stage], seconds, peak = run_stage(func, prepare, repeat)
+        results.append({'stage': stage, 'seconds': seconds, 'peak_mb': peak / 2**20})
+    return results, len(outputs['flattened_data'])
+
+# Returns the stages of results that are more than threshold slower or bigger than the same stage and requested size of baseline
+# Slowdowns of less than min_seconds are timer noise and never flagged
+def regressions(results, baseline, threshold, min_seconds=0.01):
+    base = {(result['size'], result['stage']): result for result in baseline['results']}
+    flagged = []
+    for result in results:
+        old = base.get((result['size'], result['stage']))
+        if old is None:
+            continue
+        for field in ['seconds', 'peak_mb']:
+            if field == 'seconds' and result[field] - old[field] < min_seconds:
+                continue
+            if old[field] > 0 and result[field] > old[field] * (1 + threshold):
+                flagged.append({**result, 'field': field, 'baseline': old[field], 'ratio': result[field] / old[field]})
+    return flagged
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-stage benchmark of data(filename=...) on synthetic snapshots')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='target numbers of outcome rows')
+    parser.add_argument('--books', type=int, default=20, help='bookmakers per event (pinnacle is always included)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage, the fastest is kept')
+    parser.add_argument('--output', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_stages.json'), help='file the results are written to (benchmarks/bench_stages.json by default)')
+    parser.add_argument('--compare', help='baseline results file to flag regressions against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed slowdown or memory growth before flagging, as a fraction')
+    parser.add_argument('--min-seconds', type=float, default=0.01, help='slowdowns smaller than this are never flagged')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            filename = os.path.join(directory, f'snapshot_{size}.json')
+            synthetic.write(synthetic.snapshot_rows(size, num_books=args.books), filename)
+            stage_results, rows = bench_file(filename, args.repeat)
+            os.remove(filename)
+            for result in stage_results:
+                results.append({'rows': rows, 'size': size, **result})
+                print(f'{rows:>9} rows  {result["stage"]:<22}{result["seconds"]:9.4f}s {result["peak_mb"]:9.1f}MB peak')
+
+    report = {
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'pandas': pandas.__version__,
+        'numpy': numpy.__version__,
+        'machine': platform.platform(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        flagged = regressions(results, baseline, args.threshold, args.min_seconds)
+        for result in flagged:
+            print(f'REGRESSION {result["size"]:>9} rows  {result["stage"]:<22}{result["field"]:<8} {result["baseline"]:9.4f} -> {result[result["field"]]:9.4f} ({result["ratio"]:.2f}x)')
+        if len(flagged) > 0:
+            sys.exit(1)
+        print(f'no regressions against {args.compare} (threshold {args.threshold:.0%})')
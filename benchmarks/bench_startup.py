@@ -0,0 +1,50 @@
+# Times fresh interpreter runs of the command line: bare python, importing ev, a query run in process and the same query answered by a warm worker
+import os
+import sys
+import json
+import time
+import socket
+import statistics
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic
+
+CLI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cli.py')
+
+# Returns the fastest and the median wall time of a few runs of a command in a fresh interpreter
+def timed(arguments, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + arguments, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=os.path.dirname(CLI))
+        times.append(time.perf_counter() - start)
+    return min(times), statistics.median(times)
+
+# Returns a port that nothing is listening on
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'snapshot.json')
+        with open(filename, 'w') as file:
+            json.dump(synthetic.snapshot(num_events=1000, num_books=20), file)
+        port = str(free_port())
+        query = ['query', '--filename', filename, '--min-ev-pct', '1', '--sortby', 'ev_pct', '--top-k', '20', '--port', port]
+
+        results = [('python -c pass', timed(['-c', 'pass'])), ('import ev', timed(['-c', 'import ev'])), ('cli.py --help', timed([CLI, '--help']))]
+        results.append(('cli.py query (in process)', timed([CLI] + query, repeat=3)))
+        subprocess.run([sys.executable, CLI, 'worker', '--filename', filename, '--port', port, '--detach'], check=True, stdout=subprocess.DEVNULL)
+        try:
+            results.append(('cli.py query (warm worker)', timed([CLI] + query, repeat=10)))
+        finally:
+            subprocess.run([sys.executable, CLI, 'stop', '--port', port], stdout=subprocess.DEVNULL)
+
+        baseline = results[0][1][0]
+        for name, (seconds, median) in results:
+            print(f'{name:<28}{seconds * 1000:9.1f}ms fastest {median * 1000:9.1f}ms median  {(seconds - baseline) * 1000:+9.1f}ms over python')
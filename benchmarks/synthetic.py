@@ -0,0 +1,96 @@
+# Deterministic generator of Odds API shaped JSON for benchmarking without spending any API requests
+import random
+import datetime
+import gzip
+import json
+import math
+
+BOOKS = ['pinnacle', 'draftkings', 'fanduel', 'betmgm', 'williamhill_us', 'pointsbetus', 'betrivers', 'unibet', 'bovada', 'betonlineag', 'lowvig', 'mybookieag', 'betfair', 'matchbook', 'sport888', 'betclic', 'marathonbet', 'onexbet', 'nordicbet', 'coolbet']
+SPORTS = [('americanfootball_nfl', 'NFL', 2), ('basketball_nba', 'NBA', 2), ('baseball_mlb', 'MLB', 2), ('icehockey_nhl', 'NHL', 2), ('soccer_epl', 'EPL', 3), ('soccer_uefa_champs_league', 'UEFA Champions League', 3)]
+
+# Converts a win probability into an American odds line
+def american(prob):
+    if prob < 0.5:
+        return round((100 / prob) - 100)
+    return round(-(prob * 100) / (1 - prob))
+
+# Prices a set of fair probabilities at a book with a given vig and some noise
+def price(rng, probs, vig):
+    noisy = [max(0.01, p + rng.gauss(0, 0.01)) for p in probs]
+    total = sum(noisy)
+    return [american(min(0.99, (p / total) * (1 + vig))) for p in noisy]
+
+# Returns a list of events in the same format as the /v4/sports/{sport}/odds endpoint
+# market_updates=False leaves 'last_update' off market objects like older API responses (unpacked_data() cannot handle it)
+def snapshot(num_events=100, num_books=10, markets=['h2h', 'spreads', 'totals'], seed=0, start=None, market_updates=True):
+    rng = random.Random(seed)
+    start = start or datetime.datetime(2022, 10, 1, tzinfo=datetime.timezone.utc)
+    books = BOOKS[:num_books]
+    events = []
+
+    for i in range(num_events):
+        sport_key, sport_title, num_outcomes = SPORTS[i % len(SPORTS)]
+        home, away = f'Home Team {i}', f'Away Team {i}'
+        commence = start + datetime.timedelta(hours=rng.randint(1, 24 * 14))
+        home_prob = rng.uniform(0.2, 0.7)
+        if num_outcomes == 3:
+            draw_prob = rng.uniform(0.2, 0.3)
+            h2h_probs = [home_prob * (1 - draw_prob), (1 - home_prob) * (1 - draw_prob), draw_prob]
+            h2h_names = [home, away, 'Draw']
+        else:
+            h2h_probs = [home_prob, 1 - home_prob]
+            h2h_names = [home, away]
+        spread = round(rng.uniform(-10, 10) * 2) / 2
+        total = round(rng.uniform(2, 230) * 2) / 2
+
+        bookmakers = []
+        for book in books:
+            vig = rng.uniform(0.02, 0.08) if book != 'pinnacle' else 0.025
+            update = (commence - datetime.timedelta(hours=rng.randint(1, 48))).strftime('%Y-%m-%dT%H:%M:%SZ')
+            book_markets = []
+            for market in markets:
+                if market == 'h2h':
+                    outcomes = [{'name': name, 'price': line} for name, line in zip(h2h_names, price(rng, h2h_probs, vig))]
+                elif market == 'spreads':
+                    lines = price(rng, [0.5, 0.5], vig)
+                    outcomes = [{'name': home, 'price': lines[0], 'point': spread}, {'name': away, 'price': lines[1], 'point': -spread}]
+                else:
+                    lines = price(rng, [0.5, 0.5], vig)
+                    outcomes = [{'name': 'Over', 'price': lines[0], 'point': total}, {'name': 'Under', 'price': lines[1], 'point': total}]
+                book_market = {'key': market, 'outcomes': outcomes}
+                if market_updates:
+                    book_market['last_update'] = update
+                book_markets.append(book_market)
+            bookmakers.append({'key': book, 'title': book.title(), 'last_update': update, 'markets': book_markets})
+
+        events.append({
+            'id': f'{seed:04x}{i:028x}',
+            'sport_key': sport_key,
+            'sport_title': sport_title,
+            'commence_time': commence.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'home_team': home,
+            'away_team': away,
+            'bookmakers': bookmakers,
+        })
+
+    return events
+
+# Average number of outcome rows one event produces at a single book
+def rows_per_event(markets=['h2h', 'spreads', 'totals']):
+    h2h_outcomes = sum(num_outcomes for _, _, num_outcomes in SPORTS) / len(SPORTS)
+    return sum(h2h_outcomes if market == 'h2h' else 2 for market in markets)
+
+# Returns a snapshot sized to roughly num_rows flattened outcome rows
+def snapshot_rows(num_rows, num_books=20, markets=['h2h', 'spreads', 'totals'], seed=0, market_updates=True):
+    num_events = max(1, math.ceil(num_rows / (rows_per_event(markets) * num_books)))
+    return snapshot(num_events=num_events, num_books=num_books, markets=markets, seed=seed, market_updates=market_updates)
+
+# Writes a snapshot in any format data(filename=...) reads: a JSON array, JSON lines (.jsonl/.ndjson) and either gzipped (.gz)
+def write(events, filename):
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'wt') as file:
+        if filename.removesuffix('.gz').endswith(('.jsonl', '.ndjson')):
+            for event in events:
+                file.write(json.dumps(event) + '\n')
+        else:
+            json.dump(events, file)
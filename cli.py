@@ -0,0 +1,249 @@
+# Command line entry point for data() and the warm worker, which imports nothing but the standard library until a query has to run in this process
+#   python cli.py query --filename odds.json --recommended --books fanduel,draftkings
+#   python cli.py worker --filename odds.json --detach     keeps ev, pandas and the processed snapshot loaded in a background process (an EVService)
+#   python cli.py query --min-ev-pct 1 --sortby ev_pct     answered by the worker, without importing pandas, when one is running
+#   python cli.py status / python cli.py stop
+import os
+import sys
+import json
+import argparse
+
+# Address of the warm worker
+WORKER_HOST = '127.0.0.1'
+WORKER_PORT = 8754
+
+# data() parameters that the worker answers (the rest change how the table is built, so a query with them runs in this process)
+WORKER_PARAMETERS = ['sports', 'markets', 'books', 'ev_type', 'recommended', 'days_from_now', 'min_odds', 'max_odds', 'max_width', 'max_vig_pct', 'min_ev_pct', 'min_num_books', 'pref_ev_filter', 'sortby', 'ascending', 'pref_ev_sort', 'expanded', 'top_k', 'top_per', 'fields']
+
+# Parameters that select the source of the data
+SOURCE_PARAMETERS = ['api_key', 'filename', 'store']
+
+# Imports ev (and with it pandas and numpy) only when a query runs in this process or the worker starts
+def import_ev():
+    if __package__:
+        import importlib
+        return importlib.import_module('.ev', __package__)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import ev
+    return ev
+
+# Parses a comma separated list
+def comma_list(value):
+    return [item for item in value.split(',') if item]
+
+# Parses a number the way data() expects it, as an int unless it has a fraction
+def number(value):
+    return float(value) if any(character in value for character in '.eE') else int(value)
+
+# Parses an integer >= 1 (data() ignores top_k below 1 while the worker rejects it, so both are rejected here)
+def positive_int(value):
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError('must be an integer >= 1')
+    return value
+
+# Parses consensus weights given as book=weight pairs, e.g. pinnacle=3,circasports=2
+def weights(value):
+    try:
+        return {book: number(weight) for book, weight in (pair.split('=') for pair in comma_list(value))}
+    except ValueError:
+        raise argparse.ArgumentTypeError("consensus weights must be book=weight pairs, e.g. pinnacle=3,circasports=2")
+
+# Adds the source options shared by query and worker
+def add_source_arguments(parser):
+    parser.add_argument('--api-key', dest='api_key', help='key for The Odds API')
+    parser.add_argument('--filename', help='snapshot file (.json, .jsonl, optionally gzipped)')
+    parser.add_argument('--store', help='snapshot store directory')
+    parser.add_argument('--sports', type=comma_list, help='comma separated sport keys')
+    parser.add_argument('--regions', type=comma_list, help='comma separated regions (us, eu, uk, au)')
+    parser.add_argument('--markets', type=comma_list, help='comma separated markets (h2h, spreads, totals)')
+    parser.add_argument('--ev-type', dest='ev_type', help="'avg', 'pinnacle' or 'both'")
+    parser.add_argument('--devig', help="'multiplicative', 'power' or 'shin'")
+    parser.add_argument('--consensus-weights', dest='consensus_weights', type=weights, help="book=weight pairs of the weighted consensus, default=weight weighs the books that aren't listed")
+
+# Adds the worker address options
+def add_worker_arguments(parser):
+    parser.add_argument('--host', default=WORKER_HOST, help=f'worker address (default {WORKER_HOST})')
+    parser.add_argument('--port', type=int, default=WORKER_PORT, help=f'worker port (default {WORKER_PORT})')
+
+def parser():
+    cli = argparse.ArgumentParser(prog='cli.py', description='Expected values of sports betting odds from The Odds API')
+    commands = cli.add_subparsers(dest='command', required=True)
+
+    # Options left out are not passed, so data() keeps its own defaults
+    query = commands.add_parser('query', help='run data() and print the result', argument_default=argparse.SUPPRESS)
+    add_source_arguments(query)
+    query.add_argument('--recommended', action='store_true', help='use the recommended filter and sort values')
+    query.add_argument('--days-from-now', dest='days_from_now', type=int)
+    query.add_argument('--books', type=comma_list, help='comma separated book keys')
+    for option in ['min-odds', 'max-odds', 'max-width', 'max-vig-pct', 'min-ev-pct', 'min-num-books']:
+        query.add_argument(f'--{option}', dest=option.replace('-', '_'), type=number)
+    query.add_argument('--pref-ev-filter', dest='pref_ev_filter')
+    query.add_argument('--sortby')
+    query.add_argument('--ascending', action='store_true')
+    query.add_argument('--pref-ev-sort', dest='pref_ev_sort')
+    query.add_argument('--expanded', action='store_true', help='return every field')
+    query.add_argument('--top-k', dest='top_k', type=positive_int)
+    query.add_argument('--top-per', dest='top_per', help="'sport' or 'event'")
+    query.add_argument('--max-workers', dest='max_workers', type=int)
+    query.add_argument('--cache', help='response cache directory')
+    query.add_argument('--chunk-size', dest='chunk_size', type=int)
+    query.add_argument('--processes', type=int)
+    query.add_argument('--shard-by', dest='shard_by')
+    query.add_argument('--dry-run', dest='dry_run', action='store_true', help='print the planned API requests and their quota cost instead')
+    query.add_argument('--narrow-pull', dest='narrow_pull', action='store_true', help='pull only the bookmakers the expected values need when that costs less (num_books then only counts them)')
+    query.add_argument('--fields', type=comma_list, help='comma separated columns to print')
+    query.add_argument('--output', default='table', choices=['table', 'csv', 'json'], help='output format (default table)')
+    query.add_argument('--no-worker', dest='no_worker', action='store_true', help="run in this process even if a worker is running")
+    add_worker_arguments(query)
+
+    worker = commands.add_parser('worker', help='keep the ev table of a source loaded and answer queries (an EVService)')
+    add_source_arguments(worker)
+    worker.add_argument('--days-from-now', dest='days_from_now', type=int, help='only poll sports with events within this many days (API source)')
+    worker.add_argument('--budget', type=int, help='API requests per day (API source)')
+    worker.add_argument('--refresh-interval', dest='refresh_interval', type=float, default=60, help='seconds between reloads of a file or store (default 60)')
+    worker.add_argument('--detach', action='store_true', help='run in the background and return once the table is loaded')
+    add_worker_arguments(worker)
+
+    for command, description in [('status', 'print the status of the worker'), ('stop', 'stop the worker')]:
+        add_worker_arguments(commands.add_parser(command, help=description))
+    return cli
+
+# Sends a request to the worker, returns (status, parsed JSON body), or None when no worker is listening
+# A plain HTTP/1.0 exchange over a socket, because importing http.client takes longer than the worker takes to answer
+def worker_request(host, port, method, path, timeout=30):
+    import socket
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as connection:
+            connection.sendall(f'{method} {path} HTTP/1.0\r\nHost: {host}\r\n\r\n'.encode())
+            response = b''.join(iter(lambda: connection.recv(1 << 16), b''))
+        head, _, body = response.partition(b'\r\n\r\n')
+        return int(head.split(None, 2)[1]), json.loads(body)
+    except (OSError, ValueError, IndexError):
+        return None
+
+# Returns whether the worker serves the source a query asks for (a query without a source takes the worker's)
+def same_source(params, status):
+    if 'filename' in params:
+        return os.path.abspath(params['filename']) == status.get('filename')
+    if 'store' in params:
+        return os.path.abspath(params['store']) == status.get('store')
+    if 'api_key' in params:
+        return 'api' in status
+    return True
+
+# Runs a query on the worker, returns (columns, rows, warnings), or None when it has to run in this process
+# The worker's source is only checked when the query names one
+def worker_query(params, host, port):
+    if any(name not in WORKER_PARAMETERS + SOURCE_PARAMETERS for name in params):
+        return None
+    if any(name in SOURCE_PARAMETERS for name in params):
+        answer = worker_request(host, port, 'GET', '/status', timeout=1)
+        if answer is None or answer[0] != 200 or not same_source(params, answer[1]):
+            return None
+
+    import urllib.parse
+    values = {name: ','.join(value) if isinstance(value, list) else str(value).lower() if isinstance(value, bool) else value for name, value in params.items() if name in WORKER_PARAMETERS}
+    answer = worker_request(host, port, 'GET', '/ev?' + urllib.parse.urlencode(values))
+    if answer is None:
+        return None
+    status, body = answer
+    if status != 200:
+        raise SystemExit(f"Error: {body['error']}")
+    return body['columns'], body['data'], body['warnings']
+
+# Runs data() in this process, returns (columns, rows, warnings)
+def local_query(params):
+    ev = import_ev()
+    fields = params.pop('fields', None)
+    # data() sends its warnings (and failed requests) to telemetry instead of printing them, so they are returned like the worker's
+    warnings = []
+    odds = ev.data(**params, telemetry=lambda event: warnings.append(event['message']) if event['event'] == 'warning' else None)
+    # Unknown fields are an error, like they are for the worker
+    if fields is not None:
+        unknown = [field for field in fields if field not in odds.columns]
+        if unknown:
+            raise SystemExit(f"Error: parameter 'fields' has unknown fields: {unknown}")
+        odds = odds[fields]
+    split = json.loads(odds.to_json(orient='split', index=False, date_format='iso'))
+    return split['columns'], split['data'], warnings
+
+# Prints rows as an aligned table, CSV or JSON records
+def print_rows(columns, rows, output):
+    if output == 'json':
+        print(json.dumps([dict(zip(columns, row)) for row in rows]))
+        return
+    if output == 'csv':
+        import csv
+        writer = csv.writer(sys.stdout, lineterminator='\n')
+        writer.writerow(columns)
+        writer.writerows(rows)
+        return
+
+    cells = [columns] + [['' if value is None else str(value) for value in row] for row in rows]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(columns))]
+    numeric = [all(isinstance(row[i], (int, float)) or row[i] is None for row in rows) for i in range(len(columns))]
+    for row in cells:
+        print('  '.join(cell.rjust(width) if right else cell.ljust(width) for cell, width, right in zip(row, widths, numeric)).rstrip())
+
+# Starts the worker in a new background process with the same options, and waits until it answers (its table is loaded then)
+def detach(host, port):
+    import time
+    import subprocess
+    arguments = [argument for argument in sys.argv[1:] if argument != '--detach']
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__)] + arguments, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    while process.poll() is None:
+        answer = worker_request(host, port, 'GET', '/status', timeout=1)
+        if answer is not None and answer[0] == 200:
+            print(f'worker {answer[1]["pid"]} listening on {host}:{port}')
+            return
+        time.sleep(0.1)
+    raise SystemExit(f'Error: the worker exited with status {process.returncode}')
+
+# Runs the worker in this process until it is stopped
+def run_worker(args):
+    if args.detach:
+        detach(args.host, args.port)
+        return
+    ev = import_ev()
+    options = {name: value for name, value in vars(args).items() if name in ['api_key', 'sports', 'regions', 'markets', 'ev_type', 'days_from_now', 'budget', 'devig', 'consensus_weights'] and value is not None}
+    filename = os.path.abspath(args.filename) if args.filename is not None else None
+    store = os.path.abspath(args.store) if args.store is not None else None
+    ev.EVService(filename=filename, store=store, refresh_interval=args.refresh_interval, host=args.host, port=args.port, **options).serve()
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+
+    if args.command == 'query':
+        params = {name: value for name, value in vars(args).items() if name not in ['command', 'output', 'no_worker', 'host', 'port']}
+        result = None if getattr(args, 'no_worker', False) else worker_query(params, args.host, args.port)
+        if result is None:
+            result = local_query(params)
+        columns, rows, warnings = result
+        for warning in warnings:
+            print(warning, file=sys.stderr)
+        print_rows(columns, rows, args.output)
+
+    elif args.command == 'worker':
+        run_worker(args)
+
+    else:
+        answer = worker_request(args.host, args.port, 'GET', '/status', timeout=1)
+        if answer is None:
+            raise SystemExit(f'Error: no worker is listening on {args.host}:{args.port}')
+        if args.command == 'status':
+            print(json.dumps(answer[1], indent=2))
+        else:
+            import signal
+            os.kill(answer[1]['pid'], signal.SIGTERM)
+            print(f'stopped worker {answer[1]["pid"]}')
+
+if __name__ == '__main__':
+    try:
+        main()
+    except BrokenPipeError:
+        # The reader (e.g. head) stopped reading early, which is not an error
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
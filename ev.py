@@ -1,390 +1,2608 @@
 # IMORTS
 import pandas
 import numpy
-import requests
+import concurrent.futures
+import time
+import re
 import json
+import gzip
+import heapq
+import itertools
+import os
+import array
+import logging
+import threading
+import urllib.parse
 import datetime
 import dateutil.parser
 import pytz
-from typing import Optional, Union
+from typing import Optional, Union, Callable
 
 # ATTENTION!
 # PULLING ALL ODDS FROM ONE MARKET (us, eu, etc.) TAKES ~150-350 API REQUESTS
 
-# Main function
-# Takes an Odds API key or filename as well as a variety of optional parameters to calculate expected value (EV) percentage(s) and filter and sort the betting odds of upcoming sporting events
-def data(api_key: Optional[str]=None, sports: Optional[list[str]]=None, regions: Optional[list[str]]=['us', 'eu', 'uk', 'au'], markets: Optional[list[str]]=['h2h', 'spreads', 'totals'], ev_type: Optional[str]='both', recommended: Optional[bool]=False, days_from_now: Optional[Union[int, float]]=None, books: Optional[list[str]]=None, min_odds: Optional[Union[int, float]]=None, max_odds: Optional[Union[int, float]]=None, max_width: Optional[Union[int, float]]=None, max_vig_pct: Optional[Union[int, float]]=None, min_ev_pct: Optional[Union[int, float]]=None, min_num_books: Optional[Union[int, float]]=None, pref_ev_filter: Optional[str]='both', sortby: Optional[str]='default', ascending: Optional[bool]=False, pref_ev_sort: Optional[str]='avg', expanded: Optional[bool]=False, filename: Optional[str]=None) -> pandas.DataFrame:
-
-    # Returns a list of sports from the API
-    def get_sports(api_key):
-        sports_response = requests.get(
-            'https://api.the-odds-api.com/v4/sports', 
-            params={
-                'api_key': api_key
-            }
-        )
-
+# Base URL of The Odds API
+ODDS_API_URL = 'https://api.the-odds-api.com/v4'
+
+# Status codes that are worth retrying (rate limited or server side errors)
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+# Structured events about what the module is doing (stage timings, row counts, HTTP requests and quota), sent to a pluggable sink
+# sink can be a callable that takes each event dict, a logging.Logger, or the path of a JSON lines file the events are appended to
+# With memory=True, tracemalloc is started and every stage also reports how much memory it allocated (tracing slows everything down)
+class Telemetry:
+    def __init__(self, sink, memory=False):
+        if isinstance(sink, str):
+            sink = JsonLinesSink(sink)
+        elif isinstance(sink, logging.Logger):
+            sink = LoggingSink(sink)
+        elif not callable(sink):
+            raise TypeError("parameter 'telemetry' must be a callable, a logging.Logger, a JSON lines file path, a Telemetry or None value\n")
+        self.sink = sink
+        self.memory = memory
+        if memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    # Sends one event to the sink
+    def emit(self, event, **fields):
+        self.sink({'event': event, 'time': time.time(), **fields})
+
+    # Returns a context manager that emits a 'stage' event with the time the block took, and the rows it produced if they are set on it
+    def stage(self, name, **fields):
+        return Stage(self, name, fields)
+
+# Times one stage of the pipeline for a Telemetry
+class Stage:
+    def __init__(self, telemetry, name, fields):
+        self.telemetry = telemetry
+        self.name = name
+        self.fields = fields
+        self.rows = None
+
+    def __enter__(self):
+        if self.telemetry.memory:
+            import tracemalloc
+            self.memory_start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        fields = {'stage': self.name, 'seconds': time.perf_counter() - self.start, 'rows': self.rows, **self.fields}
+        if self.telemetry.memory:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            fields['memory_delta_mb'] = (current - self.memory_start) / 2**20
+            fields['memory_peak_mb'] = (peak - self.memory_start) / 2**20
+        if error_type is not None:
+            fields['error'] = repr(error)
+        self.telemetry.emit('stage', **fields)
+
+# Stands in for a Stage when telemetry is off so instrumented code costs next to nothing
+class NullStage:
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        pass
+
+NULL_STAGE = NullStage()
+
+# Returns a stage of telemetry (or a stage that does nothing when telemetry is None)
+def stage(telemetry, name, **fields):
+    if telemetry is None:
+        return NULL_STAGE
+    return telemetry.stage(name, **fields)
+
+# Sends telemetry events to a logger as JSON messages (the event dict is also attached to the log record as record.telemetry)
+class LoggingSink:
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def __call__(self, record):
+        self.logger.log(self.level, json.dumps(record, default=str), extra={'telemetry': record})
+
+# Appends telemetry events to a JSON lines file, one event per line (safe to share between threads)
+class JsonLinesSink:
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock:
+            with open(self.filename, 'a') as file:
+                file.write(line)
+
+# Reports a problem (a bad parameter or a failed request): sends it to telemetry as a 'warning' event, or prints it when there is no telemetry
+def warn(message, telemetry=None):
+    if telemetry is None:
+        print(message)
+    else:
+        telemetry.emit('warning', message=message)
+
+# Returns a Telemetry from any value data() accepts for its telemetry parameter
+def as_telemetry(telemetry):
+    if telemetry is None or isinstance(telemetry, Telemetry):
+        return telemetry
+    return Telemetry(telemetry)
+
+# Returns the x-requests-* quota headers of a response as numbers
+def quota_headers(response):
+    quota = {}
+    for header in ['x-requests-remaining', 'x-requests-used', 'x-requests-last']:
+        value = response.headers.get(header)
+        if value is not None:
+            quota[header.removeprefix('x-').replace('-', '_')] = float(value)
+    return quota
+
+# requests takes about 100ms to import and is only needed to call the API, so it is imported by the first call that does
+def import_requests():
+    import requests
+    import requests.adapters
+    return requests
+
+# http.server takes about 30ms to import and is only needed to run an EVService, so it is imported when one starts
+def import_http_server():
+    import http.server
+    return http.server
+
+# Returns a requests Session whose connection pool can serve max_workers concurrent requests
+def odds_session(max_workers=8):
+    requests = import_requests()
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Sends a GET request, retrying rate limited/server errors and connection errors with exponential backoff
+# Returns the last response received (or None if the connection never succeeded)
+# Every attempt is reported to telemetry as an 'http' event with its latency, status and the quota headers (the api key is left out)
+def get_with_retries(session, url, params, max_retries=3, backoff=0.5, telemetry=None):
+    requests = import_requests()
+    response = None
+    for attempt in range(max_retries + 1):
+        start = time.perf_counter()
+        try:
+            response = session.get(url, params=params, timeout=30)
+        except requests.exceptions.RequestException as error:
+            if telemetry is not None:
+                telemetry.emit('http', url=url, attempt=attempt, seconds=time.perf_counter() - start, status=None, error=repr(error))
+            if attempt == max_retries:
+                warn(f'Failed to connect: {error}', telemetry)
+                return None
+        else:
+            if telemetry is not None:
+                telemetry.emit('http', url=url, attempt=attempt, seconds=time.perf_counter() - start, status=response.status_code, **quota_headers(response))
+            if response.status_code not in RETRY_STATUS_CODES or attempt == max_retries:
+                return response
+
+        # Respect the server's Retry-After header when it gives one
+        delay = backoff * (2 ** attempt)
+        if response is not None and response.headers.get('retry-after', '').isdigit():
+            delay = max(delay, int(response.headers['retry-after']))
+        time.sleep(delay)
+
+    return response
+
+# On-disk cache of API responses so odds that were pulled recently are not paid for twice
+# Odds are stored per (sport, region, market) so any later request that overlaps with an earlier one can reuse its entries
+# Entries older than ttl seconds are treated as misses, and the oldest entries are evicted once max_entries or max_bytes is exceeded
+class ResponseCache:
+    def __init__(self, directory, ttl=60, max_entries=None, max_bytes=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    # Returns the file an entry is stored in
+    def path(self, key):
+        return os.path.join(self.directory, '__'.join(key) + '.json')
+
+    # Returns the cached value for a key, or None if it is missing or expired
+    def get(self, key):
+        try:
+            with open(self.path(key)) as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        if time.time() - entry['time'] > self.ttl:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry['value']
+
+    # Stores a value under a key (call evict() afterwards to enforce the limits)
+    def put(self, key, value):
+        # Write to a temporary file first so a reader never sees a partial entry
+        temp_path = self.path(key) + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({'time': time.time(), 'value': value}, file)
+        os.replace(temp_path, self.path(key))
+
+    # Deletes expired entries, then the oldest entries until the cache is within max_entries and max_bytes
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if time.time() - stat.st_mtime > self.ttl:
+                os.remove(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+        while entries and ((self.max_entries is not None and len(entries) > self.max_entries) or (self.max_bytes is not None and total_bytes > self.max_bytes)):
+            _, size, path = entries.pop(0)
+            os.remove(path)
+            total_bytes -= size
+
+    # Deletes every entry
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                os.remove(os.path.join(self.directory, name))
+
+    # Returns the hit and miss counts
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+# Returns a copy of a list of events keeping only the given market for each bookmaker
+def events_for_market(odds_json, market):
+    events = []
+    for event in odds_json:
+        bookmakers = []
+        for bookmaker in event.get('bookmakers', []):
+            book_markets = [book_market for book_market in bookmaker.get('markets', []) if book_market['key'] == market]
+            if book_markets:
+                bookmakers.append({**bookmaker, 'markets': book_markets})
+        events.append({**event, 'bookmakers': bookmakers})
+    return events
+
+# Combines several lists of events (e.g. different regions or markets of the same sport) into one list with each event, bookmaker and market appearing once
+def merge_events(odds_jsons):
+    events = {}
+    for odds_json in odds_jsons:
+        for event in odds_json:
+            merged_event = events.setdefault(event['id'], {**event, 'bookmakers': {}})
+            for bookmaker in event.get('bookmakers', []):
+                merged_book = merged_event['bookmakers'].setdefault(bookmaker['key'], {**bookmaker, 'markets': {}})
+                for book_market in bookmaker.get('markets', []):
+                    merged_book['markets'].setdefault(book_market['key'], book_market)
+
+    for event in events.values():
+        for bookmaker in event['bookmakers'].values():
+            bookmaker['markets'] = list(bookmaker['markets'].values())
+        event['bookmakers'] = list(event['bookmakers'].values())
+
+    return list(events.values())
+
+# Returns a list of the sports in season from the API
+def get_sports(api_key, session=None, base_url=ODDS_API_URL, cache=None, telemetry=None):
+    sports_json = cache.get(('sports',)) if cache is not None else None
+
+    if sports_json is None:
+        session = session or odds_session()
+        sports_response = get_with_retries(session, f'{base_url}/sports', params={'api_key': api_key}, telemetry=telemetry)
+
+        if sports_response is None:
+            return
 
         if sports_response.status_code != 200:
-            print(f'Failed to get sports: status_code {sports_response.status_code}, response body {sports_response.text}')
+            warn(f'Failed to get sports: status_code {sports_response.status_code}, response body {sports_response.text}', telemetry)
             return
 
-        else:
-            sports_list = [sport['key'] for sport in sports_response.json() if not sport['has_outrights']]
-
-        return sports_list
+        sports_json = sports_response.json()
+        if cache is not None:
+            cache.put(('sports',), sports_json)
+            cache.evict()
+
+    sports_list = [sport['key'] for sport in sports_json if not sport['has_outrights'] and sport.get('active', True)]
+
+    return sports_list
+
+# Pulls the odds of a single sport, returns the response (or None if the request failed)
+# With bookmakers_string, only those bookmakers are pulled instead of the regions
+def get_odds(session, api_key, sport, regions_string, markets_string, base_url=ODDS_API_URL, max_retries=3, backoff=0.5, telemetry=None, bookmakers_string=None):
+    odds_response = get_with_retries(
+        session,
+        f'{base_url}/sports/{sport}/odds',
+        params={
+            'api_key': api_key,
+            **({'regions': regions_string} if bookmakers_string is None else {'bookmakers': bookmakers_string}),
+            'markets': markets_string,
+            'oddsFormat': 'american',
+            'dateFormat': 'iso',
+        },
+        max_retries=max_retries,
+        backoff=backoff,
+        telemetry=telemetry
+    )
+
+    if odds_response is None:
+        return
+
+    if odds_response.status_code != 200:
+        warn(f'Failed to get odds for {sport}: status_code {odds_response.status_code}, response body {odds_response.text}', telemetry)
+        return
+
+    return odds_response
+
+# Returns the upcoming events of a sport (without odds) from the API, which isn't charged against the quota (or None if the request failed)
+def get_events(session, api_key, sport, base_url=ODDS_API_URL, max_retries=3, backoff=0.5, telemetry=None):
+    events_response = get_with_retries(session, f'{base_url}/sports/{sport}/events', params={'api_key': api_key, 'dateFormat': 'iso'}, max_retries=max_retries, backoff=backoff, telemetry=telemetry)
+
+    if events_response is None:
+        return
+
+    if events_response.status_code != 200:
+        warn(f'Failed to get events for {sport}: status_code {events_response.status_code}, response body {events_response.text}', telemetry)
+        return
+
+    return events_response.json()
+
+# Pulls data from the API into a JSON object
+# Sports are requested concurrently by up to max_workers threads sharing one pooled session, events come back in the order of sports
+# With a cache, only the (sport, region, market) combinations that are not cached are requested, one region per request so every response can be cached per region
+# (the API charges regions x markets per request, so splitting regions does not cost any extra quota)
+# Every request is reported to telemetry as a 'fetch' stage, and the quota left afterwards as a 'quota' event
+# With bookmakers, only those bookmakers are requested instead of the regions (every 10 bookmakers cost as much as one region), and they are cached as one group
+def api_to_json(api_key, sports=None, regions=['us', 'eu', 'uk', 'au'], markets=['h2h', 'spreads', 'totals'], max_workers=8, session=None, base_url=ODDS_API_URL, max_retries=3, backoff=0.5, cache=None, telemetry=None, bookmakers=None):
+    session = session or odds_session(max_workers=max_workers)
+    if sports is None:
+        sports = get_sports(api_key=api_key, session=session, base_url=base_url, cache=cache, telemetry=telemetry) or []
+    groups = regions if bookmakers is None else [','.join(bookmakers)]
 
-    # Pulls data from the API into a JSON object
-    def api_to_json(api_key, sports=None, regions=['us', 'eu', 'uk', 'au'], markets=['h2h', 'spreads', 'totals']):
+    # List the (sport, regions or bookmakers, markets) requests that have to be sent
+    cached_json = {sport: [] for sport in sports}
+    if cache is None:
+        odds_requests = [(sport, ','.join(groups), ','.join(markets)) for sport in sports]
+    else:
+        odds_requests = []
+        for sport in sports:
+            for region in groups:
+                missing_markets = []
+                for market in markets:
+                    odds_json = cache.get((sport, region, market))
+                    if odds_json is None:
+                        missing_markets.append(market)
+                    else:
+                        cached_json[sport].append(odds_json)
+                if missing_markets:
+                    odds_requests.append((sport, region, ','.join(missing_markets)))
+
+    # Pulls the odds of one request
+    def fetch(odds_request):
+        sport, groups_string, markets_string = odds_request
+        sources = {'regions': groups_string} if bookmakers is None else {'bookmakers': groups_string}
+        with stage(telemetry, 'fetch', sport=sport, **sources, markets=markets_string) as fetch_stage:
+            odds_response = get_odds(session, api_key, sport, groups_string if bookmakers is None else None, markets_string, base_url=base_url, max_retries=max_retries, backoff=backoff, telemetry=telemetry, bookmakers_string=None if bookmakers is None else groups_string)
+            if odds_response is not None:
+                fetch_stage.rows = len(odds_response.json())
+        return odds_response
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        responses = list(executor.map(fetch, odds_requests))
+
+    fetched_json = {sport: [] for sport in sports}
+    quota_response = None
+    for (sport, region, markets_string), odds_response in zip(odds_requests, responses):
+        if odds_response is None:
+            continue
+        odds_json = odds_response.json()
+        fetched_json[sport].append(odds_json)
+        if cache is not None:
+            for market in markets_string.split(','):
+                cache.put((sport, region, market), events_for_market(odds_json, market))
+        # The response that was counted last carries the most up to date quota
+        if quota_response is None or int(odds_response.headers.get('x-requests-used', 0)) >= int(quota_response.headers.get('x-requests-used', 0)):
+            quota_response = odds_response
+
+    all_odds_json = []
+    for sport in sports:
+        if cache is None:
+            for odds_json in fetched_json[sport]:
+                all_odds_json.extend(odds_json)
+        else:
+            all_odds_json.extend(merge_events(cached_json[sport] + fetched_json[sport]))
+
+    # Check the usage quota (telemetry gets it as the 'quota' event instead)
+    if quota_response is not None and telemetry is None:
+        print('Remaining requests', quota_response.headers.get('x-requests-remaining'))
+        print('Used requests', quota_response.headers.get('x-requests-used'))
+    if cache is not None:
+        cache.evict()
+    if telemetry is not None:
+        cache_fields = {'cache_hits': cache.hits, 'cache_misses': cache.misses} if cache is not None else {}
+        telemetry.emit('quota', requests_sent=len(odds_requests), **(quota_headers(quota_response) if quota_response is not None else {}), **cache_fields)
+
+    return all_odds_json
+
+# Fields of every request planned by plan_requests()
+REQUEST_PLAN_FIELDS = ['sport', 'request', 'regions', 'bookmakers', 'markets', 'events', 'cost']
+
+# Quota cost of one odds request by the API's cost model: the number of regions (or of groups of up to 10 bookmakers, which cost one region each) times the number of markets
+def request_cost(markets, regions=None, bookmakers=None):
+    groups = len(regions) if bookmakers is None else -(-len(bookmakers) // 10)
+    return groups * len(markets)
+
+# Returns the bookmakers that a pull can be narrowed to without changing any ev, or None when it needs every book of the regions
+# Those are the books filter, plus pinnacle for the pinnacle ev and the consensus books for the avg ev,
+# and only when the avg ev isn't the average of every book and no min_num_books filter counts the other books
+# The other books are still missing from num_books, so a pull is only narrowed when asked to (narrow in plan_requests())
+# Books are sent as the bookmakers parameter, so every one of them has to look like a bookmaker key
+def needed_bookmakers(ev_type, books, consensus_weights, min_num_books):
+    if books is None or min_num_books is not None or (ev_type != 'pinnacle' and (consensus_weights is None or consensus_weights.get('default', 0) > 0)):
+        return None
+    needed = set(books)
+    if ev_type != 'avg':
+        needed.add('pinnacle')
+    if ev_type != 'pinnacle':
+        needed.update(book for book, weight in consensus_weights.items() if weight > 0 and book != 'default')
+    if any(type(book) != str or not re.fullmatch('[a-z0-9_]+', book) for book in needed):
+        return None
+    return sorted(needed)
+
+# Plans the odds requests of a pull before any odds are fetched, only the free sports and events listings are requested
+# Sports that are out of season, or whose events all start after commence_to (by the events listing), are skipped
+# Pinnacle ev needs the eu book pinnacle: when the eu region isn't pulled, pinnacle is pulled on its own
+# With narrow, the whole pull is narrowed to the bookmakers it needs (see needed_bookmakers()) when that costs less, which leaves the other books out of num_books
+# Returns one row per request ('odds', 'pinnacle' or 'skipped') with its quota cost, cache hits aren't taken into account so the cost is an upper bound
+def plan_requests(api_key, sports=None, regions=['us', 'eu', 'uk', 'au'], markets=['h2h', 'spreads', 'totals'], ev_type='both', commence_to=None, books=None, consensus_weights=None, min_num_books=None, narrow=False, max_workers=8, session=None, base_url=ODDS_API_URL, cache=None, telemetry=None):
+    session = session or odds_session(max_workers=max_workers)
+    with stage(telemetry, 'plan') as plan_stage:
         if sports is None:
-            sports = get_sports(api_key=api_key)
-        regions_string = ','.join(regions)
-        markets_string = ','.join(markets)
-
-        all_odds_json = []
-
+            sports = get_sports(api_key=api_key, session=session, base_url=base_url, cache=cache, telemetry=telemetry) or []
+
+        # Count the events of every sport within the days_from_now window (sports whose listing failed are pulled anyway)
+        events = {sport: None for sport in sports}
+        if commence_to is not None:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                listings = list(executor.map(lambda sport: get_events(session, api_key, sport, base_url=base_url, telemetry=telemetry), sports))
+            for sport, listing in zip(sports, listings):
+                if listing is not None:
+                    events[sport] = int((pandas.to_datetime([event['commence_time'] for event in listing], utc=True) <= commence_to).sum())
+
+        pinnacle_pull = ev_type != 'avg' and 'eu' not in regions
+        regions_cost = request_cost(markets, regions) + (request_cost(markets, bookmakers=['pinnacle']) if pinnacle_pull else 0)
+        bookmakers = needed_bookmakers(ev_type, books, consensus_weights, min_num_books) if narrow else None
+        if bookmakers is not None and request_cost(markets, bookmakers=bookmakers) >= regions_cost:
+            bookmakers = None
+
+        plan = []
         for sport in sports:
-            
-            odds_response = requests.get(
-                f'https://api.the-odds-api.com/v4/sports/{sport}/odds',
-                params={
-                    'api_key': api_key,
-                    'regions': regions_string,
-                    'markets': markets_string,
-                    'oddsFormat': 'american',
-                    'dateFormat': 'iso',
-                }
-            )
-
-            if odds_response.status_code != 200:
-                print(f'Failed to get odds: status_code {odds_response.status_code}, response body {odds_response.text}')
-
+            if events[sport] == 0:
+                plan.append([sport, 'skipped', None, None, None, 0, 0])
+            elif bookmakers is not None:
+                plan.append([sport, 'odds', None, ','.join(bookmakers), ','.join(markets), events[sport], request_cost(markets, bookmakers=bookmakers)])
             else:
-                odds_json = odds_response.json()
-                all_odds_json.extend(odds_json)
+                plan.append([sport, 'odds', ','.join(regions), None, ','.join(markets), events[sport], request_cost(markets, regions)])
+                if pinnacle_pull:
+                    plan.append([sport, 'pinnacle', None, 'pinnacle', ','.join(markets), events[sport], request_cost(markets, bookmakers=['pinnacle'])])
+        plan = pandas.DataFrame(plan, columns=REQUEST_PLAN_FIELDS).astype({'events': 'Int64', 'cost': numpy.int64})
+        plan_stage.rows = int((plan['request'] != 'skipped').sum())
+
+    return plan
+
+# Polls the odds of several sports for as long as it runs, spending the request quota where it matters most
+# Each sport is polled more often the closer its next event is and the more its lines have been moving, within [min_interval, max_interval] seconds:
+# a sport is polled polls_to_start times until its next event starts, and volatility_weight times more often when all of its lines moved in the last polls
+# The remaining quota (x-requests-remaining) is spread over the rest of the quota_period (the API's quota resets monthly, counted from the start of the scheduler),
+# and an optional budget of requests per budget_period over the rest of that period, by stretching every interval evenly
+# Sports without events within days_from_now are not polled, the free events listing is checked every events_interval seconds instead
+# clock, sleep and session can be replaced to run the scheduler against a simulated clock and a fake API
+class PollScheduler:
+    def __init__(self, api_key, sports=None, regions=['us', 'eu', 'uk', 'au'], markets=['h2h', 'spreads', 'totals'], days_from_now=None, budget=None, budget_period=86400, quota_period=30 * 86400, min_interval=30, max_interval=3600, events_interval=3600, polls_to_start=48, volatility_weight=4, on_odds=None, session=None, base_url=ODDS_API_URL, clock=time.time, sleep=time.sleep, telemetry=None):
+        self.api_key = api_key
+        self.telemetry = as_telemetry(telemetry)
+        self.session = session or odds_session()
+        self.base_url = base_url
+        self.regions_string = ','.join(regions)
+        self.markets_string = ','.join(markets)
+        # The API charges one request per region per market
+        self.cost = len(regions) * len(markets)
+        self.days_from_now = days_from_now
+        self.budget = budget
+        self.budget_period = budget_period
+        self.quota_period = quota_period
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.events_interval = events_interval
+        self.polls_to_start = polls_to_start
+        self.volatility_weight = volatility_weight
+        self.on_odds = on_odds
+        self.clock = clock
+        self.sleep = sleep
 
-                # Check the usage quota
-                print('Remaining requests', odds_response.headers['x-requests-remaining'])
-                print('Used requests', odds_response.headers['x-requests-used'])
-
-        return odds_json
-
-    # Reads data from a JSON file into a JSON object
-    def file_to_json(filename):
-        odds_json = json.load(open(filename))
-
-        return odds_json
-
-    # Converts the JSON object to a Dataframe
-    def json_to_df(odds_json):
-        # Put the json in a dataframe
-        df_ori = pandas.DataFrame(odds_json)
-
-        return df_ori
-
-    # Takes API parameters and returns the resulting Dataframe
-    def api_to_df(api_key, sports=None, regions=['us', 'eu', 'uk', 'au'], markets=['h2h', 'spreads', 'totals']):
-        json_data = api_to_json(api_key=api_key, sports=sports, regions=regions, markets=markets)
-        df_data = json_to_df(json_data)
-        return df_data
-
-    # Reads data from a JSON file and converts it to a Dataframe
-    def file_to_df(filename):
-        json_data = file_to_json(filename)
-        df_data = json_to_df(json_data)
-        return df_data
-
-    # Unpacks a Dataframe that was derived from JSON into it's most robust, redundant form
-    def unpacked_data(df_ori):
-        # Unpack each of the bookmakers the 'bookmakers' column into its own row
-        # Make new dataframe of bookmakers where each bookmaker has its own column
-        df_bookmakers = pandas.DataFrame(list(df_ori['bookmakers']))
-
-        # Concactenate df and df2 together
-        df = pandas.concat([df_ori, df_bookmakers], axis=1, join='inner')
-
-        # Unpivot the table using the melt() function (take the bookmaker columns and combine them into multiple rows in the same single column)
-        df = pandas.melt(df, id_vars=df_ori.columns, value_name='bookmaker')
-        df.drop(columns=['variable', 'bookmakers'], inplace=True)
-        df.sort_values(['commence_time', 'id'], inplace=True)
-        df.dropna(inplace=True)
-        df.reset_index(drop=True, inplace=True)
-
-        # Now, unpack the json in the bookmaker column
-        df_ori = df
-        df_bookmakers = pandas.DataFrame(list(df_ori['bookmaker']))
-        df = pandas.concat([df_ori, df_bookmakers], axis=1, join='inner')
-        df.drop(columns=['bookmaker'], inplace=True)
-        df.rename(columns={'key' : 'book_key', 'title' : 'book_title'}, inplace=True)
-
-        # Now, do the same unpacking, concat, and melting with the markets column
-        df_ori = df
-        df_markets = pandas.DataFrame(list(df_ori['markets']))
-        df = pandas.concat([df_ori, df_markets], axis=1, join='inner')
-
-        df = pandas.melt(df, id_vars=df_ori.columns, value_name='market')
-        df.drop(columns=['variable', 'markets'], inplace=True)
-        df.sort_values(['commence_time', 'id', 'book_key'], inplace=True)
-        df.dropna(inplace=True)
-        df.reset_index(drop=True, inplace=True)
-
-        # Unpack the json in market column
-        df_ori = df
-        df_market = pandas.DataFrame(list(df_ori['market']))
-        df = pandas.concat([df_ori, df_market], axis=1, join='inner')
-        df.drop(columns=['market'], inplace=True)
-        df.rename(columns={'key' : 'market'}, inplace=True)
-
-        # Delete all lay markets
-        df = df.loc[~df['market'].isin(['h2h_lay', 'outright_lay'])]
-        df.reset_index(drop=True, inplace=True)
-
-        # Unpack the 'outcomes' column
-        df_ori = df
-        df_outcomes = pandas.DataFrame(list(df_ori['outcomes']))
-        df = pandas.concat([df_ori, df_outcomes], axis=1, join='inner')
-
-        # Melt the resulting columns
-        df = pandas.melt(df, id_vars=df_ori.columns, value_name='outcome')
-        df.drop(columns=['outcomes', 'variable'], inplace=True)
-        df.sort_values(['commence_time', 'id', 'book_key', 'market'], inplace=True)
-        df.dropna(inplace=True)
-        df.reset_index(drop=True, inplace=True)
-
-        # Unpack outcome column
-        df_ori = df
-        df_outcome = pandas.DataFrame(list(df_ori['outcome']))
-        df = pandas.concat([df_ori, df_outcome], axis=1, join='inner')
-        df.drop(columns=['outcome'], inplace=True)
-        df.rename(columns={'name' : 'position', 'price' : 'line'}, inplace=True)
-
-        return df
-
-    # Expands an unpacked Dataframe by calculating additional columns
-    def processed_data(df):
-        # Calculate the number of possible outcomes for the market
-        df['num_outcomes'] = df.groupby(by=['id', 'book_key', 'market'])['line'].transform('count')
-        # Calculate the market width only for markets with 2 outcomes
-        df['above_below'] = numpy.where(df['num_outcomes'] != 2, numpy.nan, numpy.where(df['line'] > 0, df['line'] - 100, df['line'] + 100))
-        df['width'] = numpy.where(df['num_outcomes'] != 2, numpy.nan, (-1)*(df.groupby(by=['id', 'book_key', 'market'])['above_below'].transform('sum')))
-
-        # Calculate the number of books that carry each market
-        key_fields = ['id', 'sport_key', 'sport_title', 'commence_time', 'home_team', 'away_team', 'market', 'position', 'point']
-        df['num_books'] = df.groupby(by=key_fields, dropna=False)['book_key'].transform('count')
-
-        # Calculate the implied win dec, fair implied win dec, fair line, amount to win from the real line, amount to win from the fair line, and vig pct
-        df['vig_win_dec'] = numpy.where(df['line'] > 0, 100/(df['line'] + 100), abs(df['line'])/(abs(df['line']) + 100))
-        df['fair_win_dec'] = df['vig_win_dec']/df.groupby(by=['id', 'book_key', 'market'])['vig_win_dec'].transform('sum')
-        df['fair_line'] = numpy.where(df['fair_win_dec'] < 0.5, (100/df['fair_win_dec']) - 100, ((df['fair_win_dec']*100)/(1-df['fair_win_dec']))*(-1))
-        df['amount_to_win_line'] = numpy.where(df['line'] > 0, df['line'], (100/abs(df['line']))*100)
-        df['amount_to_win_fair'] = numpy.where(df['fair_line'] > 0, df['fair_line'], (100/abs(df['fair_line']))*100)
-        # Vig pct to be used for multi-outcome games where market width cannot be calculated
-        df['vig_dec'] = df.groupby(by=['id', 'book_key', 'market'])['vig_win_dec'].transform('sum') - df.groupby(by=['id', 'book_key', 'market'])['fair_win_dec'].transform('sum')
-        df['vig_pct'] = df['vig_dec'] * 100
-
-        return df
-
-    # Takes API parameters and returns a fully unpacked and processed Dataframe
-    def api_to_processed_df(api_key, sports=None, regions=['us', 'eu', 'uk', 'au'], markets=['h2h', 'spreads', 'totals']):
-        raw_df = api_to_df(api_key=api_key, sports=sports, regions=regions, markets=markets)
-        unpacked_df = unpacked_data(raw_df)
-        processed_df = processed_data(unpacked_df)
-        return processed_df
+        if sports is None:
+            sports = get_sports(api_key=api_key, session=self.session, base_url=base_url, telemetry=self.telemetry) or []
+        now = self.clock()
+        self.sports = {sport: {'next_poll': now, 'next_events': now, 'next_commence': None, 'volatility': 0.0, 'prices': {}} for sport in sports}
+        self.remaining = None
+        self.used = None
+        self.period_start = now
+        self.period_used = 0
+        self.quota_start = now
+        self.polls = 0
+
+    # Returns the start time of the next event of a sport within the days_from_now window (or None if there isn't one)
+    def next_commence(self, events):
+        now = self.clock()
+        end = now + self.days_from_now * 86400 if self.days_from_now is not None else float('inf')
+        times = [dateutil.parser.isoparse(event['commence_time']).timestamp() for event in events]
+        times = [t for t in times if now <= t <= end]
+        return min(times) if times else None
+
+    # Returns the polling interval of a sport from how soon its next event starts and how volatile its lines are
+    def interval(self, state):
+        if state['next_commence'] is None:
+            return self.max_interval
+        seconds_to_start = max(state['next_commence'] - self.clock(), 0)
+        interval = seconds_to_start / self.polls_to_start
+        interval /= 1 + self.volatility_weight * state['volatility']
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    # Returns the limits on the requests that are left as (requests left, end of the period they have to last), for the quota and the budget
+    def limits(self):
+        limits = []
+        if self.remaining is not None:
+            limits.append((self.remaining, self.quota_start + self.quota_period))
+        if self.budget is not None:
+            limits.append((self.budget - self.period_used, self.period_start + self.budget_period))
+        return limits
+
+    # Returns how much every interval has to be stretched so the planned polling fits in the requests that are left in every limit
+    def quota_factor(self):
+        factor = 1.0
+        for left, end in self.limits():
+            if left < self.cost:
+                return float('inf')
+            seconds_left = max(end - self.clock(), 1)
+            planned = sum(self.cost * seconds_left / self.interval(state) for state in self.sports.values() if state['next_commence'] is not None)
+            factor = max(factor, planned / left)
+        return factor
+
+    # Updates a sport's volatility with the share of its lines that moved since the last poll
+    def update_volatility(self, state, odds_json):
+        prices = {}
+        for event in odds_json:
+            for bookmaker in event.get('bookmakers', []):
+                for market in bookmaker.get('markets', []):
+                    for outcome in market.get('outcomes', []):
+                        prices[(event['id'], bookmaker['key'], market['key'], outcome['name'], outcome.get('point'))] = outcome['price']
+        if state['prices']:
+            common = [key for key in prices if key in state['prices']]
+            moved = sum(prices[key] != state['prices'][key] for key in common) / len(common) if common else 0.0
+            # Exponentially weighted so a single quiet poll doesn't reset it
+            state['volatility'] = 0.5 * state['volatility'] + 0.5 * moved
+        state['prices'] = prices
+
+    # Refreshes the events of a sport, returns False if the sport has nothing within days_from_now
+    def refresh_events(self, sport, state):
+        events = get_events(self.session, self.api_key, sport, base_url=self.base_url, telemetry=self.telemetry)
+        state['next_events'] = self.clock() + self.events_interval
+        if events is not None:
+            state['next_commence'] = self.next_commence(events)
+        return state['next_commence'] is not None
+
+    # Waits for the next sport that is due and polls it, returns (sport, odds JSON) or (sport, None) if the sport was skipped or the quota ran out
+    def step(self):
+        # Start a new budget period, or quota period, once the current one is over
+        if self.clock() >= self.period_start + self.budget_period:
+            self.period_start = self.clock()
+            self.period_used = 0
+        # (the remaining quota of the last response is stale then, the next response tells the new one)
+        if self.clock() >= self.quota_start + self.quota_period:
+            self.quota_start = self.clock()
+            self.remaining = None
+
+        sport, state = min(self.sports.items(), key=lambda item: min(item[1]['next_poll'], item[1]['next_events']))
+        due = min(state['next_poll'], state['next_events'])
+        if due > self.clock():
+            self.sleep(due - self.clock())
+
+        if self.clock() >= state['next_events'] and not self.refresh_events(sport, state):
+            state['next_poll'] = state['next_events']
+            return sport, None
+        if self.clock() < state['next_poll']:
+            return sport, None
+
+        factor = self.quota_factor()
+        if factor == float('inf'):
+            # Out of requests until the period of the limit that ran out ends
+            state['next_poll'] = min(end for left, end in self.limits() if left < self.cost)
+            return sport, None
+
+        odds_response = get_odds(self.session, self.api_key, sport, self.regions_string, self.markets_string, base_url=self.base_url, telemetry=self.telemetry)
+        self.polls += 1
+        odds_json = None
+        if odds_response is not None:
+            odds_json = odds_response.json()
+            self.period_used += self.cost
+            if 'x-requests-remaining' in odds_response.headers:
+                self.remaining = float(odds_response.headers['x-requests-remaining'])
+            if 'x-requests-used' in odds_response.headers:
+                self.used = float(odds_response.headers['x-requests-used'])
+            self.update_volatility(state, odds_json)
+            state['next_commence'] = self.next_commence(odds_json)
+            if self.on_odds is not None:
+                self.on_odds(sport, odds_json)
+
+        state['next_poll'] = self.clock() + self.interval(state) * factor
+        if self.telemetry is not None:
+            self.telemetry.emit('poll', sport=sport, events=len(odds_json) if odds_json is not None else None, volatility=state['volatility'], quota_factor=factor, next_poll_seconds=state['next_poll'] - self.clock(), requests_remaining=self.remaining, requests_used=self.used, period_used=self.period_used)
+        return sport, odds_json
+
+    # Keeps polling until the clock reaches until or max_polls odds requests have been made
+    def run(self, until=None, max_polls=None):
+        while self.sports and (until is None or self.clock() < until) and (max_polls is None or self.polls < max_polls):
+            self.step()
+
+# Whether a file is gzipped (by its magic number rather than its extension)
+def is_gzipped(filename):
+    with open(filename, 'rb') as file:
+        return file.read(2) == b'\x1f\x8b'
+
+# Opens a snapshot file as text, transparently decompressing gzip files
+def open_snapshot(filename):
+    if is_gzipped(filename):
+        return gzip.open(filename, 'rt')
+    return open(filename)
+
+# Yields the events of a snapshot file one at a time without loading the whole file
+# Accepts a JSON list of events (like the API returns) or newline-delimited JSON where each line is an event or a list of events, either of them optionally gzipped
+def iter_events(filename, buffer_size=1 << 20):
+    decoder = json.JSONDecoder()
+
+    with open_snapshot(filename) as file:
+        buffer = file.read(buffer_size)
+        pos = 0
+        while pos < len(buffer) and buffer[pos].isspace():
+            pos += 1
+
+        # A single JSON list is decoded one element at a time from a sliding buffer
+        if buffer[pos:pos + 1] == '[' and not filename.endswith(('.jsonl', '.jsonl.gz', '.ndjson', '.ndjson.gz')):
+            pos += 1
+            while True:
+                while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ','):
+                    pos += 1
+                if pos == len(buffer):
+                    more = file.read(buffer_size)
+                    if not more:
+                        raise ValueError(f'{filename} ended before the end of the list of events')
+                    buffer, pos = buffer[pos:] + more, 0
+                    continue
+                if buffer[pos] == ']':
+                    pos += 1
+                    break
+
+                try:
+                    event, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # The event is cut off by the end of the buffer, read more and try again
+                    more = file.read(buffer_size)
+                    if not more:
+                        raise
+                    buffer, pos = buffer[pos:] + more, 0
+                    continue
+                yield event
+                pos = end
+
+            # A newline-delimited file named .json has more lines after the first list, they are read line by line
+            while True:
+                while pos < len(buffer) and buffer[pos].isspace():
+                    pos += 1
+                if pos < len(buffer):
+                    break
+                buffer, pos = file.read(buffer_size), 0
+                if not buffer:
+                    return
+
+        # Otherwise the file is read line by line
+        lines = itertools.chain(buffer[pos:].splitlines(keepends=True), file)
+        partial = ''
+        for line in lines:
+            # The first buffer can end in the middle of a line
+            if not line.endswith('\n'):
+                partial += line
+                continue
+            line, partial = partial + line, ''
+            if line.strip():
+                value = json.loads(line)
+                if isinstance(value, list):
+                    yield from value
+                else:
+                    yield value
+        if partial.strip():
+            value = json.loads(partial)
+            if isinstance(value, list):
+                yield from value
+            else:
+                yield value
+
+# Splits a newline-delimited file into about num_ranges byte ranges that start and end on line boundaries
+def line_ranges(filename, num_ranges):
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as file:
+        for number in range(1, num_ranges):
+            file.seek(max(size * number // num_ranges, bounds[-1] + 1) - 1)
+            file.readline()
+            bounds.append(min(file.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+# Yields the events of the lines between two byte offsets of a newline-delimited snapshot file (each line is an event or a list of events)
+def iter_line_events(filename, start, end):
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        for line in file.read(end - start).splitlines():
+            if line.strip():
+                value = json.loads(line)
+                if isinstance(value, list):
+                    yield from value
+                else:
+                    yield value
+
+# Groups an iterable of events into lists of at most chunk_size events
+def iter_chunks(events, chunk_size):
+    events = iter(events)
+    while True:
+        chunk = list(itertools.islice(events, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+# Reads data from a snapshot file into a JSON object
+def file_to_json(filename):
+    odds_json = list(iter_events(filename))
+
+    return odds_json
+
+# Reads a snapshot file chunk_size events at a time and returns the fully unpacked and processed Dataframe
+# Every calculation in processed_data() stays within one event, so chunks can be processed independently and peak memory depends on chunk_size rather than the file size
+def file_to_processed_df(filename, chunk_size=1000, telemetry=None, devig='multiplicative'):
+    return events_to_processed_df(iter_events(filename), chunk_size=chunk_size, telemetry=telemetry, devig=devig)
+
+# Processes an iterable of events chunk_size events at a time and returns the fully unpacked and processed Dataframe
+def events_to_processed_df(events, chunk_size=1000, telemetry=None, devig='multiplicative'):
+    processed_chunks = []
+    for chunk_number, chunk in enumerate(iter_chunks(events, chunk_size)):
+        with stage(telemetry, 'flatten', chunk=chunk_number) as flatten_stage:
+            flattened_chunk = flattened_data(chunk)
+            flatten_stage.rows = len(flattened_chunk)
+        with stage(telemetry, 'process', chunk=chunk_number) as process_stage:
+            processed_chunks.append(processed_data(flattened_chunk, devig))
+            process_stage.rows = len(processed_chunks[-1])
+    if not processed_chunks:
+        return processed_data(flattened_data([]), devig)
+
+    # Offset each chunk's dense codes so they stay unique across chunks
+    market_offset, position_offset = 0, 0
+    for processed_chunk in processed_chunks:
+        if len(processed_chunk) == 0:
+            continue
+        processed_chunk['market_code'] += market_offset
+        processed_chunk['position_code'] += position_offset
+        market_offset = processed_chunk['market_code'].max() + 1
+        position_offset = processed_chunk['position_code'].max() + 1
+
+    processed_df = concat_odds(processed_chunks)
+
+    return processed_df
+
+# Fields the snapshot store is partitioned by (capture_date is the UTC date the snapshot was taken)
+STORE_PARTITIONS = ['capture_date', 'sport_key']
+
+# Imports pyarrow, which is only needed for the snapshot store and sharded queries
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('the snapshot store and sharded queries require pyarrow: pip install pyarrow')
+    return pyarrow
+
+# Serializes a Dataframe to Arrow IPC stream bytes, so it moves between processes as flat buffers instead of a pickled Dataframe
+def to_ipc(df):
+    pyarrow = import_pyarrow()
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+# Reads a Dataframe back from Arrow IPC stream bytes written by to_ipc()
+def from_ipc(buffer):
+    pyarrow = import_pyarrow()
+    return pyarrow.ipc.open_stream(buffer).read_all().to_pandas()
+
+# Writes a flattened (or processed) Dataframe of odds to a snapshot store: a directory of Parquet files partitioned by capture date and sport_key
+# String columns are dictionary encoded, and the group code columns are left out because they are only meaningful within one Dataframe
+def write_snapshot(store, odds, captured_at=None):
+    pyarrow = import_pyarrow()
+    captured_at = captured_at or datetime.datetime.now(datetime.timezone.utc)
+
+    odds = odds.drop(columns=[field for field in ['market_code', 'position_code', 'position_key'] if field in odds.columns])
+    odds = odds.assign(captured_at=pandas.Timestamp(captured_at), capture_date=captured_at.strftime('%Y-%m-%d'))
+    table = pyarrow.Table.from_pandas(odds, preserve_index=False)
+    # Repeated strings (teams, books, markets, timestamps...) are stored once per row group
+    table = table.cast(pyarrow.schema([pyarrow.field(field.name, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())) if pyarrow.types.is_string(field.type) or pyarrow.types.is_large_string(field.type) else field for field in table.schema]))
+
+    pyarrow.dataset.write_dataset(
+        table,
+        store,
+        format='parquet',
+        partitioning=STORE_PARTITIONS,
+        partitioning_flavor='hive',
+        basename_template=f'{captured_at.strftime("%Y%m%dT%H%M%S%f")}-{{i}}.parquet',
+        existing_data_behavior='overwrite_or_ignore'
+    )
+
+# Reads odds back from a snapshot store through memory mapped files, only reading the partitions and columns that are asked for
+# sports, books and markets are lists of keys, start and end are dates (or 'YYYY-MM-DD' strings) of the first and last capture date to read
+def read_snapshots(store, columns=None, sports=None, start=None, end=None, books=None, markets=None):
+    pyarrow = import_pyarrow()
+    partitioning = pyarrow.dataset.partitioning(pyarrow.schema([pyarrow.field(field, pyarrow.string()) for field in STORE_PARTITIONS]), flavor='hive')
+
+    # Filters on partition fields prune whole directories, the book and market filters are pushed down to the row groups
+    filters = []
+    if sports is not None:
+        filters.append(pyarrow.dataset.field('sport_key').isin(sports))
+    if start is not None:
+        filters.append(pyarrow.dataset.field('capture_date') >= str(start))
+    if end is not None:
+        filters.append(pyarrow.dataset.field('capture_date') <= str(end))
+    if books is not None:
+        filters.append(pyarrow.dataset.field('book_key').isin(books))
+    if markets is not None:
+        filters.append(pyarrow.dataset.field('market').isin(markets))
+    expression = None
+    for dataset_filter in filters:
+        expression = dataset_filter if expression is None else expression & dataset_filter
+
+    table = pyarrow.parquet.read_table(store, columns=columns, filters=expression, memory_map=True, partitioning=partitioning)
+    odds = table.to_pandas(categories=None)
+    if 'capture_date' in odds.columns:
+        odds['capture_date'] = odds['capture_date'].astype(str)
+
+    return odds
+
+# Reads the latest capture of every market from a snapshot store and returns the fully unpacked and processed Dataframe, without any JSON parsing
+def store_to_processed_df(store, sports=None, markets=None, devig='multiplicative'):
+    odds = read_snapshots(store, sports=sports, markets=markets)
+
+    # Keep only the most recent capture of each market at each book
+    if len(odds) > 0:
+        market_code = pandas.factorize(pandas.util.hash_pandas_object(odds[MARKET_FIELDS], index=False))[0]
+        captured_at = odds['captured_at'].dt.tz_localize(None).to_numpy().astype(numpy.int64)
+        latest = numpy.full(market_code.max() + 1, numpy.iinfo(numpy.int64).min)
+        numpy.maximum.at(latest, market_code, captured_at)
+        odds = odds.loc[captured_at == latest[market_code]]
+
+    odds = odds.drop(columns=['captured_at', 'capture_date']).reset_index(drop=True)
+    # Dictionary encoded strings come back as categories already, typed_data() sorts their categories (and parses timestamps stored as strings)
+    processed_df = processed_data(group_codes(typed_data(odds)), devig)
+
+    return processed_df
+
+# Unpacks a Dataframe that was derived from JSON (pandas.DataFrame(odds_json)) into it's most robust, redundant form
+# Kept as the reference implementation for flattened_data()
+def unpacked_data(df_ori):
+    # Unpack each of the bookmakers the 'bookmakers' column into its own row
+    # Make new dataframe of bookmakers where each bookmaker has its own column
+    df_bookmakers = pandas.DataFrame(list(df_ori['bookmakers']))
+
+    # Concactenate df and df2 together
+    df = pandas.concat([df_ori, df_bookmakers], axis=1, join='inner')
+
+    # Unpivot the table using the melt() function (take the bookmaker columns and combine them into multiple rows in the same single column)
+    df = pandas.melt(df, id_vars=df_ori.columns, value_name='bookmaker')
+    df.drop(columns=['variable', 'bookmakers'], inplace=True)
+    df.sort_values(['commence_time', 'id'], inplace=True)
+    df.dropna(inplace=True)
+    df.reset_index(drop=True, inplace=True)
+
+    # Now, unpack the json in the bookmaker column
+    df_ori = df
+    df_bookmakers = pandas.DataFrame(list(df_ori['bookmaker']))
+    df = pandas.concat([df_ori, df_bookmakers], axis=1, join='inner')
+    df.drop(columns=['bookmaker'], inplace=True)
+    df.rename(columns={'key' : 'book_key', 'title' : 'book_title'}, inplace=True)
+
+    # Now, do the same unpacking, concat, and melting with the markets column
+    df_ori = df
+    df_markets = pandas.DataFrame(list(df_ori['markets']))
+    df = pandas.concat([df_ori, df_markets], axis=1, join='inner')
+
+    df = pandas.melt(df, id_vars=df_ori.columns, value_name='market')
+    df.drop(columns=['variable', 'markets'], inplace=True)
+    df.sort_values(['commence_time', 'id', 'book_key'], inplace=True)
+    df.dropna(inplace=True)
+    df.reset_index(drop=True, inplace=True)
+
+    # Unpack the json in market column
+    df_ori = df
+    df_market = pandas.DataFrame(list(df_ori['market']))
+    df = pandas.concat([df_ori, df_market], axis=1, join='inner')
+    df.drop(columns=['market'], inplace=True)
+    df.rename(columns={'key' : 'market'}, inplace=True)
+
+    # Delete all lay markets
+    df = df.loc[~df['market'].isin(['h2h_lay', 'outright_lay'])]
+    df.reset_index(drop=True, inplace=True)
+
+    # Unpack the 'outcomes' column
+    df_ori = df
+    df_outcomes = pandas.DataFrame(list(df_ori['outcomes']))
+    df = pandas.concat([df_ori, df_outcomes], axis=1, join='inner')
+
+    # Melt the resulting columns
+    df = pandas.melt(df, id_vars=df_ori.columns, value_name='outcome')
+    df.drop(columns=['outcomes', 'variable'], inplace=True)
+    df.sort_values(['commence_time', 'id', 'book_key', 'market'], inplace=True)
+    df.dropna(inplace=True)
+    df.reset_index(drop=True, inplace=True)
+
+    # Unpack outcome column
+    df_ori = df
+    df_outcome = pandas.DataFrame(list(df_ori['outcome']))
+    df = pandas.concat([df_ori, df_outcome], axis=1, join='inner')
+    df.drop(columns=['outcome'], inplace=True)
+    df.rename(columns={'name' : 'position', 'price' : 'line'}, inplace=True)
+
+    return df
+
+# Markets that are never priced by the EV calculations
+LAY_MARKETS = ['h2h_lay', 'outright_lay']
+
+# Repeated strings of the flattened odds, stored as categoricals whose categories are sorted so sorting them matches sorting the strings
+CATEGORICAL_FIELDS = ['id', 'sport_key', 'sport_title', 'home_team', 'away_team', 'book_key', 'book_title', 'market', 'position']
+
+# Timestamps of the flattened odds, stored as datetime64[ns, UTC]
+DATETIME_FIELDS = ['commence_time', 'last_update', 'market_last_update']
+
+# Compact dtypes of the numeric fields (lines are American odds, counts are far below the int16 limit, codes below the int32 limit)
+NUMERIC_DTYPES = {'num_outcomes': numpy.int16, 'num_books': numpy.int16, 'market_code': numpy.int32, 'position_code': numpy.int32}
+
+# Returns a categorical with one row per index, from the values of a parent level (events, bookmakers or markets) so every distinct string is only hashed once
+def gathered_categorical(values, index):
+    codes, categories = pandas.factorize(values, sort=True)
+    return pandas.Categorical.from_codes(codes[index], categories=categories)
+
+# Returns UTC datetimes with one row per index, from the ISO timestamps of a parent level so every distinct timestamp is only parsed once
+def gathered_datetimes(values, index):
+    codes, timestamps = pandas.factorize(numpy.asarray(values, dtype=object))
+    nanoseconds = numpy.append(pandas.to_datetime(timestamps, utc=True, format='ISO8601').as_unit('ns').asi8, numpy.iinfo(numpy.int64).min)
+    # Missing timestamps (code -1) pick the NaT appended at the end
+    return pandas.DatetimeIndex(nanoseconds[codes[index]].view('datetime64[ns]')).tz_localize('UTC')
+
+# Converts a Dataframe of odds to the typed schema: categorical key fields, UTC datetimes and compact numbers
+# Fields that already have the right type are left alone, so it is cheap to call on Dataframes that come from flattened_data()
+def typed_data(df):
+    for field in CATEGORICAL_FIELDS:
+        if field not in df.columns:
+            continue
+        if not isinstance(df[field].dtype, pandas.CategoricalDtype):
+            df[field] = pandas.Categorical(df[field])
+        elif not df[field].cat.categories.is_monotonic_increasing:
+            df[field] = df[field].cat.set_categories(df[field].cat.categories.sort_values())
+    for field in DATETIME_FIELDS:
+        if field in df.columns and not pandas.api.types.is_datetime64_any_dtype(df[field]):
+            df[field] = pandas.to_datetime(df[field], utc=True, format='ISO8601').dt.as_unit('ns')
+    for field, dtype in NUMERIC_DTYPES.items():
+        if field in df.columns and df[field].dtype != dtype:
+            df[field] = df[field].astype(dtype)
+    return df
+
+# Concatenates Dataframes of odds, giving every categorical field the union of the categories first (pandas.concat falls back to object strings when they differ)
+def concat_odds(frames, ignore_index=True):
+    frames = list(frames)
+    for field in frames[0].columns:
+        if not isinstance(frames[0][field].dtype, pandas.CategoricalDtype):
+            continue
+        categories = frames[0][field].cat.categories
+        for frame in frames[1:]:
+            if not categories.equals(frame[field].cat.categories):
+                categories = categories.union(frame[field].cat.categories)
+        for i, frame in enumerate(frames):
+            if not categories.equals(frame[field].cat.categories):
+                frames[i] = frame.assign(**{field: frame[field].cat.set_categories(categories)})
+    return pandas.concat(frames, ignore_index=ignore_index)
+
+# Returns the memory used by every column of a Dataframe (strings included) with its dtype, plus a 'total' row
+def memory_report(df):
+    memory = df.memory_usage(deep=True, index=False)
+    report = pandas.DataFrame({'dtype': df.dtypes.astype(str), 'bytes': memory, 'bytes_per_row': memory / max(len(df), 1)})
+    report.loc['total'] = ['', memory.sum(), memory.sum() / max(len(df), 1)]
+    return report
+
+# Flattens a JSON object (list of events) straight into the same outcome-level Dataframe as unpacked_data() (plus the group_codes() columns) in a single pass
+# Each level (event, bookmaker, market) is stored once and outcomes only keep integer references to their parents, so no intermediate Dataframes are built
+# The result has the typed schema of typed_data(): strings and timestamps are converted once per event, bookmaker or market and gathered onto the outcomes
+def flattened_data(odds_json):
+    event_fields = ['id', 'sport_key', 'sport_title', 'commence_time', 'home_team', 'away_team']
+    events = {field: [] for field in event_fields}
+    book_event, book_key, book_title, book_update = array.array('q'), [], [], []
+    market_book, market_key, market_update = array.array('q'), [], []
+    outcome_market, position, line, point = array.array('q'), [], array.array('d'), array.array('d')
+    has_market_update = False
+
+    for event in odds_json:
+        bookmakers = event.get('bookmakers')
+        if not bookmakers:
+            continue
+        event_index = len(events['id'])
+        for field in event_fields:
+            events[field].append(event.get(field))
+
+        for bookmaker in bookmakers:
+            book_index = len(book_key)
+            book_event.append(event_index)
+            book_key.append(bookmaker['key'])
+            book_title.append(bookmaker['title'])
+            book_update.append(bookmaker.get('last_update'))
+
+            for market in bookmaker.get('markets', []):
+                if market['key'] in LAY_MARKETS:
+                    continue
+                market_index = len(market_key)
+                market_book.append(book_index)
+                market_key.append(market['key'])
+                if 'last_update' in market:
+                    has_market_update = True
+                market_update.append(market.get('last_update'))
+
+                for outcome in market.get('outcomes', []):
+                    outcome_market.append(market_index)
+                    position.append(outcome['name'])
+                    line.append(outcome['price'])
+                    point.append(outcome.get('point', numpy.nan))
+
+    # Resolve every market's parents with integer gathers
+    market_book = numpy.frombuffer(market_book, dtype=numpy.int64)
+    market_event = numpy.frombuffer(book_event, dtype=numpy.int64)[market_book]
+    event_values = {field: numpy.array(events[field], dtype=object) for field in event_fields}
+    book_key = numpy.array(book_key, dtype=object)
+    market_key = numpy.array(market_key, dtype=object)
+
+    # Same row order as unpacked_data() (commence_time, id, book_key, market), sorted once per market instead of once per outcome
+    market_order = numpy.lexsort((market_key, book_key[market_book], event_values['id'][market_event], event_values['commence_time'][market_event]))
+    market_rank = numpy.empty_like(market_order)
+    market_rank[market_order] = numpy.arange(len(market_order))
+    outcome_market = numpy.frombuffer(outcome_market, dtype=numpy.int64)
+    # Outcomes keep their original order within each market
+    outcome_order = numpy.argsort(market_rank[outcome_market], kind='stable')
+    outcome_market = outcome_market[outcome_order]
+    outcome_book = market_book[outcome_market]
+    outcome_event = market_event[outcome_market]
+
+    columns = {field: gathered_categorical(event_values[field], outcome_event) for field in event_fields if field != 'commence_time'}
+    columns['commence_time'] = gathered_datetimes(event_values['commence_time'], outcome_event)
+    columns['book_key'] = gathered_categorical(book_key, outcome_book)
+    columns['book_title'] = gathered_categorical(numpy.array(book_title, dtype=object), outcome_book)
+    columns['last_update'] = gathered_datetimes(book_update, outcome_book)
+    columns['market'] = gathered_categorical(market_key, outcome_market)
+    if has_market_update:
+        columns['market_last_update'] = gathered_datetimes(market_update, outcome_market)
+    columns['position'] = gathered_categorical(numpy.array(position, dtype=object), outcome_order)
+    columns['line'] = numpy.frombuffer(line, dtype=numpy.float64)[outcome_order]
+    # Always present (NaN for h2h) because processed_data() groups on it
+    columns['point'] = numpy.frombuffer(point, dtype=numpy.float64)[outcome_order]
+
+    df = pandas.DataFrame({field: columns[field] for field in event_fields + [field for field in columns if field not in event_fields]})
+    # Integer lines stay integers like they do in the JSON
+    if len(df) > 0 and (df['line'] % 1 == 0).all() and df['line'].abs().max() < 2**31:
+        df['line'] = df['line'].astype(numpy.int32)
+
+    df = group_codes(df)
+
+    return df
+
+# Fields that identify a market at one book and a position (one side of a market, across books) of an event
+MARKET_FIELDS = ['id', 'book_key', 'market']
+POSITION_FIELDS = ['id', 'market', 'position', 'point']
+
+# Group code fields added by group_codes(), which are internal and left out of every returned Dataframe (also expanded ones)
+CODE_FIELDS = ['position_key', 'position_code', 'market_code']
+
+# Fields averaged across books for each position
+AVERAGED_FIELDS = ['line', 'above_below', 'width', 'vig_win_dec', 'fair_win_dec', 'fair_line', 'amount_to_win_line', 'amount_to_win_fair', 'vig_dec', 'vig_pct']
+
+# Adds integer group codes to an unpacked Dataframe so later stages never have to group or join on the string key fields
+# market_code and position_code are dense (0..n-1) within the Dataframe and are used for segment reductions
+# position_key is a hash of the position fields, so it matches between Dataframes that were pulled separately
+def group_codes(df):
+    df['position_key'] = pandas.util.hash_pandas_object(df[POSITION_FIELDS], index=False).to_numpy()
+    df['position_code'] = pandas.factorize(df['position_key'])[0].astype(NUMERIC_DTYPES['position_code'])
+    df['market_code'] = pandas.factorize(pandas.util.hash_pandas_object(df[MARKET_FIELDS], index=False))[0].astype(NUMERIC_DTYPES['market_code'])
+    return df
+
+# Sums values over the groups of codes and returns the group sums broadcast back onto every row
+def group_sum(codes, values, num_groups):
+    return numpy.bincount(codes, weights=values, minlength=num_groups)[codes]
+
+# Methods that turn the implied win probabilities of a market's lines into fair win probabilities that sum to 1
+#   multiplicative: divides every probability by the market's total, so the vig is taken off in proportion to the probability
+#   power: raises every probability to the same power k, which takes more of the vig off longshots
+#   shin: solves for the share z of money from insiders that the book protects itself against (Shin 1993), which also puts more of the vig on longshots
+DEVIG_METHODS = ['multiplicative', 'power', 'shin']
+
+# Solves one decreasing equation per market at once: func(x) returns the value and slope of every market at x, and each root lies within [lo, hi]
+# Every iteration is a Newton step for all markets together, and markets whose step would leave their bracket bisect it instead, so every market converges
+# Markets whose value is within tol of 0 (or missing) stop moving. Returns the roots and the number of iterations
+def newton_bisect(func, x, lo, hi, tol=1e-12, max_iter=100):
+    for iteration in range(1, max_iter + 1):
+        value, slope = func(x)
+        done = ~(numpy.abs(value) >= tol)
+        if done.all():
+            break
+        lo = numpy.where(value > 0, x, lo)
+        hi = numpy.where(value < 0, x, hi)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            step = x - value/slope
+        x = numpy.where(done, x, numpy.where((step > lo) & (step < hi), step, (lo + hi)/2))
+    return x, iteration
+
+# Returns the fair win probability of every line from its implied win probability (vig_win_dec) with one of DEVIG_METHODS
+# Markets with a single line, and with shin markets without any vig, are de-vigged multiplicatively
+def devig_probabilities(vig_win_dec, market_code, num_markets, method='multiplicative'):
+    vig_win_sum = group_sum(market_code, vig_win_dec, num_markets)
+    multiplicative = vig_win_dec/vig_win_sum
+    if method == 'multiplicative' or len(vig_win_dec) == 0:
+        return multiplicative
+
+    num_outcomes = numpy.bincount(market_code, minlength=num_markets)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        if method == 'power':
+            # sum(p^k) = 1, sum(p^k) falls from num_outcomes at k = 0 to at most num_outcomes * max(p)^k, which is 1 at the upper bound
+            log_win = numpy.log(vig_win_dec)
+            max_win = numpy.zeros(num_markets)
+            numpy.maximum.at(max_win, market_code, vig_win_dec)
+            solved = num_outcomes > 1
+
+            def func(k):
+                powered = numpy.exp(k[market_code]*log_win)
+                value = numpy.bincount(market_code, weights=powered, minlength=num_markets) - 1
+                slope = numpy.bincount(market_code, weights=powered*log_win, minlength=num_markets)
+                return numpy.where(solved, value, 0), slope
+
+            upper = numpy.maximum(1, numpy.log(num_outcomes)/-numpy.log(max_win))
+            k, _ = newton_bisect(func, numpy.ones(num_markets), numpy.zeros(num_markets), numpy.where(solved, upper, 1))
+            fair_win_dec = numpy.exp(k[market_code]*log_win)
+
+        elif method == 'shin':
+            # sum(p_i(z)) = 1 with p_i(z) = (sqrt(z^2 + 4(1 - z) pi_i^2 / sum(pi)) - z) / (2(1 - z)), which falls from sqrt(sum(pi)) at z = 0 to sum(pi^2) / sum(pi) < 1 as z -> 1
+            share = vig_win_dec**2/vig_win_sum
+            solved = (num_outcomes > 1) & (numpy.bincount(market_code, weights=vig_win_dec, minlength=num_markets) > 1)
+
+            def probabilities(z):
+                root = numpy.sqrt(z**2 + 4*(1 - z)*share)
+                return (root - z)/(2*(1 - z)), root
+
+            def func(z):
+                row_z = z[market_code]
+                fair, root = probabilities(row_z)
+                slope = (((row_z - 2*share)/root - 1)*(1 - row_z) + root - row_z)/(2*(1 - row_z)**2)
+                value = numpy.bincount(market_code, weights=fair, minlength=num_markets) - 1
+                return numpy.where(solved, value, 0), numpy.bincount(market_code, weights=slope, minlength=num_markets)
+
+            z, _ = newton_bisect(func, numpy.zeros(num_markets), numpy.zeros(num_markets), numpy.ones(num_markets))
+            fair_win_dec = probabilities(z[market_code])[0]
 
-    # Reads data from a JSON file and converts it to a fully unpacked and processed Dataframe
-    def file_to_processed_df(filename):
-        raw_df = file_to_df(filename)
-        unpacked_df = unpacked_data(raw_df)
-        processed_df = processed_data(unpacked_df)
+        else:
+            raise ValueError(f'devig must be one of {DEVIG_METHODS}')
+
+    return numpy.where(solved[market_code], fair_win_dec, multiplicative)
+
+# Expands an unpacked Dataframe by calculating additional columns
+# devig is the method (one of DEVIG_METHODS) used to take the vig off each market's lines for fair_win_dec
+def processed_data(df, devig='multiplicative'):
+    if 'market_code' not in df.columns:
+        df = group_codes(df)
+    market_code = df['market_code'].to_numpy()
+    position_code = df['position_code'].to_numpy()
+    num_markets = market_code.max() + 1 if len(df) > 0 else 0
+    line = df['line'].to_numpy(dtype=numpy.float64)
+
+    # Calculate the number of possible outcomes for the market
+    df['num_outcomes'] = numpy.bincount(market_code, minlength=num_markets)[market_code].astype(NUMERIC_DTYPES['num_outcomes'])
+    # Calculate the market width only for markets with 2 outcomes
+    two_outcomes = df['num_outcomes'].to_numpy() == 2
+    df['above_below'] = numpy.where(~two_outcomes, numpy.nan, numpy.where(line > 0, line - 100, line + 100))
+    df['width'] = numpy.where(~two_outcomes, numpy.nan, (-1)*group_sum(market_code, numpy.nan_to_num(df['above_below'].to_numpy()), num_markets))
+
+    # Calculate the number of books that carry each market
+    df['num_books'] = (numpy.bincount(position_code)[position_code] if len(df) > 0 else numpy.zeros(0, dtype=numpy.int64)).astype(NUMERIC_DTYPES['num_books'])
+
+    # Calculate the implied win dec, fair implied win dec, fair line, amount to win from the real line, amount to win from the fair line, and vig pct
+    # (numpy.where evaluates both branches, so silence the divisions by zero of the branch that is not used)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        vig_win_dec = numpy.where(line > 0, 100/(line + 100), abs(line)/(abs(line) + 100))
+        vig_win_sum = group_sum(market_code, vig_win_dec, num_markets)
+        fair_win_dec = devig_probabilities(vig_win_dec, market_code, num_markets, devig)
+        fair_line = numpy.where(fair_win_dec < 0.5, (100/fair_win_dec) - 100, ((fair_win_dec*100)/(1-fair_win_dec))*(-1))
+        df['vig_win_dec'] = vig_win_dec
+        df['fair_win_dec'] = fair_win_dec
+        df['fair_line'] = fair_line
+        df['amount_to_win_line'] = numpy.where(line > 0, line, (100/abs(line))*100)
+        df['amount_to_win_fair'] = numpy.where(fair_line > 0, fair_line, (100/abs(fair_line))*100)
+    # Vig pct to be used for multi-outcome games where market width cannot be calculated
+    df['vig_dec'] = vig_win_sum - group_sum(market_code, fair_win_dec, num_markets)
+    df['vig_pct'] = df['vig_dec'] * 100
+
+    return df
+
+# Averages fields over each position (position_code), skipping missing values like groupby().mean() does
+# weights is an optional weight of every row, which makes the means weighted (positions whose rows all weigh 0 have no mean)
+# Returns the per-position means, one entry per position_code
+def position_means(df, fields, weights=None):
+    position_code = df['position_code'].to_numpy()
+    num_positions = position_code.max() + 1 if len(df) > 0 else 0
+    means = {}
+    for field in fields:
+        values = df[field].to_numpy(dtype=numpy.float64)
+        filled, present = numpy.nan_to_num(values), ~numpy.isnan(values)
+        if weights is not None:
+            filled, present = filled*weights, present*weights
+        sums = numpy.bincount(position_code, weights=filled, minlength=num_positions)
+        non_missing = numpy.bincount(position_code, weights=present, minlength=num_positions)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            means[field] = numpy.where(non_missing > 0, sums/non_missing, numpy.nan)
+    return means
+
+# Returns the consensus weight of every row from a {book_key: weight} dict, books that aren't in it weigh its 'default' weight (0 without one)
+def book_weights(book_keys, consensus_weights):
+    codes, books = pandas.factorize(book_keys)
+    default = consensus_weights.get('default', 0)
+    return numpy.array([consensus_weights.get(book, default) for book in books], dtype=numpy.float64)[codes]
+
+# Adds the expected value and kelly criterion of betting each book line against a reference fair win probability
+def add_ev_fields(columns, suffix, fair_win_dec, amount_to_win_line):
+    columns['ev_pct_' + suffix] = (fair_win_dec * amount_to_win_line) - ((1 - fair_win_dec) * 100)
+    columns['kelly_dec_' + suffix] = fair_win_dec - ((1 - fair_win_dec) / (amount_to_win_line / 100))
+    columns['kelly_pct_' + suffix] = columns['kelly_dec_' + suffix] * 100
+
+# Calculates the expected value of every book line with regard to the average odds and/or the pinnacle odds of its position in one pass
+# The averages and the pinnacle line of each position are looked up by group code and broadcast onto the book rows, so no Dataframes are merged
+# pinnacle_odds only needs to be passed when the pinnacle odds were pulled separately from book_odds, otherwise they are taken from book_odds
+# Like the merges this replaces, ev_type 'avg' (and 'both') drops lines whose number of outcomes differs from the average for their position,
+# and ev_type 'pinnacle' drops lines that pinnacle doesn't offer (with 'both', their pinnacle fields are left empty)
+# rows is an optional boolean mask of the lines to calculate the ev of, the averages and pinnacle lines are still taken from every line
+# consensus_weights ({book_key: weight}) turns the flat average of every book into a weighted consensus, which is stored in the '_avg' fields
+# Books that aren't listed weigh the 'default' weight, so without one the consensus is only made of the listed books
+def ev_data(book_odds, ev_type='both', pinnacle_odds=None, rows=None, consensus_weights=None):
+    position_code = book_odds['position_code'].to_numpy()
+    num_outcomes = book_odds['num_outcomes'].to_numpy()
+    keep = numpy.ones(len(book_odds), dtype=bool) if rows is None else numpy.array(rows, dtype=bool)
+
+    if ev_type == 'both' or ev_type == 'avg':
+        weights = book_weights(book_odds['book_key'], consensus_weights) if consensus_weights is not None else None
+        means = position_means(book_odds, ['num_outcomes'] + AVERAGED_FIELDS, weights)
+        keep &= num_outcomes == means['num_outcomes'][position_code]
+
+    if ev_type == 'both' or ev_type == 'pinnacle':
+        # Find the pinnacle row of each book row's position (-1 when pinnacle has no line for it)
+        if pinnacle_odds is None:
+            pinnacle_rows = numpy.flatnonzero(book_odds['book_key'] == 'pinnacle')
+            pinnacle_odds = book_odds
+            num_positions = position_code.max() + 1 if len(book_odds) > 0 else 0
+            position_row = numpy.full(num_positions, -1)
+            position_row[position_code[pinnacle_rows]] = pinnacle_rows
+            pinnacle_row = position_row[position_code]
+        else:
+            if pinnacle_odds['position_key'].duplicated().any():
+                raise ValueError('pinnacle odds must have one line per position')
+            pinnacle_row = pandas.Index(pinnacle_odds['position_key']).get_indexer(book_odds['position_key'])
+        matched = pinnacle_row >= 0
+        matched[matched] = pinnacle_odds['num_outcomes'].to_numpy()[pinnacle_row[matched]] == num_outcomes[matched]
+        pinnacle_row[~matched] = -1
+        if ev_type == 'pinnacle':
+            keep &= matched
+
+    # Drop rows before anything is broadcast, so every output column is allocated once at its final length
+    if not keep.all():
+        book_odds = book_odds.loc[keep]
+        position_code = position_code[keep]
+        if ev_type == 'both' or ev_type == 'pinnacle':
+            pinnacle_row = pinnacle_row[keep]
+            matched = matched[keep]
+    amount_to_win_line = book_odds['amount_to_win_line'].to_numpy(dtype=numpy.float64)
+
+    columns = {}
+    if ev_type == 'both' or ev_type == 'avg':
+        for field in AVERAGED_FIELDS:
+            columns[field + '_avg'] = means[field][position_code]
+        add_ev_fields(columns, 'avg', columns['fair_win_dec_avg'], amount_to_win_line)
+
+    if ev_type == 'both' or ev_type == 'pinnacle':
+        for field in ['last_update', 'market_last_update']:
+            if field in pinnacle_odds.columns:
+                columns[field + '_pinnacle'] = pinnacle_odds[field].array.take(pinnacle_row, allow_fill=True)
+        for field in AVERAGED_FIELDS:
+            columns[field + '_pinnacle'] = numpy.where(matched, pinnacle_odds[field].to_numpy(dtype=numpy.float64)[pinnacle_row], numpy.nan)
+        add_ev_fields(columns, 'pinnacle', columns['fair_win_dec_pinnacle'], amount_to_win_line)
+
+    # Book fields, with the per-book calculated fields suffixed with '_book', followed by the reference and ev fields
+    ev = pandas.concat([book_odds.rename(columns={field: field + '_book' for field in AVERAGED_FIELDS}), pandas.DataFrame(columns, index=book_odds.index, copy=False)], axis=1)
+    ev.reset_index(drop=True, inplace=True)
+
+    return ev
+
+# Keeps the processed odds and ev of the last snapshot so a stream of snapshots (e.g. polling the API every 30 seconds) can be processed incrementally
+# Each update() only flattens and processes the markets whose last_update changed (or that are new), and only recomputes the ev of the positions those markets belong to
+# market_code and position_code stay the same for a market/position across updates
+# After each update(), new_odds holds the processed rows of the changed markets and removed_keys the (id, book_key, market) of the markets that are gone
+class EVSession:
+    def __init__(self, ev_type='both', devig='multiplicative', consensus_weights=None):
+        if ev_type not in ['avg', 'pinnacle', 'both']:
+            raise SystemExit("Error: ev_type must be one of: 'avg', 'pinnacle', 'both' or be left blank")
+        self.ev_type = ev_type
+        self.devig = devig
+        self.consensus_weights = consensus_weights
+        self.book_updates = {}
+        self.market_codes = {}
+        self.position_codes = {}
+        self.position_keys = {}
+        self.next_code = itertools.count()
+        self.book_odds = None
+        self.ev = None
+        self.changed_markets = 0
+        self.removed_markets = 0
+        self.new_odds = None
+        self.removed_keys = []
+
+    # Returns session wide codes for a list of keys, numbering keys that haven't been seen before (codes are never reused)
+    def codes(self, code_map, keys):
+        codes = numpy.empty(len(keys), dtype=numpy.int64)
+        for i, key in enumerate(keys):
+            if key not in code_map:
+                code_map[key] = next(self.next_code)
+            codes[i] = code_map[key]
+        return codes
+
+    # Takes a new snapshot (list of events) and returns the updated ev table
+    def update(self, odds_json):
+        # Diff the snapshot against the last one by (event, book, market, last_update), keeping only changed markets in the JSON that is flattened
+        # A bookmaker's last_update moves whenever one of its markets does and is stored on all of its rows, so all markets of a bookmaker with a new last_update are refreshed
+        # and bookmakers with an unchanged last_update are skipped whole (markets are diffed one by one only when the bookmaker has no last_update)
+        book_updates = {}
+        changed_json = []
+        removed_keys = []
+        for event in odds_json:
+            changed_books = []
+            for bookmaker in event.get('bookmakers', []):
+                book = (event['id'], bookmaker['key'])
+                last_update = bookmaker.get('last_update')
+                previous = self.book_updates.get(book)
+                if last_update is not None and previous is not None and previous[0] == last_update:
+                    book_updates[book] = previous
+                    continue
+
+                previous_markets = previous[1] if previous is not None else {}
+                markets = {}
+                changed_markets = []
+                for market in bookmaker.get('markets', []):
+                    if market['key'] in LAY_MARKETS:
+                        continue
+                    market_update = market.get('last_update')
+                    markets[market['key']] = market_update
+                    # Markets without a timestamp can't be diffed and are always refreshed
+                    if last_update is not None or market_update is None or market['key'] not in previous_markets or previous_markets[market['key']] != market_update:
+                        changed_markets.append(market)
+                removed_keys.extend(book + (market,) for market in previous_markets if market not in markets)
+                book_updates[book] = (last_update, markets)
+                if changed_markets:
+                    changed_books.append({**bookmaker, 'markets': changed_markets})
+            if changed_books:
+                changed_json.append({**event, 'bookmakers': changed_books})
+
+        # Bookmakers (or whole events) that are no longer in the snapshot
+        for book, (_, markets) in self.book_updates.items():
+            if book not in book_updates:
+                removed_keys.extend(book + (market,) for market in markets)
+        self.book_updates = book_updates
+        stale_codes = [self.market_codes.pop(key) for key in removed_keys if key in self.market_codes]
+
+        # Flatten and process only the changed markets (num_books is recounted below, across all books)
+        new_odds = processed_data(flattened_data(changed_json), self.devig)
+        market_keys = list(zip(new_odds['id'], new_odds['book_key'], new_odds['market']))
+        stale_codes.extend(self.market_codes[key] for key in set(market_keys) if key in self.market_codes)
+        new_odds['market_code'] = self.codes(self.market_codes, market_keys)
+        position_keys = new_odds['position_key'].tolist()
+        new_odds['position_code'] = self.codes(self.position_codes, position_keys)
+        self.position_keys.update(zip(new_odds['position_code'].tolist(), position_keys))
+        self.changed_markets = len(set(market_keys))
+        self.removed_markets = len(removed_keys)
+        self.new_odds = new_odds
+        self.removed_keys = removed_keys
+
+        # Replace the stale rows and find every position that has to be recomputed
+        if self.book_odds is None:
+            book_odds = new_odds
+            affected_positions = numpy.unique(new_odds['position_code'])
+        else:
+            stale = numpy.isin(self.book_odds['market_code'], stale_codes)
+            affected_positions = numpy.union1d(self.book_odds.loc[stale, 'position_code'], new_odds['position_code'])
+            book_odds = concat_odds([self.book_odds.loc[~stale], new_odds])
+
+        # Recount the books and recompute the ev of the affected positions only, with codes numbered densely within them
+        affected = numpy.isin(book_odds['position_code'], affected_positions)
+        affected_odds = book_odds.loc[affected].copy()
+        local_codes, position_codes = pandas.factorize(affected_odds['position_code'])
+        affected_odds['position_code'] = local_codes
+        affected_odds['num_books'] = (numpy.bincount(local_codes)[local_codes] if len(affected_odds) > 0 else local_codes).astype(NUMERIC_DTYPES['num_books'])
+        book_odds.loc[affected, 'num_books'] = affected_odds['num_books'].to_numpy()
+        new_ev = ev_data(affected_odds, ev_type=self.ev_type, consensus_weights=self.consensus_weights)
+        new_ev['position_code'] = numpy.asarray(position_codes)[new_ev['position_code'].to_numpy()]
+
+        # Forget positions that no longer have any lines
+        for code in numpy.setdiff1d(affected_positions, numpy.asarray(position_codes)).tolist():
+            del self.position_codes[self.position_keys.pop(code)]
+
+        self.book_odds = book_odds
+        if self.ev is None:
+            self.ev = new_ev
+        else:
+            self.ev = concat_odds([self.ev.loc[~numpy.isin(self.ev['position_code'], affected_positions)], new_ev])
+
+        return self.ev
+
+# Fields of every position in BestLineIndex.best_lines(), besides the best line
+BEST_LINE_FIELDS = ['id', 'sport_key', 'commence_time', 'home_team', 'away_team', 'market', 'position', 'point', 'num_outcomes']
+
+# Best available price of every position (POSITION_FIELDS) across books, kept up to date one line at a time
+# Every position keeps a heap of its books' prices with lazy deletion, so changing or removing one book's line is O(log n) in the number of books
+# Built from processed_data() output, and updated with the processed rows of the markets that changed, e.g.:
+#   index.update(session.new_odds, session.removed_keys) after every EVSession.update()
+class BestLineIndex:
+    def __init__(self, book_odds=None):
+        self.prices = {}
+        self.heaps = {}
+        self.positions = {}
+        self.markets = {}
+        if book_odds is not None:
+            self.update(book_odds)
+
+    # Sets one book's line for a position
+    def set_line(self, position, book, amount_to_win, line):
+        prices = self.prices.setdefault(position, {})
+        prices[book] = (amount_to_win, line)
+        heap = self.heaps.setdefault(position, [])
+        heapq.heappush(heap, (-amount_to_win, book))
+        # Stale entries are only dropped when they reach the top, so rebuild heaps that mostly hold stale entries
+        if len(heap) > 2 * len(prices) + 8:
+            heap = [(-amount, book) for book, (amount, _) in prices.items()]
+            heapq.heapify(heap)
+            self.heaps[position] = heap
+
+    # Removes one book's line for a position, and the position once no book has a line for it
+    def remove_line(self, position, book):
+        prices = self.prices.get(position)
+        if prices is None:
+            return
+        prices.pop(book, None)
+        if not prices:
+            del self.prices[position], self.heaps[position], self.positions[position]
+
+    # Returns the (book_key, amount_to_win_line, line) of the best price of a position, or None when no book has a line for it
+    def best(self, position):
+        heap = self.heaps.get(position)
+        if heap is None:
+            return None
+        prices = self.prices[position]
+        while prices.get(heap[0][1], (None,))[0] != -heap[0][0]:
+            heapq.heappop(heap)
+        book = heap[0][1]
+        return book, prices[book][0], prices[book][1]
+
+    # Replaces the lines of every market (id, book_key, market) in book_odds with its rows, and removes the markets in removed
+    def update(self, book_odds, removed=()):
+        columns = {field: book_odds[field].tolist() for field in BEST_LINE_FIELDS + ['book_key', 'line', 'amount_to_win_line']}
+        rows = list(zip(*columns.values()))
+        fields = list(columns.keys())
+        id_field, market_field, position_field, point_field, book_field = [fields.index(field) for field in ['id', 'market', 'position', 'point', 'book_key']]
+
+        market_keys = [(row[id_field], row[book_field], row[market_field]) for row in rows]
+        for market_key in set(market_keys).union(removed):
+            for position in self.markets.pop(market_key, ()):
+                self.remove_line(position, market_key[1])
+
+        for market_key, row in zip(market_keys, rows):
+            # NaN points (h2h) would never compare equal in a dict key
+            point = row[point_field] if row[point_field] == row[point_field] else None
+            position = (row[id_field], row[market_field], row[position_field], point)
+            self.positions[position] = row[:len(BEST_LINE_FIELDS)]
+            self.set_line(position, row[book_field], row[-1], row[-2])
+            self.markets.setdefault(market_key, []).append(position)
+
+    # Returns the best line of every position as a Dataframe, with the book that offers it and its decimal odds and implied win probability
+    def best_lines(self):
+        records = []
+        for position, fields in self.positions.items():
+            book, amount_to_win, line = self.best(position)
+            records.append(fields + (book, line, amount_to_win, len(self.prices[position])))
+        lines = pandas.DataFrame.from_records(records, columns=BEST_LINE_FIELDS + ['book_key', 'line', 'amount_to_win_line', 'num_books'])
+        lines['decimal'] = 1 + lines['amount_to_win_line'].astype(numpy.float64) / 100
+        lines['implied_win_dec'] = 1 / lines['decimal']
+        return lines
+
+    # Returns the best line of both sides of every spread and total, with the side whose bet wins above its threshold ('lower': home spread, over)
+    # and the one that wins below it ('upper': away spread, under). The home team covers when its margin is above -point, the away team when it is below point
+    def sided_lines(self, lines):
+        lines = lines.loc[lines['market'].isin(['spreads', 'totals']) & lines['point'].notna()].copy()
+        lower = numpy.where(lines['market'] == 'totals', lines['position'] == 'Over', lines['position'] == lines['home_team'])
+        lines['side'] = numpy.where(lower, 'lower', 'upper')
+        lines['threshold'] = numpy.where(lower & (lines['market'] == 'spreads'), 0 - lines['point'], lines['point']) + 0.0
+        return lines
+
+    # Returns the pairs of a lower and an upper line of the same event and market where one of them always wins (the lower threshold isn't above the upper one)
+    def sided_pairs(self, lines):
+        sided = self.sided_lines(lines)
+        pairs = sided.loc[sided['side'] == 'lower'].merge(sided.loc[sided['side'] == 'upper'], on=['id', 'market'], suffixes=('_lower', '_upper'))
+        return pairs.loc[pairs['threshold_lower'] <= pairs['threshold_upper']].copy()
+
+    # Returns pairs of lines as one row per leg (lower leg first), with an opportunity number per pair and the pair wide fields
+    def pair_legs(self, pairs, fields):
+        legs = []
+        for side in ['lower', 'upper']:
+            columns = {'id': 'id', 'market': 'market', **{f'{field}_lower': field for field in ['sport_key', 'commence_time', 'home_team', 'away_team']}}
+            columns.update({f'{field}_{side}': field for field in ['position', 'point', 'book_key', 'line', 'decimal', 'implied_win_dec']})
+            columns.update({field: field for field in fields})
+            leg = pairs[list(columns)].rename(columns=columns)
+            leg.insert(0, 'opportunity', numpy.arange(len(pairs)))
+            legs.append(leg)
+        return pandas.concat(legs).sort_values('opportunity', kind='stable').reset_index(drop=True)
+
+    # Returns the sets of best lines that cover every outcome of a market for less than they pay out, one row per leg
+    # Markets without points (h2h) need the best line of every outcome, spreads and totals need the best lines of both sides of the same point
+    # (or of a lower side below an upper side, which also wins both bets when the result lands in between, and a push only returns a stake)
+    # stake_pct is the share of the total stake of each leg that makes every outcome pay the same, profit_pct the guaranteed return
+    def arbitrage(self, min_profit_pct=0):
+        lines = self.best_lines()
+        fields = ['id', 'market', 'sport_key', 'commence_time', 'home_team', 'away_team', 'position', 'point', 'book_key', 'line', 'decimal', 'implied_win_dec']
+
+        # Markets without points are complete when every outcome of the market has a line
+        outright = lines.loc[lines['point'].isna()]
+        groups = outright.groupby(['id', 'market'], observed=True, sort=False)
+        complete = groups['position'].transform('size') == groups['num_outcomes'].transform('max')
+        outright = outright.loc[complete, fields].copy()
+        outright['implied_sum'] = outright.groupby(['id', 'market'], observed=True, sort=False)['implied_win_dec'].transform('sum')
+        outright['opportunity'] = outright.groupby(['id', 'market'], observed=True, sort=False).ngroup()
+
+        pairs = self.sided_pairs(lines)
+        pairs['implied_sum'] = pairs['implied_win_dec_lower'] + pairs['implied_win_dec_upper']
+        sided = self.pair_legs(pairs, ['implied_sum'])
+        sided['opportunity'] += outright['opportunity'].max() + 1 if len(outright) > 0 else 0
+
+        legs = pandas.concat([outright[['opportunity'] + fields + ['implied_sum']], sided], ignore_index=True)
+        legs['profit_pct'] = (1 / legs['implied_sum'] - 1) * 100
+        legs = legs.loc[(legs['implied_sum'] < 1) & (legs['profit_pct'] >= min_profit_pct)].copy()
+        legs['stake_pct'] = legs['implied_win_dec'] / legs['implied_sum'] * 100
+        legs['opportunity'] = pandas.factorize(legs['opportunity'])[0]
+        legs.sort_values(['profit_pct', 'opportunity'], ascending=[False, True], kind='stable', inplace=True)
+        legs['opportunity'] = pandas.factorize(legs['opportunity'])[0]
+        return legs.reset_index(drop=True)
+
+    # Returns spread and total middles: a lower side below an upper side with a whole number between them, so a final score can win both bets
+    # middle_from and middle_to are the home margin (spreads) or total (totals) both bets win between, exclusive
+    # One row per leg, with stakes that make either bet alone pay the same: profit_pct is the return when only one bet wins, middle_profit_pct when both do
+    def middles(self, min_profit_pct=None):
+        pairs = self.sided_pairs(self.best_lines())
+        pairs = pairs.loc[numpy.floor(pairs['threshold_lower']) + 1 < pairs['threshold_upper']]
+        pairs['implied_sum'] = pairs['implied_win_dec_lower'] + pairs['implied_win_dec_upper']
+        pairs['middle_from'] = pairs['threshold_lower']
+        pairs['middle_to'] = pairs['threshold_upper']
+        legs = self.pair_legs(pairs, ['implied_sum', 'middle_from', 'middle_to'])
+        legs['profit_pct'] = (1 / legs['implied_sum'] - 1) * 100
+        legs['middle_profit_pct'] = (2 / legs['implied_sum'] - 1) * 100
+        legs['stake_pct'] = legs['implied_win_dec'] / legs['implied_sum'] * 100
+        if min_profit_pct is not None:
+            legs = legs.loc[legs['profit_pct'] >= min_profit_pct]
+        legs = legs.sort_values(['profit_pct', 'opportunity'], ascending=[False, True], kind='stable')
+        legs['opportunity'] = pandas.factorize(legs['opportunity'])[0]
+        return legs.reset_index(drop=True)
+
+# Filters a Dataframe of ev odds based on several optional parameters
+def filter_ev(odds, pref_ev_filter, sports=None, markets=None, days_from_now=None, books=None, min_odds=None, max_odds=None, max_width=None, max_vig_pct=None, min_ev_pct=None, min_num_books=None):
+    if sports is not None:
+        odds = odds.loc[odds['sport_key'].isin(sports)]
+    if markets is not None:
+        odds = odds.loc[odds['market'].isin(markets)]
+    if days_from_now is not None:
+        date = pytz.UTC.localize(datetime.datetime.now())+datetime.timedelta(days=days_from_now)
+        commence_time = odds['commence_time']
+        if not pandas.api.types.is_datetime64_any_dtype(commence_time):
+            commence_time = pandas.to_datetime(commence_time, utc=True, format='ISO8601')
+        odds = odds.loc[commence_time <= date]
+    if books is not None:
+        odds = odds.loc[odds['book_key'].isin(books)]
+    if min_odds is not None:
+        odds = odds.loc[odds['line_book'] >= min_odds]
+    if max_odds is not None:
+        odds = odds.loc[odds['line_book'] <= max_odds]
+    if max_width is not None:
+        odds = odds.loc[odds['num_outcomes'] == 2]
+        if pref_ev_filter == 'both' or pref_ev_filter == 'avg':
+            odds = odds.loc[odds['width_avg'] <= max_width]
+        if pref_ev_filter == 'both' or pref_ev_filter == 'pinnacle':
+            odds = odds.loc[odds['width_pinnacle'] <= max_width]
+    if max_vig_pct is not None:
+        if pref_ev_filter == 'both' or pref_ev_filter == 'avg':
+            odds = odds.loc[odds['vig_pct_avg'] <= max_vig_pct]
+        if pref_ev_filter == 'both' or pref_ev_filter == 'pinnacle':
+            odds = odds.loc[odds['vig_pct_pinnacle'] <= max_vig_pct]
+    if min_ev_pct is not None:
+        if pref_ev_filter == 'both' or pref_ev_filter == 'avg':
+            odds = odds.loc[odds['ev_pct_avg'] >= min_ev_pct]
+        if pref_ev_filter == 'both' or pref_ev_filter == 'pinnacle':
+            odds = odds.loc[odds['ev_pct_pinnacle'] >= min_ev_pct]
+    if min_num_books is not None:
+        odds = odds.loc[odds['num_books'] >= min_num_books]
+
+    odds.reset_index(drop=True, inplace=True)
+
+    return odds
+
+# Sorts a Dataframe of ev odds by a field
+def sort_ev(odds, sortby, ascending, pref_ev_sort='avg'):
+    if sortby == 'commence_time':
+        odds.sort_values(['commence_time'], ascending=ascending, inplace=True)
+    elif sortby == 'line':
+        odds.sort_values(['line_book'], ascending=ascending, inplace=True)
+    elif sortby == 'width':
+        if pref_ev_sort == 'avg':
+            odds.sort_values(['width_avg'], ascending=ascending, inplace=True)
+        if pref_ev_sort == 'pinnacle':
+            odds.sort_values(['width_pinnacle'], ascending=ascending, inplace=True)
+    elif sortby == 'ev_pct':
+        if pref_ev_sort == 'avg':
+            odds.sort_values(['ev_pct_avg'], ascending=ascending, inplace=True)
+        if pref_ev_sort == 'pinnacle':
+            odds.sort_values(['ev_pct_pinnacle'], ascending=ascending, inplace=True)
+    if sortby == 'kelly_pct':
+        if pref_ev_sort == 'avg':
+            odds.sort_values(['kelly_pct_avg'], ascending=ascending, inplace=True)
+        if pref_ev_sort == 'pinnacle':
+            odds.sort_values(['kelly_pct_pinnacle'], ascending=ascending, inplace=True)
+
+    if sortby == 'default':
+        odds.sort_values(['commence_time', 'id', 'book_key', 'market'], inplace=True)
+
+    odds.reset_index(drop=True, inplace=True)
+    
+    return odds
+
+# Returns the field a sortby option of sort_ev() sorts by (ev fields use the pref_ev_sort suffix, 'default' sorts by commence_time)
+def sort_field(sortby, pref_ev_sort='avg'):
+    if sortby in ['width', 'ev_pct', 'kelly_pct']:
+        return f'{sortby}_{pref_ev_sort}'
+    if sortby == 'line':
+        return 'line_book'
+    return 'commence_time'
+
+# Returns the positions of the k highest scores, highest first, selecting them with argpartition instead of sorting every score
+def top_positions(score, k):
+    if len(score) > k:
+        positions = numpy.argpartition(-score, k - 1)[:k]
+    else:
+        positions = numpy.arange(len(score))
+    return positions[numpy.argsort(-score[positions], kind='stable')]
+
+# Returns the k best rows of a Dataframe of ev odds by a sortby option of sort_ev(), without sorting the whole Dataframe
+# With per 'sport' or 'event', the k best rows of every sport or event are kept (ordered by the sort field across all of them)
+# Missing values always rank last, and sortby 'default' ranks the events that start soonest first
+def top_ev(odds, k, sortby='ev_pct', ascending=False, pref_ev_sort='avg', per=None):
+    field = sort_field(sortby, pref_ev_sort)
+    if sortby == 'default':
+        ascending = True
+    values = odds[field]
+    missing = values.isna().to_numpy()
+    if pandas.api.types.is_datetime64_any_dtype(values):
+        values = values.astype('int64')
+    score = values.to_numpy(dtype=numpy.float64, copy=True)
+    if ascending:
+        score = -score
+    score[missing] = -numpy.inf
+
+    if per is None:
+        selected = top_positions(score, k)
+    else:
+        # Rows grouped by sport or event with one stable integer sort, then each group is selected on its own
+        codes = pandas.factorize(odds[{'sport': 'sport_key', 'event': 'id'}[per]])[0]
+        order = numpy.argsort(codes, kind='stable')
+        boundaries = numpy.flatnonzero(numpy.diff(codes[order])) + 1
+        selected = numpy.concatenate([group[top_positions(score[group], k)] for group in numpy.split(order, boundaries)]) if len(order) > 0 else order
+        selected = selected[numpy.argsort(-score[selected], kind='stable')]
+
+    return odds.iloc[selected].reset_index(drop=True)
+
+# Simplify the dataframe into a more easily consumable format
+def cleanup_ev(odds, ev_type):
+    fields_keep = ['sport_title', 'commence_time', 'home_team', 'away_team', 'book_title', 'market', 'position', 'line_book', 'point', 'num_books']
+
+    if ev_type == 'both' or ev_type == 'avg':
+        add_fields = ['fair_line_avg', 'width_avg', 'vig_pct_avg', 'ev_pct_avg', 'kelly_pct_avg']
+        fields_keep.extend(add_fields)
+    if ev_type == 'both' or ev_type == 'pinnacle':
+        add_fields = ['fair_line_pinnacle', 'width_pinnacle', 'vig_pct_pinnacle', 'ev_pct_pinnacle', 'kelly_pct_pinnacle']
+        fields_keep.extend(add_fields)
+
+    odds = odds[fields_keep]
+    odds = odds.round({field: 2 for field in fields_keep if pandas.api.types.is_float_dtype(odds[field])})
+    return odds
+
+# Yields the events that can pass a query's event level predicates, keeping only the markets it asks for
+# Everything calculated before the ev stage stays within one market of one event, so dropping events and markets early doesn't change any other line's values
+def pruned_events(events, sports=None, markets=None, commence_to=None):
+    for event in events:
+        if sports is not None and event.get('sport_key') not in sports:
+            continue
+        if commence_to is not None and dateutil.parser.isoparse(event['commence_time']) > commence_to:
+            continue
+        if markets is not None:
+            event = {**event, 'bookmakers': [{**bookmaker, 'markets': [market for market in bookmaker.get('markets', []) if market['key'] in markets]} for bookmaker in event.get('bookmakers', [])]}
+        yield event
+
+# Lazy version of data(): collects the source, filter and sort parameters and only does the work the result needs when collect() is called
+# Predicates are pushed as early as they can go without changing any result:
+#   sports, markets and days_from_now drop events and markets before they are flattened (for the API, sports and markets are request parameters)
+#   books, min_odds, max_odds and min_num_books only skip the ev calculation of other lines, the averages and pinnacle lines still come from every book
+#   max_width, max_vig_pct and min_ev_pct need the ev fields and are applied after them
+# explain() shows the plan, and the row counts of every step once the query has been collected
+# With processes, the process, prefilter, ev and filter steps run on shards of events (split by shard_by 'event' or 'sport') in a process pool, see collect_sharded()
+class Query:
+    def __init__(self, api_key=None, filename=None, store=None, sports=None, regions=['us', 'eu', 'uk', 'au'], markets=['h2h', 'spreads', 'totals'], ev_type='both', expanded=False, max_workers=8, cache=None, chunk_size=1000, session=None, telemetry=None, processes=None, shard_by='event', devig='multiplicative', consensus_weights=None, narrow_pull=False):
+        if api_key is None and filename is None and store is None:
+            raise SystemExit("Error: API key, filename or store must be specified\n")
+        self.api_key = api_key
+        self.filename = filename
+        self.store = store
+        self.sports = sports
+        self.regions = regions
+        self.markets = markets
+        self.ev_type = ev_type
+        self.expanded = expanded
+        self.max_workers = max_workers
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.session = session
+        self.telemetry = as_telemetry(telemetry)
+        self.processes = processes
+        self.shard_by = shard_by
+        self.devig = devig
+        self.consensus_weights = consensus_weights
+        self.narrow_pull = narrow_pull
+        self.filters = {'pref_ev_filter': ev_type}
+        self.sorting = {'sortby': 'default', 'ascending': False, 'pref_ev_sort': 'pinnacle' if ev_type == 'pinnacle' else 'avg'}
+        self.top_k = None
+        self.top_per = None
+        self.rows = None
+        self.request_plan = None
+
+    # Adds filter_ev() parameters to the query (parameters left as None keep their current value)
+    def filter(self, pref_ev_filter=None, days_from_now=None, books=None, min_odds=None, max_odds=None, max_width=None, max_vig_pct=None, min_ev_pct=None, min_num_books=None):
+        values = {'pref_ev_filter': pref_ev_filter, 'days_from_now': days_from_now, 'books': books, 'min_odds': min_odds, 'max_odds': max_odds, 'max_width': max_width, 'max_vig_pct': max_vig_pct, 'min_ev_pct': min_ev_pct, 'min_num_books': min_num_books}
+        self.filters.update({field: value for field, value in values.items() if value is not None})
+        return self
+
+    # Sets the sort_ev() parameters of the query, with top_k only the top_k best rows (of every sport or event with top_per) are kept, see top_ev()
+    def sort(self, sortby='default', ascending=False, pref_ev_sort=None, top_k=None, top_per=None):
+        self.sorting = {'sortby': sortby, 'ascending': ascending, 'pref_ev_sort': pref_ev_sort or self.sorting['pref_ev_sort']}
+        self.top_k = top_k
+        self.top_per = top_per
+        return self
+
+    # Returns the steps of the query as (step, description) pairs
+    def plan(self):
+        pushed = []
+        if self.sports is not None:
+            pushed.append(f'sport_key in {self.sports}')
+        if self.filename is not None or self.store is not None:
+            pushed.append(f'market in {self.markets}')
+        if self.filters.get('days_from_now') is not None:
+            pushed.append(f'commence_time <= now + {self.filters["days_from_now"]} days')
+        if self.filename is not None:
+            source = f'file {self.filename!r} in chunks of {self.chunk_size} events'
+        elif self.store is not None:
+            source = f'snapshot store {self.store!r} (latest capture of every market)'
+        else:
+            source = f'API {self.sports or "all sports in season"}, regions {self.regions}, markets {self.markets}'
+            if self.ev_type != 'avg' and 'eu' not in self.regions:
+                source += ', plus pinnacle'
+            if self.filters.get('days_from_now') is not None:
+                source += ', skipping sports without events in the window'
+
+        prefilters = []
+        if self.filters.get('books') is not None:
+            prefilters.append(f'book_key in {self.filters["books"]}')
+        if self.filters.get('min_odds') is not None:
+            prefilters.append(f'line >= {self.filters["min_odds"]}')
+        if self.filters.get('max_odds') is not None:
+            prefilters.append(f'line <= {self.filters["max_odds"]}')
+        if self.filters.get('min_num_books') is not None:
+            prefilters.append(f'num_books >= {self.filters["min_num_books"]}')
+
+        references = {'both': ['avg', 'pinnacle'], 'avg': ['avg'], 'pinnacle': ['pinnacle']}
+        residual = []
+        for field, operator in [('max_width', '<='), ('max_vig_pct', '<='), ('min_ev_pct', '>=')]:
+            if self.filters.get(field) is not None:
+                residual.extend(f'{field[4:]}_{reference} {operator} {self.filters[field]}' for reference in references[self.filters['pref_ev_filter']])
+
+        steps = [
+            ('scan', source + (', pushed down: ' + ', '.join(pushed) if pushed else '')),
+            ('process', f'flatten, then num_outcomes, width, vig and fair odds ({self.devig} de-vig) per market and num_books per position' + (f', in {self.processes} processes sharded by {self.shard_by}' if self.sharded() else '')),
+            ('prefilter', ', '.join(prefilters) if prefilters else 'none'),
+            ('ev', f'{"averages" if self.consensus_weights is None else "weighted consensus of " + ", ".join(self.consensus_weights)} and pinnacle lines from every book, ev and kelly against {" and ".join(references[self.ev_type])} for the prefiltered lines'),
+            ('filter', ', '.join(residual) if residual else 'none'),
+            ('sort', f'{self.sorting["sortby"]} ({"ascending" if self.sorting["ascending"] else "descending"}, {self.sorting["pref_ev_sort"]})' + (f', top {self.top_k}' + (f' per {self.top_per}' if self.top_per is not None else '') + ' by partial selection' if self.top_k is not None else '')),
+        ]
+        if not self.expanded:
+            steps.append(('cleanup', 'round and keep the display fields'))
+        return steps
+
+    # Returns the plan as text, with the row counts of every step of the last collect()
+    def explain(self):
+        lines = [f'Query plan (ev_type {self.ev_type!r})']
+        for number, (step, description) in enumerate(self.plan(), 1):
+            rows = self.rows.get(step, '-') if self.rows is not None else 'not run'
+            lines.append(f'{number}. {step:<10}{description}')
+            lines.append(f'   {"":<10}rows: {rows}')
+        return '\n'.join(lines)
+
+    # Flattens and processes a list of events
+    def process(self, events):
+        with stage(self.telemetry, 'flatten') as flatten_stage:
+            unpacked_df = flattened_data(events)
+            flatten_stage.rows = len(unpacked_df)
+        with stage(self.telemetry, 'process') as process_stage:
+            processed_df = processed_data(unpacked_df, self.devig)
+            process_stage.rows = len(processed_df)
         return processed_df
 
-    # Groups and aggregates a processed Dataframe to find the average odds of each position of each market of each game
-    def av_odds(df):
-        key_fields = ['id', 'sport_key', 'sport_title', 'commence_time', 'home_team', 'away_team', 'market', 'position', 'point']
-
-        # Aggregate by mean
-        df = df.groupby(key_fields, dropna=False).mean()
-        df.sort_values(['commence_time', 'id', 'market'], inplace=True)
-        return df
-
-    # Extracts the pinnacle odds from processed odds (function will return an empty df if eu odds are not part of input df)
-    def extract_pinnacle(odds):
-        pinnacle_odds = odds.loc[odds['book_key'] == 'pinnacle']
-        pinnacle_odds.reset_index(drop=True, inplace=True)
-        return pinnacle_odds
-
-    # Calculates the expected value with regard to the average odds, takes just book_odds as parameter as average odds are calculated directly from book odds
-    def avg_ev(book_odds):
-        # Calculate average odds
-        average_odds = av_odds(book_odds)
-
-        # Key fields for merging
-        key_fields = ['id', 'sport_key', 'sport_title', 'commence_time', 'home_team', 'away_team', 'market', 'position', 'point', 'num_outcomes', 'num_books']
-
-        # Merge book odds with the average odds
-        avg_merge = book_odds.merge(average_odds, how='inner', on=key_fields, suffixes=['_book', '_avg'], validate='m:1')
-
-        # Calculate ev data
-        avg_merge['ev_pct_avg'] = (avg_merge['fair_win_dec_avg'] * avg_merge['amount_to_win_line_book']) - ((1 - avg_merge['fair_win_dec_avg']) * 100)
-        avg_merge['kelly_dec_avg'] = avg_merge['fair_win_dec_avg'] - ((1 - avg_merge['fair_win_dec_avg']) / (avg_merge['amount_to_win_line_book'] / 100))
-        avg_merge['kelly_pct_avg'] = avg_merge['kelly_dec_avg'] * 100
-
-        return avg_merge
-
-    # Calculates the expected value with regard to pinnacle odds, takes both book odds and pinnacle odds as parameters as book_odds may not necessarily have pinnacle odds within it
-    def pinnacle_ev(book_odds, pinnacle_odds):
-        # Key fields for merging
-        key_fields = ['id', 'sport_key', 'sport_title', 'commence_time', 'home_team', 'away_team', 'market', 'position', 'point', 'num_outcomes']
-        
-        # Fields that are not keys but should not be duplicated when merging Pinnacle
-        drop_fields = ['book_key', 'book_title', 'num_books']
-        
-        # Merge book odds with the pinnacle odds
-        pinnacle_merge = book_odds.merge(pinnacle_odds.drop(columns=drop_fields), how='inner', on=key_fields, suffixes=['_book','_pinnacle'], validate='m:1')
-
-        # Calculate ev data
-        pinnacle_merge['ev_pct_pinnacle'] = (pinnacle_merge['fair_win_dec_pinnacle'] * pinnacle_merge['amount_to_win_line_book']) - ((1 - pinnacle_merge['fair_win_dec_pinnacle']) * 100)
-        pinnacle_merge['kelly_dec_pinnacle'] = pinnacle_merge['fair_win_dec_pinnacle'] - ((1 - pinnacle_merge['fair_win_dec_pinnacle']) / (pinnacle_merge['amount_to_win_line_book'] / 100))
-        pinnacle_merge['kelly_pct_pinnacle'] = pinnacle_merge['kelly_dec_pinnacle'] * 100
-
-        return pinnacle_merge
-
-    # Merge the avg ev and pinnacle ev dataframes into one
-    def merge_ev(avg_merge, pinnacle_merge):
-        # Key fields for merging
-        key_fields = ['id', 'sport_key', 'sport_title', 'commence_time', 'home_team', 'away_team', 'book_key', 'book_title', 'market', 'position', 'line_book', 'point', 'num_outcomes', 'above_below_book', 'width_book', 'vig_win_dec_book', 'fair_win_dec_book', 'fair_line_book', 'amount_to_win_line_book', 'amount_to_win_fair_book', 'vig_dec_book', 'vig_pct_book']
-
-        # Merge the dataframes (left merge because there are more averages than pinnacle odds and we don't want to lose those)
-        final_merge = avg_merge.merge(pinnacle_merge.drop(columns=['num_books']), how='left', on=key_fields, suffixes=['_avg', '_pinnacle'])
+    # Whether the query runs in a process pool
+    def sharded(self):
+        return self.processes is not None and self.processes > 1
+
+    # Counts the events going through a generator (and the books of the events that are read, before anything is pruned)
+    def counted(self, events, count):
+        for event in events:
+            self.counts[count] += 1
+            if count == 'read':
+                self.books_seen.update(bookmaker['key'] for bookmaker in event.get('bookmakers', []))
+            yield event
+
+    # Returns the latest commence time allowed by the days_from_now filter (or None)
+    def commence_to(self):
+        if self.filters.get('days_from_now') is None:
+            return None
+        return pytz.UTC.localize(datetime.datetime.now()) + datetime.timedelta(days=self.filters['days_from_now'])
+
+    # Returns the API requests the query sends, see plan_requests() (file and store sources send none)
+    def requests(self, commence_to=None):
+        if self.filename is not None or self.store is not None:
+            return pandas.DataFrame(columns=REQUEST_PLAN_FIELDS)
+        return plan_requests(self.api_key, sports=self.sports, regions=self.regions, markets=self.markets, ev_type=self.ev_type, commence_to=commence_to, books=self.filters.get('books'), consensus_weights=self.consensus_weights, min_num_books=self.filters.get('min_num_books'), narrow=self.narrow_pull, max_workers=self.max_workers, session=self.session, cache=self.cache, telemetry=self.telemetry)
+
+    # Returns the number and cost of the API requests of the last run for the scan row counts
+    def requested(self):
+        if self.request_plan is None:
+            return ''
+        sent = self.request_plan.loc[self.request_plan['request'] != 'skipped']
+        return f', {len(sent)} requests costing {sent["cost"].sum()}'
+
+    # Returns the events of the file or API source that pass the pushed down filters, and the separately pulled pinnacle events (or None)
+    def read_events(self, commence_to):
+        if self.filename is not None:
+            return self.counted(pruned_events(self.counted(iter_events(self.filename), 'read'), self.sports, self.markets, commence_to), 'kept'), None
+
+        # Only the planned requests are sent
+        self.request_plan = self.requests(commence_to)
+        odds_plan = self.request_plan.loc[self.request_plan['request'] == 'odds']
+        bookmakers = odds_plan['bookmakers'].iloc[0].split(',') if len(odds_plan) > 0 and pandas.notna(odds_plan['bookmakers'].iloc[0]) else None
+        odds_json = api_to_json(api_key=self.api_key, sports=odds_plan['sport'].tolist(), regions=self.regions, markets=self.markets, max_workers=self.max_workers, session=self.session, cache=self.cache, telemetry=self.telemetry, bookmakers=bookmakers)
+        events = self.counted(pruned_events(self.counted(odds_json, 'read'), commence_to=commence_to), 'kept')
+
+        # Pinnacle is an eu book, so its odds have to be pulled separately when eu odds aren't requested (and the pull isn't narrowed to bookmakers that include it)
+        eu_events = None
+        pinnacle_plan = self.request_plan.loc[self.request_plan['request'] == 'pinnacle']
+        if len(pinnacle_plan) > 0:
+            eu_json = api_to_json(api_key=self.api_key, sports=pinnacle_plan['sport'].tolist(), regions=['eu'], markets=self.markets, max_workers=self.max_workers, session=self.session, cache=self.cache, telemetry=self.telemetry, bookmakers=['pinnacle'])
+            eu_events = pruned_events(eu_json, commence_to=commence_to)
+        return events, eu_events
+
+    # Returns the processed odds of the snapshot store source that pass the pushed down filters
+    def read_store(self, commence_to):
+        with stage(self.telemetry, 'read_store') as read_stage:
+            book_odds = store_to_processed_df(self.store, sports=self.sports, markets=self.markets, devig=self.devig)
+            read_stage.rows = len(book_odds)
+        self.counts['read'] = self.counts['kept'] = book_odds['id'].nunique()
+        self.books_seen.update(book_odds['book_key'].unique().tolist())
+        if commence_to is not None:
+            book_odds = book_odds.loc[book_odds['commence_time'] <= commence_to].reset_index(drop=True)
+            self.counts['kept'] = book_odds['id'].nunique()
+        return book_odds
+
+    # Runs the scan and process steps, returns the processed odds and the separately pulled pinnacle odds (or None)
+    def scan(self, commence_to):
+        self.counts = {'read': 0, 'kept': 0}
+        self.books_seen = set()
+
+        pinnacle_odds = None
+        if self.store is not None:
+            book_odds = self.read_store(commence_to)
+        else:
+            events, eu_events = self.read_events(commence_to)
+            if self.filename is not None:
+                book_odds = events_to_processed_df(events, chunk_size=self.chunk_size, telemetry=self.telemetry, devig=self.devig)
+            else:
+                book_odds = self.process(list(events))
+            if eu_events is not None:
+                eu_odds = self.process(list(eu_events))
+                pinnacle_odds = eu_odds.loc[eu_odds['book_key'] == 'pinnacle']
+
+        self.rows['scan'] = f'{self.counts["read"]} events read, {self.counts["kept"]} kept' + self.requested()
+        self.rows['process'] = len(book_odds)
+        return book_odds, pinnacle_odds
+
+    # Returns the books of the books filter that are in the data, or None when no books filter applies
+    # Books that aren't in the data are left out of the filter, like data() always did, and no book filter is applied if none of them are
+    def valid_books(self):
+        if self.filters.get('books') is None:
+            return None
+        for book in self.filters['books']:
+            if book not in self.books_seen:
+                warn(f'{book} is not a valid book. Data filtered by other specified books', self.telemetry)
+        return [book for book in self.filters['books'] if book in self.books_seen] or None
+
+    # Yields the scanned source as shards of whole events, as (shard, pinnacle events) pairs, while it is being read
+    # With shard_by 'event', events are split into runs of chunk_size / processes events, and uncompressed newline-delimited files into byte ranges that the workers read themselves
+    # With shard_by 'sport', every sport is one shard. Store shards are the Arrow IPC bytes of their processed odds
+    def shards(self, commence_to):
+        if self.store is not None:
+            book_odds = self.read_store(commence_to)
+            codes, keys = pandas.factorize(book_odds['sport_key' if self.shard_by == 'sport' else 'id'])
+            shard_numbers = codes if self.shard_by == 'sport' else codes * self.processes // max(len(keys), 1)
+            for number in numpy.unique(shard_numbers):
+                yield to_ipc(book_odds.loc[shard_numbers == number]), None
+            return
 
-        return final_merge
+        if self.filename is not None and self.shard_by == 'event' and self.filename.endswith(('.jsonl', '.ndjson')) and not is_gzipped(self.filename):
+            for start, end in line_ranges(self.filename, self.processes * 4):
+                yield (self.filename, start, end), None
+            return
 
-    # Takes API parameters and the desired type of expected value and returns a complete Dataframe with ev fields
-    def api_to_ev(api_key, sports=None, regions=['us', 'eu', 'uk', 'au'], markets=['h2h', 'spreads', 'totals'], ev_type='both'):
-        book_odds = api_to_processed_df(api_key=api_key, sports=sports, regions=regions, markets=markets)
+        events, eu_events = self.read_events(commence_to)
+        # Only the pinnacle odds of each shard's own events are sent along with it
+        pinnacle_events = None
+        if eu_events is not None:
+            pinnacle_events = {event['id']: {**event, 'bookmakers': [bookmaker for bookmaker in event.get('bookmakers', []) if bookmaker['key'] == 'pinnacle']} for event in eu_events}
+
+        if self.shard_by == 'sport':
+            by_sport = {}
+            for event in events:
+                by_sport.setdefault(event.get('sport_key'), []).append(event)
+            shards = by_sport.values()
+        else:
+            shards = iter_chunks(events, max(1, self.chunk_size // self.processes))
+        for shard in shards:
+            yield shard, None if pinnacle_events is None else [pinnacle_events[event['id']] for event in shard if event['id'] in pinnacle_events]
+
+    # Runs the scan step, then the process, prefilter, ev and filter steps of every shard in a pool of processes and concatenates the results
+    # Every calculation stays within one event, so the shards give the same rows as one pass over all events
+    # Shards are sent to the workers as soon as they are read, as events, byte ranges or Arrow IPC bytes, and come back as Arrow IPC bytes, so no Dataframe is pickled
+    # With top_k, every shard already keeps only its own top_k rows (which always include its rows of the overall top_k)
+    def collect_sharded(self, commence_to):
+        self.counts = {'read': 0, 'kept': 0}
+        self.books_seen = set()
+        books = self.filters.get('books')
+        top = {'k': self.top_k, 'per': self.top_per, **self.sorting} if self.top_k is not None else None
+        pruning = {'sports': self.sports, 'markets': self.markets, 'commence_to': commence_to}
+
+        with stage(self.telemetry, 'shards', processes=self.processes) as shards_stage:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.processes) as executor:
+                shards = []
+                futures = []
+                for shard, pinnacle_events in self.shards(commence_to):
+                    shards.append((shard, pinnacle_events))
+                    futures.append(executor.submit(query_shard, shard, pinnacle_events, self.ev_type, self.filters, books, top, pruning, self.devig, self.consensus_weights))
+                results = [future.result() for future in futures]
+
+                # Workers that read their own byte range count its events and books
+                for _, rows in results:
+                    self.counts['read'] += rows.get('read', 0)
+                    self.counts['kept'] += rows.get('kept', 0)
+                    self.books_seen.update(rows.get('books', []))
+
+                # The books filter only matches books that are in the data, so the shards only have to run again when none of the books are
+                if books is not None and self.valid_books() is None:
+                    results = list(executor.map(query_shard, *zip(*shards), *[itertools.repeat(value) for value in [self.ev_type, self.filters, None, top, pruning, self.devig, self.consensus_weights]]))
+            shards_stage.rows = sum(rows['filter'] for _, rows in results)
+
+        self.rows['scan'] = f'{self.counts["read"]} events read, {self.counts["kept"]} kept, {len(shards)} shards' + self.requested()
+        for step in ['process', 'prefilter', 'ev', 'filter']:
+            self.rows[step] = sum(rows[step] for _, rows in results)
+        if not results:
+            return evaluated_odds(processed_data(flattened_data([]), self.devig), None, self.ev_type, self.filters, None, {}, consensus_weights=self.consensus_weights)
+
+        # Offset each shard's codes so they stay unique across shards
+        frames = [from_ipc(buffer) for buffer, _ in results]
+        market_offset, position_offset = 0, 0
+        for frame in frames:
+            if len(frame) == 0:
+                continue
+            frame['market_code'] += market_offset
+            frame['position_code'] += position_offset
+            market_offset = frame['market_code'].max() + 1
+            position_offset = frame['position_code'].max() + 1
+        return concat_odds(frames)
+
+    # Runs the query and returns the filtered and sorted Dataframe of ev odds
+    def collect(self):
+        self.rows = {}
+        self.request_plan = None
+        commence_to = self.commence_to()
+
+        if self.sharded():
+            odds = self.collect_sharded(commence_to)
+        else:
+            book_odds, pinnacle_odds = self.scan(commence_to)
+            odds = evaluated_odds(book_odds, pinnacle_odds, self.ev_type, self.filters, self.valid_books(), self.rows, self.telemetry, self.consensus_weights)
 
-        if ev_type == 'avg':
-            ev = avg_ev(book_odds=book_odds)
-        elif ev_type == 'pinnacle':
-            if 'eu' not in regions:
-                eu_odds = api_to_processed_df(api_key=api_key, sports=sports, regions=['eu'], markets=markets)
-                pinnacle_odds = extract_pinnacle(eu_odds)
-                ev = pinnacle_ev(book_odds=book_odds, pinnacle_odds=pinnacle_odds)
-            else:
-                pinnacle_odds = extract_pinnacle(book_odds)
-                ev = pinnacle_ev(book_odds=book_odds, pinnacle_odds=pinnacle_odds)
-        else: # assumed to be 'both'
-            average = avg_ev(book_odds=book_odds)
-            if 'eu' not in regions:
-                eu_odds = api_to_processed_df(api_key=api_key, sports=sports, regions=['eu'], markets=markets)
-                pinnacle_odds = extract_pinnacle(eu_odds)
-                pinnacle = pinnacle_ev(book_odds=book_odds, pinnacle_odds=pinnacle_odds)
+        with stage(self.telemetry, 'sort', sortby=self.sorting['sortby']) as sort_stage:
+            if self.top_k is not None:
+                odds = top_ev(odds, self.top_k, per=self.top_per, **self.sorting)
             else:
-                pinnacle_odds = extract_pinnacle(book_odds)
-                pinnacle = pinnacle_ev(book_odds=book_odds, pinnacle_odds=pinnacle_odds)
-            ev = merge_ev(avg_merge=average, pinnacle_merge=pinnacle)
-
-        return ev
-
-    # Reads data from a JSON file and returns a complete Dataframe with ev fields (if ev_type 'pinnacle' is selected and file does not contain eu odds, df will be empty)
-    def file_to_ev(filename, ev_type='both'): 
-        book_odds = file_to_processed_df(filename)
-        if ev_type == 'avg':
-            ev = avg_ev(book_odds=book_odds)
-        elif ev_type == 'pinnacle':
-            pinnacle_odds = extract_pinnacle(book_odds)
-            ev = pinnacle_ev(book_odds=book_odds, pinnacle_odds=pinnacle_odds)
-        else: # assumed to be 'both'
-            average = avg_ev(book_odds=book_odds)
-            pinnacle_odds = extract_pinnacle(book_odds)
-            pinnacle = pinnacle_ev(book_odds=book_odds, pinnacle_odds=pinnacle_odds)
-            ev = merge_ev(avg_merge=average, pinnacle_merge=pinnacle)
-
-        return ev
-
-    # Filters a Dataframe of ev odds based on several optional parameters
-    def filter_ev(odds, pref_ev_filter, sports=None, markets=None, days_from_now=None, books=None, min_odds=None, max_odds=None, max_width=None, max_vig_pct=None, min_ev_pct=None, min_num_books=None):
-        if sports is not None:
-            odds = odds.loc[odds['sport_key'].isin(sports)]
-        if markets is not None:
-            odds = odds.loc[odds['market'].isin(markets)]
-        if days_from_now is not None:
-            date = pytz.UTC.localize(datetime.datetime.now())+datetime.timedelta(days=days_from_now)
-            odds = odds.loc[odds['commence_time'].apply(lambda t: dateutil.parser.isoparse(t)) <=  date]
-        if books is not None:
-            odds = odds.loc[odds['book_key'].isin(books)]
-        if min_odds is not None:
-            odds = odds.loc[odds['line_book'] >= min_odds]
-        if max_odds is not None:
-            odds = odds.loc[odds['line_book'] <= max_odds]
-        if max_width is not None:
-            odds = odds.loc[odds['num_outcomes'] == 2]
-            if pref_ev_filter == 'both' or pref_ev_filter == 'avg':
-                odds = odds.loc[odds['width_avg'] <= max_width]
-            if pref_ev_filter == 'both' or pref_ev_filter == 'pinnacle':
-                odds = odds.loc[odds['width_pinnacle'] <= max_width]
-        if max_vig_pct is not None:
-            if pref_ev_filter == 'both' or pref_ev_filter == 'avg':
-                odds = odds.loc[odds['vig_pct_avg'] <= max_vig_pct]
-            if pref_ev_filter == 'both' or pref_ev_filter == 'pinnacle':
-                odds = odds.loc[odds['vig_pct_pinnacle'] <= max_vig_pct]
-        if min_ev_pct is not None:
-            if pref_ev_filter == 'both' or pref_ev_filter == 'avg':
-                odds = odds.loc[odds['ev_pct_avg'] >= min_ev_pct]
-            if pref_ev_filter == 'both' or pref_ev_filter == 'pinnacle':
-                odds = odds.loc[odds['ev_pct_pinnacle'] >= min_ev_pct]
-        if min_num_books is not None:
-            odds = odds.loc[odds['num_books'] >= min_num_books]
-
-        odds.reset_index(drop=True, inplace=True)
+                odds = sort_ev(odds, **self.sorting)
+            sort_stage.rows = self.rows['sort'] = len(odds)
 
-        return odds
+        if not self.expanded:
+            with stage(self.telemetry, 'cleanup') as cleanup_stage:
+                odds = cleanup_ev(odds, ev_type=self.ev_type)
+                cleanup_stage.rows = self.rows['cleanup'] = len(odds)
+        else:
+            odds = odds.drop(columns=CODE_FIELDS, errors='ignore')
 
-    # Sorts a Dataframe of ev odds by a field
-    def sort_ev(odds, sortby, ascending, pref_ev_sort='avg'):
-        if sortby == 'commence_time':
-            odds.sort_values(['commence_time'], ascending=ascending, inplace=True)
-        elif sortby == 'line':
-            odds.sort_values(['line_book'], ascending=ascending, inplace=True)
-        elif sortby == 'width':
-            if pref_ev_sort == 'avg':
-                odds.sort_values(['width_avg'], ascending=ascending, inplace=True)
-            if pref_ev_sort == 'pinnacle':
-                odds.sort_values(['width_pinnacle'], ascending=ascending, inplace=True)
-        elif sortby == 'ev_pct':
-            if pref_ev_sort == 'avg':
-                odds.sort_values(['ev_pct_avg'], ascending=ascending, inplace=True)
-            if pref_ev_sort == 'pinnacle':
-                odds.sort_values(['ev_pct_pinnacle'], ascending=ascending, inplace=True)
-        if sortby == 'kelly_pct':
-            if pref_ev_sort == 'avg':
-                odds.sort_values(['kelly_pct_avg'], ascending=ascending, inplace=True)
-            if pref_ev_sort == 'pinnacle':
-                odds.sort_values(['kelly_pct_pinnacle'], ascending=ascending, inplace=True)
-
-        if sortby == 'default':
-            odds.sort_values(['commence_time', 'id', 'book_key', 'market'], inplace=True)
-
-        odds.reset_index(drop=True, inplace=True)
-        
         return odds
 
-    # Simplify the dataframe into a more easily consumable format
-    def cleanup_ev(odds, ev_type):
-        fields_keep = ['sport_title', 'commence_time', 'home_team', 'away_team', 'book_title', 'market', 'position', 'line_book', 'point', 'num_books']
-
-        if ev_type == 'both' or ev_type == 'avg':
-            add_fields = ['fair_line_avg', 'width_avg', 'vig_pct_avg', 'ev_pct_avg', 'kelly_pct_avg']
-            fields_keep.extend(add_fields)
-        if ev_type == 'both' or ev_type == 'pinnacle':
-            add_fields = ['fair_line_pinnacle', 'width_pinnacle', 'vig_pct_pinnacle', 'ev_pct_pinnacle', 'kelly_pct_pinnacle']
-            fields_keep.extend(add_fields)
-
+# Runs the prefilter, ev and filter steps of a Query on processed odds and records the rows left after every step in rows
+# books is the list of books to keep (None keeps every book), the other filters are the filter_ev() parameters of the query
+def evaluated_odds(book_odds, pinnacle_odds, ev_type, filters, books, rows, telemetry=None, consensus_weights=None):
+    with stage(telemetry, 'prefilter') as prefilter_stage:
+        keep = numpy.ones(len(book_odds), dtype=bool)
+        if books is not None:
+            keep &= book_odds['book_key'].isin(books).to_numpy()
+        if filters.get('min_odds') is not None:
+            keep &= book_odds['line'].to_numpy() >= filters['min_odds']
+        if filters.get('max_odds') is not None:
+            keep &= book_odds['line'].to_numpy() <= filters['max_odds']
+        if filters.get('min_num_books') is not None:
+            keep &= book_odds['num_books'].to_numpy() >= filters['min_num_books']
+        prefilter_stage.rows = rows['prefilter'] = int(keep.sum())
+
+    with stage(telemetry, 'ev', ev_type=ev_type) as ev_stage:
+        odds = ev_data(book_odds, ev_type=ev_type, pinnacle_odds=pinnacle_odds, rows=keep, consensus_weights=consensus_weights)
+        ev_stage.rows = rows['ev'] = len(odds)
+
+    with stage(telemetry, 'filter') as filter_stage:
+        odds = filter_ev(odds, filters['pref_ev_filter'], max_width=filters.get('max_width'), max_vig_pct=filters.get('max_vig_pct'), min_ev_pct=filters.get('min_ev_pct'))
+        filter_stage.rows = rows['filter'] = len(odds)
+
+    return odds
+
+# Runs the process, prefilter, ev and filter steps of a sharded Query on one shard (runs in a worker process)
+# The shard is a list of events (with the pinnacle events of the same events when pinnacle was pulled separately), the Arrow IPC bytes of processed odds,
+# or a (filename, start, end) byte range of a newline-delimited file, which is read and pruned (pruned_events() parameters in pruning) here
+# Returns the result as Arrow IPC bytes with the rows left after every step, top is the top_ev() parameters when only the best rows are kept
+def query_shard(shard, pinnacle_events, ev_type, filters, books, top, pruning, devig='multiplicative', consensus_weights=None):
+    counts = {}
+    if isinstance(shard, tuple):
+        events = list(iter_line_events(*shard))
+        counts = {'read': len(events), 'books': {bookmaker['key'] for event in events for bookmaker in event.get('bookmakers', [])}}
+        shard = list(pruned_events(events, **pruning))
+        counts['kept'] = len(shard)
+
+    if isinstance(shard, bytes):
+        book_odds = from_ipc(shard)
+        # Store codes are global, make them dense within the shard again
+        for field in ['market_code', 'position_code']:
+            book_odds[field] = pandas.factorize(book_odds[field])[0].astype(NUMERIC_DTYPES[field])
+    else:
+        book_odds = processed_data(flattened_data(shard), devig)
+    rows = {'process': len(book_odds), **counts}
+
+    pinnacle_odds = None
+    if pinnacle_events is not None:
+        eu_odds = processed_data(flattened_data(pinnacle_events), devig)
+        pinnacle_odds = eu_odds.loc[eu_odds['book_key'] == 'pinnacle']
+
+    odds = evaluated_odds(book_odds, pinnacle_odds, ev_type, filters, books, rows, consensus_weights=consensus_weights)
+    if top is not None:
+        odds = top_ev(odds, **top)
+    return to_ipc(odds), rows
+
+# Fields that identify one bet, alerts are deduplicated on them
+BET_FIELDS = ['id', 'book_key', 'market', 'position', 'point']
+
+# Turns successive expanded ev tables (e.g. from EVSession.update() or data(expanded=True)) into alerts about the bets at or above min_ev_pct
+# A bet is alerted when it reaches the threshold ('new') and again only when its line moves while it stays there ('changed')
+# Bets that drop below the threshold are forgotten, so they are alerted as new if they cross it again
+# pref_ev is the ev the threshold applies to ('avg', 'pinnacle' or 'both'), and on_alert is called with every alert as a dict
+class AlertStream:
+    def __init__(self, min_ev_pct, pref_ev='avg', on_alert=None):
+        if pref_ev not in ['avg', 'pinnacle', 'both']:
+            raise SystemExit("Error: pref_ev must be one of: 'avg', 'pinnacle', 'both'")
+        self.min_ev_pct = min_ev_pct
+        self.pref_ev = pref_ev
+        self.on_alert = on_alert
+        # Line of every bet that is at or above the threshold, by a hash of its BET_FIELDS
+        self.alerted = pandas.Series(dtype=numpy.float64)
+
+    # Takes the next ev table and returns the new and changed bets as a Dataframe with an 'alert' and a 'previous_line' field
+    def update(self, odds):
+        above = numpy.ones(len(odds), dtype=bool)
+        for reference in (['avg', 'pinnacle'] if self.pref_ev == 'both' else [self.pref_ev]):
+            above &= odds['ev_pct_' + reference].to_numpy(dtype=numpy.float64) >= self.min_ev_pct
+        odds = odds.loc[above]
+
+        keys = pandas.util.hash_pandas_object(odds[BET_FIELDS], index=False).to_numpy()
+        lines = odds['line_book'].to_numpy(dtype=numpy.float64)
+        previous = self.alerted.reindex(keys).to_numpy()
+        new = numpy.isnan(previous)
+        alerted = new | (previous != lines)
+
+        alerts = odds.iloc[numpy.flatnonzero(alerted)].reset_index(drop=True)
+        alerts.insert(0, 'alert', numpy.where(new[alerted], 'new', 'changed'))
+        alerts['previous_line'] = previous[alerted]
+        self.alerted = pandas.Series(lines, index=keys)
+
+        if self.on_alert is not None:
+            for alert in alerts.to_dict('records'):
+                self.on_alert(alert)
+        return alerts
+
+    # Yields the alerts of a stream of ev tables one at a time, as dicts
+    def alerts(self, ev_tables):
+        for odds in ev_tables:
+            yield from self.update(odds).to_dict('records')
+
+# Fields of the ev table a backtest keeps for every line it replays
+BACKTEST_FIELDS = ['bet_key', 'capture_time', 'commence_time', 'num_outcomes', 'num_books', 'line_book', 'amount_to_win_line_book', 'width_avg', 'vig_pct_avg', 'ev_pct_avg', 'kelly_dec_avg', 'fair_win_dec_avg', 'width_pinnacle', 'vig_pct_pinnacle', 'ev_pct_pinnacle', 'kelly_dec_pinnacle', 'fair_win_dec_pinnacle']
+
+# Grid of filter_ev() parameters swept by backtest() when no grid is given (None means the filter isn't applied), includes the recommended=True values
+BACKTEST_GRID = {
+    'days_from_now': [2],
+    'min_odds': [-200],
+    'max_odds': [200],
+    'max_width': [None, 25, 45],
+    'max_vig_pct': [None],
+    'min_ev_pct': [0, 1, 2, 3],
+    'min_num_books': [None, 4, 8],
+    'pref_ev_filter': ['avg', 'pinnacle', 'both'],
+}
+
+# Runs one snapshot file through the ev pipeline for a backtest (runs in a worker process)
+# The capture time of a snapshot is its most recent last_update, and lines of events that had already started are left out
+def backtest_snapshot(filename):
+    odds = ev_data(file_to_processed_df(filename), ev_type='both')
+    if 'market_last_update' in odds.columns:
+        capture_time = pandas.to_datetime(odds['market_last_update'], utc=True).max()
+    else:
+        capture_time = pandas.to_datetime(odds['last_update'], utc=True).max()
+    odds['capture_time'] = capture_time
+    odds['commence_time'] = pandas.to_datetime(odds['commence_time'], utc=True)
+    odds['bet_key'] = pandas.util.hash_pandas_object(odds[POSITION_FIELDS + ['book_key']], index=False).to_numpy()
+    odds = odds.loc[odds['commence_time'] > capture_time, BACKTEST_FIELDS]
+    odds.reset_index(drop=True, inplace=True)
+    return odds
+
+# Replays a directory of snapshot files through the ev pipeline and reports how every combination of filter parameters in grid would have done
+# Snapshots are processed in parallel by max_workers processes, then all parameter sets are evaluated at once as a matrix of filter masks per snapshot
+# A bet is the first time a line passes the filters, and it is judged against the closing line (the last snapshot before the event starts):
+#   clv_pct: how much better the bet's price was than the same book's closing price
+#   roi_pct: expected return of flat bets if the closing fair win probability (close_ref 'avg' or 'pinnacle') is the truth
+#   kelly_log_growth: expected log growth of the bankroll from staking the kelly fraction (of the preferred ev type) of every bet
+def backtest(directory, grid=None, close_ref='avg', max_workers=None):
+    grid = grid or BACKTEST_GRID
+    filenames = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(('.json', '.jsonl', '.ndjson', '.gz')))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        snapshots = [snapshot for snapshot in executor.map(backtest_snapshot, filenames) if len(snapshot) > 0]
+    snapshots.sort(key=lambda snapshot: snapshot['capture_time'].iloc[0])
+
+    # Every parameter set of the grid, with missing filters as thresholds that always pass
+    names = list(grid.keys())
+    params = pandas.DataFrame(list(itertools.product(*grid.values())), columns=names)
+    defaults = {'days_from_now': numpy.inf, 'min_odds': -numpy.inf, 'max_odds': numpy.inf, 'max_width': numpy.inf, 'max_vig_pct': numpy.inf, 'min_ev_pct': -numpy.inf, 'min_num_books': -numpy.inf}
+    thresholds = {name: params[name].astype(float).fillna(default).to_numpy()[:, None] if name in params.columns else numpy.full((len(params), 1), default) for name, default in defaults.items()}
+    pref = params['pref_ev_filter'].to_numpy()[:, None] if 'pref_ev_filter' in params.columns else numpy.full((len(params), 1), 'both')
+    use_avg = (pref == 'avg') | (pref == 'both')
+    use_pinnacle = (pref == 'pinnacle') | (pref == 'both')
+
+    # Closing line of every bet: its row in the last snapshot it appears in (rows are in snapshot order, so the highest row of the bet)
+    lines = pandas.concat(snapshots, ignore_index=True)
+    bet_codes, bet_keys = pandas.factorize(lines['bet_key'])
+    closing_row = numpy.full(len(bet_keys), -1, dtype=numpy.int64)
+    numpy.maximum.at(closing_row, bet_codes, numpy.arange(len(lines)))
+    close_fair = lines[f'fair_win_dec_{close_ref}'].to_numpy()[closing_row]
+    close_decimal = 1 + lines['amount_to_win_line_book'].to_numpy()[closing_row] / 100
+
+    totals = {field: numpy.zeros(len(params)) for field in ['num_bets', 'clv', 'roi', 'log_growth']}
+    placed = numpy.zeros((len(params), len(bet_keys)), dtype=bool)
+    start = 0
+    for snapshot in snapshots:
+        codes = bet_codes[start:start + len(snapshot)]
+        start += len(snapshot)
+        column = lambda field: snapshot[field].to_numpy(dtype=numpy.float64)[None, :]
+
+        # One row per parameter set, one column per line of the snapshot (NaN fails every comparison, like filter_ev())
+        days_to_start = ((snapshot['commence_time'] - snapshot['capture_time']).dt.total_seconds().to_numpy() / 86400)[None, :]
+        passed = (days_to_start <= thresholds['days_from_now']) & (column('line_book') >= thresholds['min_odds']) & (column('line_book') <= thresholds['max_odds']) & (column('num_books') >= thresholds['min_num_books'])
+        for ev_type, used in [('avg', use_avg), ('pinnacle', use_pinnacle)]:
+            width_ok = numpy.isinf(thresholds['max_width']) | ((column('num_outcomes') == 2) & (column(f'width_{ev_type}') <= thresholds['max_width']))
+            vig_ok = numpy.isinf(thresholds['max_vig_pct']) | (column(f'vig_pct_{ev_type}') <= thresholds['max_vig_pct'])
+            ev_ok = numpy.isinf(thresholds['min_ev_pct']) | (column(f'ev_pct_{ev_type}') >= thresholds['min_ev_pct'])
+            passed &= ~used | (width_ok & vig_ok & ev_ok)
+
+        # Only the first time a line passes is a bet
+        new_bets = passed & ~placed[:, codes]
+        placed[:, codes] |= passed
+
+        decimal = 1 + column('amount_to_win_line_book') / 100
+        fair = close_fair[codes][None, :]
+        kelly = numpy.clip(numpy.where(pref == 'pinnacle', column('kelly_dec_pinnacle'), column('kelly_dec_avg')), 0, 0.99)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            clv = decimal / close_decimal[codes][None, :] - 1
+            roi = fair * decimal - 1
+            log_growth = fair * numpy.log1p(kelly * (decimal - 1)) + (1 - fair) * numpy.log1p(-kelly)
+        totals['num_bets'] += new_bets.sum(axis=1)
+        totals['clv'] += numpy.where(new_bets, clv, 0).sum(axis=1)
+        totals['roi'] += numpy.where(new_bets & ~numpy.isnan(roi), roi, 0).sum(axis=1)
+        totals['log_growth'] += numpy.where(new_bets & ~numpy.isnan(log_growth), log_growth, 0).sum(axis=1)
+
+    report = params.copy()
+    report['num_bets'] = totals['num_bets'].astype(numpy.int64)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        report['clv_pct'] = totals['clv'] / totals['num_bets'] * 100
+        report['roi_pct'] = totals['roi'] / totals['num_bets'] * 100
+    report['kelly_log_growth'] = totals['log_growth']
+    report['kelly_growth_pct'] = numpy.expm1(totals['log_growth']) * 100
+    report.sort_values('roi_pct', ascending=False, inplace=True)
+    report.reset_index(drop=True, inplace=True)
+
+    return report
+
+# Filter and sort values of recommended=True, in the order data() assigns them
+RECOMMENDED = {'days_from_now': 2, 'min_odds': -200, 'max_odds': 200, 'max_width': 45, 'min_ev_pct': 1, 'min_num_books': 4, 'pref_ev_filter': 'both', 'sortby': 'ev_pct', 'ascending': False, 'pref_ev_sort': 'avg', 'expanded': False}
+
+# Query string parameters of an EVService request, with the type their values are parsed as (lists are comma separated)
+SERVICE_PARAMETERS = {'sports': list, 'markets': list, 'books': list, 'ev_type': str, 'recommended': bool, 'days_from_now': float, 'min_odds': float, 'max_odds': float, 'max_width': float, 'max_vig_pct': float, 'min_ev_pct': float, 'min_num_books': float, 'pref_ev_filter': str, 'sortby': str, 'ascending': bool, 'pref_ev_sort': str, 'expanded': bool, 'top_k': int, 'top_per': str, 'fields': list, 'format': str}
+
+# Parses the query string of an EVService request into EVService.query() parameters (plus format)
+def service_parameters(query_string):
+    params = {}
+    for name, values in urllib.parse.parse_qs(query_string, keep_blank_values=True).items():
+        if name not in SERVICE_PARAMETERS:
+            raise TypeError(f"unknown parameter '{name}'")
+        value, kind = values[-1], SERVICE_PARAMETERS[name]
+        if kind == list:
+            params[name] = [item for item in value.split(',') if item]
+        elif kind == bool:
+            if value.lower() not in ['true', 'false', '1', '0']:
+                raise TypeError(f"parameter '{name}' must be a boolean")
+            params[name] = value.lower() in ['true', '1']
+        elif kind == str:
+            params[name] = value
+        else:
+            try:
+                params[name] = kind(value)
+            except ValueError:
+                raise TypeError(f"parameter '{name}' must be {'an integer' if kind == int else 'a number'}")
+    return params
+
+# Long-running local HTTP service that keeps one materialized, expanded ev table in memory and answers data() queries against it in milliseconds
+# The table is refreshed in the background: a file is reloaded when it changes and a store every refresh_interval seconds,
+# while the API is polled by a PollScheduler whose snapshots are processed incrementally by an EVSession
+#   GET /ev?books=fanduel,draftkings&min_ev_pct=1&sortby=ev_pct   data() filter and sort parameters, plus fields (columns to return) and format ('json' or 'arrow')
+#   GET /status                                                   the source, size and age of the table
+#   POST /refresh                                                 reloads a file or store right away
+class EVService:
+    def __init__(self, api_key=None, filename=None, store=None, sports=None, regions=['us', 'eu', 'uk', 'au'], markets=['h2h', 'spreads', 'totals'], ev_type='both', refresh_interval=60, host='127.0.0.1', port=8000, days_from_now=None, budget=None, session=None, base_url=ODDS_API_URL, telemetry=None, devig='multiplicative', consensus_weights=None):
+        if api_key is None and filename is None and store is None:
+            raise SystemExit("Error: API key, filename or store must be specified\n")
+        if ev_type not in ['avg', 'pinnacle', 'both']:
+            raise SystemExit("Error: ev_type must be one of: 'avg', 'pinnacle', 'both' or be left blank")
+        self.filename = filename
+        self.store = store
+        self.sports = sports
+        self.markets = markets
+        self.ev_type = ev_type
+        self.devig = devig
+        self.consensus_weights = consensus_weights
+        self.refresh_interval = refresh_interval
+        self.host = host
+        self.port = port
+        self.telemetry = as_telemetry(telemetry)
+
+        self.table = None
+        self.refreshed_at = None
+        self.refreshes = 0
+        self.error = None
+        self.mtime = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.server = None
+        self.threads = []
+
+        # The API is polled sport by sport, and the latest events of every sport make up the snapshot
+        self.scheduler = None
+        if filename is None and store is None:
+            # Pinnacle is an eu book, so its lines need the eu region
+            if ev_type != 'avg' and 'eu' not in regions:
+                warn("the 'eu' region is added to the polled regions for pinnacle odds", self.telemetry)
+                regions = regions + ['eu']
+            self.ev_session = EVSession(ev_type=ev_type, devig=devig, consensus_weights=consensus_weights)
+            self.sport_events = {}
+            self.scheduler = PollScheduler(api_key, sports=sports, regions=regions, markets=markets, days_from_now=days_from_now, budget=budget, on_odds=self.on_odds, session=session, base_url=base_url, sleep=self.stopped.wait, telemetry=self.telemetry)
+
+    # Swaps in a new table (queries that already started keep the table they started with)
+    def publish(self, table):
+        self.table = table
+        self.refreshed_at = datetime.datetime.now(datetime.timezone.utc)
+        self.refreshes += 1
+
+    # Reloads the table from the file (only when it changed) or the store, returns whether the table was reloaded
+    def refresh(self):
+        if self.scheduler is not None:
+            return False
+        with self.lock:
+            if self.filename is not None:
+                mtime = os.path.getmtime(self.filename)
+                if mtime == self.mtime:
+                    return False
+            with stage(self.telemetry, 'refresh') as refresh_stage:
+                if self.filename is not None:
+                    book_odds = events_to_processed_df(pruned_events(iter_events(self.filename), self.sports, self.markets), telemetry=self.telemetry, devig=self.devig)
+                    self.mtime = mtime
+                else:
+                    book_odds = store_to_processed_df(self.store, sports=self.sports, markets=self.markets, devig=self.devig)
+                table = ev_data(book_odds, ev_type=self.ev_type, consensus_weights=self.consensus_weights)
+                refresh_stage.rows = len(table)
+            self.publish(table)
+        return True
+
+    # Processes the latest odds of one sport polled by the scheduler
+    def on_odds(self, sport, odds_json):
+        self.sport_events[sport] = odds_json
+        with stage(self.telemetry, 'refresh', sport=sport) as refresh_stage:
+            table = self.ev_session.update(list(itertools.chain.from_iterable(self.sport_events.values())))
+            refresh_stage.rows = len(table)
+        self.publish(table)
+
+    # Keeps the table fresh until the service is stopped (runs in a background thread)
+    def run_refresh(self):
+        while not self.stopped.is_set():
+            try:
+                if self.scheduler is None:
+                    if not self.stopped.wait(self.refresh_interval):
+                        self.refresh()
+                elif self.scheduler.sports:
+                    self.scheduler.step()
+                else:
+                    # No sport in season to poll (like PollScheduler.run(), which returns right away)
+                    self.stopped.wait(self.refresh_interval)
+                self.error = None
+            except Exception as error:
+                self.error = repr(error)
+                warn(f'refreshing the ev table failed: {error!r}', self.telemetry)
+                self.stopped.wait(self.refresh_interval)
+
+    # Filters, sorts and projects the table like data() with the same parameters, returns the Dataframe and the warnings about the parameters
+    # ev_type can narrow the ev_type of the service (with 'pinnacle' on a 'both' service, lines whose number of outcomes differs from the other books' are left out)
+    def query(self, sports=None, markets=None, books=None, ev_type=None, recommended=False, days_from_now=None, min_odds=None, max_odds=None, max_width=None, max_vig_pct=None, min_ev_pct=None, min_num_books=None, pref_ev_filter=None, sortby='default', ascending=False, pref_ev_sort=None, expanded=False, top_k=None, top_per=None, fields=None):
+        table = self.table
+        if table is None:
+            raise RuntimeError('the ev table has not been loaded yet')
+        warnings = []
+        ev_type = ev_type or self.ev_type
+        if ev_type not in ['avg', 'pinnacle', 'both'] or (self.ev_type != 'both' and ev_type != self.ev_type):
+            raise TypeError(f"parameter 'ev_type' must be {['avg', 'pinnacle', 'both'] if self.ev_type == 'both' else repr(self.ev_type)}")
+        if recommended:
+            days_from_now, min_odds, max_odds, max_width, min_ev_pct, min_num_books, pref_ev_filter, sortby, ascending, pref_ev_sort, expanded = RECOMMENDED.values()
+
+        if ev_type != 'both' or pref_ev_filter is None:
+            pref_ev_filter = ev_type
+        elif pref_ev_filter not in ['avg', 'pinnacle', 'both']:
+            raise TypeError("parameter 'pref_ev_filter' must be one of: 'avg', 'pinnacle', 'both'")
+        if pref_ev_sort is None:
+            pref_ev_sort = 'pinnacle' if ev_type == 'pinnacle' else 'avg'
+        elif pref_ev_sort not in ['avg', 'pinnacle']:
+            raise TypeError("parameter 'pref_ev_sort' must be 'avg' or 'pinnacle'")
+        elif ev_type != 'both' and pref_ev_sort != ev_type:
+            warnings.append(f"parameter 'pref_ev_sort' cannot be '{pref_ev_sort}' when parameter 'ev_type' is '{ev_type}'. Value defaults to '{ev_type}'")
+            pref_ev_sort = ev_type
+        if sortby not in ['commence_time', 'line', 'width', 'ev_pct', 'kelly_pct', 'default']:
+            raise TypeError("parameter 'sortby' must be one of: 'commence_time', 'line', 'width', 'ev_pct', 'kelly_pct', 'default'")
+        if top_k is not None and (type(top_k) != int or top_k < 1):
+            raise TypeError("parameter 'top_k' must be an integer >= 1")
+        if top_per is not None and top_per not in ['sport', 'event']:
+            raise TypeError("parameter 'top_per' must be 'sport' or 'event'")
+
+        # Books that aren't in the table are left out of the filter, and no book filter is applied if none of them are
+        if books:
+            for book in books:
+                if book not in table['book_key'].cat.categories:
+                    warnings.append(f'{book} is not a valid book. Data filtered by other specified books')
+            books = [book for book in books if book in table['book_key'].cat.categories] or None
+
+        # A shallow copy, so the sorts below never touch the shared table
+        odds = table.copy(deep=False)
+        if self.ev_type == 'both' and ev_type != 'both':
+            if ev_type == 'pinnacle':
+                odds = odds.loc[odds['fair_win_dec_pinnacle'].notna()]
+            other = '_pinnacle' if ev_type == 'avg' else '_avg'
+            odds = odds.drop(columns=[field for field in odds.columns if field.endswith(other)])
+        odds = filter_ev(odds, pref_ev_filter, sports, markets, days_from_now, books, min_odds, max_odds, max_width, max_vig_pct, min_ev_pct, min_num_books)
+        if top_k is not None:
+            odds = top_ev(odds, top_k, sortby, ascending, pref_ev_sort, per=top_per)
+        else:
+            odds = sort_ev(odds, sortby, ascending, pref_ev_sort)
+        if not expanded:
+            odds = cleanup_ev(odds, ev_type)
+        else:
+            odds = odds.drop(columns=CODE_FIELDS, errors='ignore')
+
+        if fields:
+            unknown = [field for field in fields if field not in odds.columns]
+            if unknown:
+                raise TypeError(f"parameter 'fields' has unknown fields: {unknown}")
+            odds = odds[fields]
+        return odds, warnings
+
+    # Describes the source, size and age of the table
+    def status(self):
+        source = {'filename': self.filename} if self.filename is not None else {'store': self.store} if self.store is not None else {'api': {'polls': self.scheduler.polls, 'requests_remaining': self.scheduler.remaining}}
+        return {**source, 'ev_type': self.ev_type, 'pid': os.getpid(), 'rows': len(self.table) if self.table is not None else None, 'refreshed_at': self.refreshed_at.isoformat() if self.refreshed_at is not None else None, 'refreshes': self.refreshes, 'error': self.error}
+
+    # Loads the table (except from the API, which fills it as it is polled) and starts the server and the background refresh
+    def start(self):
+        if self.scheduler is None:
+            self.refresh()
+        http_server = import_http_server()
+        handler = type('EVServiceHandler', (EVServiceHandler, http_server.BaseHTTPRequestHandler), {})
+        self.server = http_server.ThreadingHTTPServer((self.host, self.port), handler)
+        self.server.service = self
+        self.port = self.server.server_address[1]
+        for target in [self.server.serve_forever, self.run_refresh]:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    # Stops the server and the background refresh
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join(timeout=self.refresh_interval)
+
+    # Runs the service until it is interrupted (starts it unless it already runs, e.g. in a with block)
+    def serve(self):
+        if self.server is None:
+            self.start()
+        try:
+            self.threads[0].join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, error_type, error, traceback):
+        self.stop()
+
+# Answers the HTTP requests of an EVService (the service is the server's service attribute)
+# EVService.start() mixes it into http.server's BaseHTTPRequestHandler, so importing this module doesn't import http.server
+class EVServiceHandler:
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/ev':
+            self.answer_query(url.query)
+        elif url.path == '/status':
+            self.send_json(200, self.server.service.status())
+        else:
+            self.send_json(404, {'error': f'unknown path {url.path}'})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/refresh':
+            try:
+                refreshed = self.server.service.refresh()
+            except Exception as error:
+                self.send_json(500, {'error': f'refreshing the ev table failed: {error!r}'})
+                return
+            self.send_json(200, {'refreshed': refreshed, **self.server.service.status()})
+        else:
+            self.send_json(404, {'error': f'unknown path {url.path}'})
+
+    # Runs a query against the table and sends the result as JSON (columns and rows) or as an Arrow IPC stream
+    def answer_query(self, query_string):
+        service = self.server.service
+        start = time.perf_counter()
+        try:
+            params = service_parameters(query_string)
+            response_format = params.pop('format', 'json')
+            if response_format not in ['json', 'arrow']:
+                raise TypeError("parameter 'format' must be 'json' or 'arrow'")
+            odds, warnings = service.query(**params)
+            refreshed_at = service.refreshed_at.isoformat()
+            if response_format == 'arrow':
+                body = to_ipc(odds)
+            else:
+                # to_json() writes the columns and rows, the metadata goes in front of them
+                body = (json.dumps({'refreshed_at': refreshed_at, 'warnings': warnings, 'rows': len(odds)})[:-1] + ', ' + odds.to_json(orient='split', index=False, date_format='iso')[1:]).encode()
+        except TypeError as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        except RuntimeError as error:
+            self.send_json(503, {'error': str(error)})
+            return
+        # Any other error is the service's fault, the client still gets an answer
+        except Exception as error:
+            self.send_json(500, {'error': f'the query failed: {error!r}'})
+            return
 
-        odds = odds[fields_keep]
-        odds = odds.round(2)
-        return odds
+        if response_format == 'arrow':
+            self.send(200, 'application/vnd.apache.arrow.stream', body, {'X-Refreshed-At': refreshed_at, 'X-Warnings': json.dumps(warnings)})
+        else:
+            self.send(200, 'application/json', body)
+        if service.telemetry is not None:
+            service.telemetry.emit('request', path='/ev', format=response_format, rows=len(odds), seconds=time.perf_counter() - start)
+
+    def send_json(self, status, value):
+        self.send(status, 'application/json', json.dumps(value).encode())
+
+    def send(self, status, content_type, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Requests are reported through the service's telemetry instead of stderr
+    def log_message(self, format, *args):
+        pass
 
+# Main function
+# Takes an Odds API key or filename as well as a variety of optional parameters to calculate expected value (EV) percentage(s) and filter and sort the betting odds of upcoming sporting events
+def data(api_key: Optional[str]=None, sports: Optional[list[str]]=None, regions: Optional[list[str]]=['us', 'eu', 'uk', 'au'], markets: Optional[list[str]]=['h2h', 'spreads', 'totals'], ev_type: Optional[str]='both', recommended: Optional[bool]=False, days_from_now: Optional[Union[int, float]]=None, books: Optional[list[str]]=None, min_odds: Optional[Union[int, float]]=None, max_odds: Optional[Union[int, float]]=None, max_width: Optional[Union[int, float]]=None, max_vig_pct: Optional[Union[int, float]]=None, min_ev_pct: Optional[Union[int, float]]=None, min_num_books: Optional[Union[int, float]]=None, pref_ev_filter: Optional[str]='both', sortby: Optional[str]='default', ascending: Optional[bool]=False, pref_ev_sort: Optional[str]='avg', expanded: Optional[bool]=False, filename: Optional[str]=None, max_workers: Optional[int]=8, cache: Optional[Union[str, ResponseCache]]=None, chunk_size: Optional[int]=1000, store: Optional[str]=None, telemetry: Optional[Union[Telemetry, str, logging.Logger, Callable]]=None, top_k: Optional[int]=None, top_per: Optional[str]=None, processes: Optional[int]=None, shard_by: Optional[str]='event', devig: Optional[str]='multiplicative', consensus_weights: Optional[dict[str, Union[int, float]]]=None, dry_run: Optional[bool]=False, narrow_pull: Optional[bool]=False) -> pandas.DataFrame:
 
     ########################################################################################################################################
     # 
@@ -392,13 +2610,28 @@ def data(api_key: Optional[str]=None, sports: Optional[list[str]]=None, regions:
     # 
     ########################################################################################################################################
 
+    telemetry = as_telemetry(telemetry)
+    start = time.perf_counter()
+
     # Check inputs for api call and/or filename
-    if api_key is None and filename is None:
-        raise SystemExit("Error: API key or filename must be specified\n")
+    if api_key is None and filename is None and store is None:
+        raise SystemExit("Error: API key, filename or store must be specified\n")
+
+    if type(max_workers) != int or max_workers < 1:
+        warn("parameter 'max_workers' must be an integer >= 1. Value defaults to 8", telemetry)
+        max_workers = 8
+
+    # One pooled session is shared by every API request of this call
+    session = odds_session(max_workers=max_workers) if api_key is not None else None
+
+    if cache is not None and not isinstance(cache, ResponseCache):
+        if type(cache) != str:
+            raise TypeError("parameter 'cache' must be a directory path, a ResponseCache or None value\n")
+        cache = ResponseCache(cache)
 
     if sports is None:
-        if filename is None and api_key is not None:
-            sports = get_sports(api_key=api_key)
+        if filename is None and store is None and api_key is not None:
+            sports = get_sports(api_key=api_key, session=session, cache=cache)
     elif sports is not None and (type(sports) != list or len(sports) == 0):
         raise TypeError("parameter 'sports' must be a list of valid sport IDs or None value. Refer to documentation for information on valid sport IDs\n")
 
@@ -421,83 +2654,68 @@ def data(api_key: Optional[str]=None, sports: Optional[list[str]]=None, regions:
     ev_types = ['avg', 'pinnacle', 'both']
     if ev_type not in ev_types:
         raise SystemExit("Error: ev_type must be one of: 'avg', 'pinnacle', 'both' or be left blank")
-    
-    # Get ev data frame
-    if filename is not None:
-        df = file_to_ev(filename=filename, ev_type=ev_type)
-    else:
-        df = api_to_ev(api_key=api_key, sports=sports, regions=regions, markets=markets, ev_type=ev_type)
 
+    if type(chunk_size) != int or chunk_size < 1:
+        warn("parameter 'chunk_size' must be an integer >= 1. Value defaults to 1000", telemetry)
+        chunk_size = 1000
+    
     # If recommended is on, reassign everything to values to give recommended bets (except books because a user should still be able to customize which books are displayed)
     if type(recommended) != bool:
-        print("parameter 'recommended' must be a boolean. Default value is false")
+        warn("parameter 'recommended' must be a boolean. Default value is false", telemetry)
         recommended = False
     if recommended:
-        days_from_now = 2
-        min_odds = -200
-        max_odds = 200
-        max_width = 45
-        min_ev_pct = 1
-        min_num_books = 4
-        pref_ev_filter = 'both'
-        sortby = 'ev_pct'
-        ascending = False
-        pref_ev_sort = 'avg'
-        expanded = False
+        days_from_now, min_odds, max_odds, max_width, min_ev_pct, min_num_books, pref_ev_filter, sortby, ascending, pref_ev_sort, expanded = RECOMMENDED.values()
 
     # Check inputs for filter
     if days_from_now is not None and (type(days_from_now) != int or days_from_now < 0):
         if type(days_from_now) == float:
             days_from_now = int(days_from_now)
         else:
-            print("parameter 'days_from_now' must be an integer >= 0. Filter parameter ignored")
+            warn("parameter 'days_from_now' must be an integer >= 0. Filter parameter ignored", telemetry)
             days_from_now = None
 
     if books is not None:
         if type(books) != list:
-            print("parameter 'books' must be a list of valid book keys. Refer to documentation for information on valid books. Filter parameter ignored")
+            warn("parameter 'books' must be a list of valid book keys. Refer to documentation for information on valid books. Filter parameter ignored", telemetry)
+            books = None
+        elif len(books) == 0:
+            books = None
+        elif any(type(book) != str for book in books):
+            warn("parameter 'books' must be a list of valid book keys. Refer to documentation for information on valid books. Filter parameter ignored", telemetry)
             books = None
-        else:
-            book_list = df['book_key'].unique().tolist()
-            for book in list(books):
-                if book not in book_list:
-                    books.remove(book)
-                    print(f'{book} is not a valid book. Data filtered by other specified books')
-            if len(books) == 0:
-                books = None
 
     if min_odds is not None and type(min_odds) != int and type(min_odds) != float:
-        print("parameter 'min_odds' must be an integer or float. Filter parameter ignored")
+        warn("parameter 'min_odds' must be an integer or float. Filter parameter ignored", telemetry)
         min_odds = None
 
     if max_odds is not None and type(max_odds) != int and type(max_odds) != float:
-        print("parameter 'max_odds' must be an integer or float. Filter parameter ignored")
+        warn("parameter 'max_odds' must be an integer or float. Filter parameter ignored", telemetry)
         max_odds = None
 
     if max_width is not None and type(max_width) != int and type(max_width) != float:
-        print("parameter 'max_width' must be an integer or float. Filter parameter ignored")
+        warn("parameter 'max_width' must be an integer or float. Filter parameter ignored", telemetry)
         max_width = None
 
     if max_vig_pct is not None and type(max_vig_pct) != int and type(max_vig_pct) != float:
-        print("parameter 'max_vig_pct' must be an integer or float. Filter parameter ignored")
+        warn("parameter 'max_vig_pct' must be an integer or float. Filter parameter ignored", telemetry)
         max_vig_pct = None
 
     if min_ev_pct is not None and type(min_ev_pct) != int and type(min_ev_pct) != float:
-        print("parameter 'min_ev_pct' must be an integer or float. Filter parameter ignored")
+        warn("parameter 'min_ev_pct' must be an integer or float. Filter parameter ignored", telemetry)
         min_ev_pct = None
 
     if min_num_books is not None and type(min_num_books) != int and type(min_num_books) != float: 
-        print("parameter 'min_num_books' must be an integer or float. Filter parameter ignored")
+        warn("parameter 'min_num_books' must be an integer or float. Filter parameter ignored", telemetry)
         min_num_books = None
 
     if pref_ev_filter not in ev_types:
-        print("parameter 'pref_ev_filter' must be one of: 'avg', 'pinnacle', 'both' or be left blank. Value defaults to 'both'")
+        warn("parameter 'pref_ev_filter' must be one of: 'avg', 'pinnacle', 'both' or be left blank. Value defaults to 'both'", telemetry)
         pref_ev_filter = 'both'
     elif pref_ev_filter == 'avg' and ev_type == 'pinnacle':
-        print("parameter 'pref_ev_filter' cannot be 'avg' when parameter 'ev_type' is 'pinnacle'. Value defaults to 'pinnacle'")
+        warn("parameter 'pref_ev_filter' cannot be 'avg' when parameter 'ev_type' is 'pinnacle'. Value defaults to 'pinnacle'", telemetry)
         pref_ev_filter = 'pinnacle'
     elif pref_ev_filter == 'pinnacle' and 'ev_type' == 'avg':
-        print("parameter 'pref_ev_filter' cannot be 'pinnacle' when parameter 'ev_type' is 'avg'. Value defaults to 'avg'")
+        warn("parameter 'pref_ev_filter' cannot be 'pinnacle' when parameter 'ev_type' is 'avg'. Value defaults to 'avg'", telemetry)
         pref_ev_filter = 'avg'
 
     if ev_type == 'both':
@@ -506,36 +2724,74 @@ def data(api_key: Optional[str]=None, sports: Optional[list[str]]=None, regions:
     else:
         pref_ev_filter = ev_type
 
-    # Filter the df
-    df = filter_ev(df, pref_ev_filter, sports=sports, markets=markets, days_from_now=days_from_now, books=books, min_odds=min_odds, max_odds=max_odds, max_width=max_width, max_vig_pct=max_vig_pct, min_ev_pct=min_ev_pct, min_num_books=min_num_books)
-
     # Check inputs for sorting
     sort_options = ['commence_time', 'line', 'width', 'ev_pct', 'kelly_pct', 'default']
     if type(sortby) != str and sortby not in sort_options:
-        print("parameter 'sortby' invalid. Refer to documentation for valid 'sortby' values. Filter parameter ignored")
+        warn("parameter 'sortby' invalid. Refer to documentation for valid 'sortby' values. Filter parameter ignored", telemetry)
         sortby = 'default'
 
     if ascending is not None and type(ascending) != bool:
-        print("parameter 'ascending' must be a boolean. Default value used")
+        warn("parameter 'ascending' must be a boolean. Default value used", telemetry)
         ascending = False
 
     if pref_ev_sort is not None and (pref_ev_sort not in ev_types or pref_ev_sort == 'both'):
-        print("parameter 'pref_ev_sort' must be 'avg' or 'pinnacle' or be left blank. Value defaults to 'avg'")
+        warn("parameter 'pref_ev_sort' must be 'avg' or 'pinnacle' or be left blank. Value defaults to 'avg'", telemetry)
         pref_ev_sort = 'avg'
     elif pref_ev_sort == 'avg' and ev_type == 'pinnacle':
-        print("parameter 'pref_ev_sort' cannot be 'avg' when parameter 'ev_type' is 'pinnacle'. Value defaults to 'pinnacle'")
+        warn("parameter 'pref_ev_sort' cannot be 'avg' when parameter 'ev_type' is 'pinnacle'. Value defaults to 'pinnacle'", telemetry)
         pref_ev_sort = 'pinnacle'
     elif pref_ev_sort == 'pinnacle' and 'ev_type' == 'avg':
-        print("parameter 'pref_ev_sort' cannot be 'pinnacle' when parameter 'ev_type' is 'avg'. Value defaults to 'avg'")
+        warn("parameter 'pref_ev_sort' cannot be 'pinnacle' when parameter 'ev_type' is 'avg'. Value defaults to 'avg'", telemetry)
         pref_ev_sort = 'avg'
     
-    # Sort the df
-    df = sort_ev(df, sortby=sortby, ascending=ascending, pref_ev_sort=pref_ev_sort)
+    if top_k is not None and (type(top_k) != int or top_k < 1):
+        warn("parameter 'top_k' must be an integer >= 1. Parameter ignored", telemetry)
+        top_k = None
+
+    if top_per is not None and top_per not in ['sport', 'event']:
+        warn("parameter 'top_per' must be 'sport', 'event' or be left blank. Parameter ignored", telemetry)
+        top_per = None
+
+    if processes is not None and (type(processes) != int or processes < 1):
+        warn("parameter 'processes' must be an integer >= 1. Parameter ignored", telemetry)
+        processes = None
+
+    if shard_by not in ['event', 'sport']:
+        warn("parameter 'shard_by' must be 'event' or 'sport'. Value defaults to 'event'", telemetry)
+        shard_by = 'event'
+
+    if devig not in DEVIG_METHODS:
+        warn("parameter 'devig' must be one of: 'multiplicative', 'power', 'shin'. Value defaults to 'multiplicative'", telemetry)
+        devig = 'multiplicative'
+
+    if consensus_weights is not None and (type(consensus_weights) != dict or len(consensus_weights) == 0 or any(type(weight) not in [int, float] or weight < 0 for weight in consensus_weights.values()) or sum(consensus_weights.values()) <= 0):
+        warn("parameter 'consensus_weights' must be a dictionary of book keys and weights >= 0 that aren't all 0. Parameter ignored", telemetry)
+        consensus_weights = None
+
+    if type(dry_run) != bool:
+        warn("parameter 'dry_run' must be a boolean. Value defaults to false", telemetry)
+        dry_run = False
+
+    if type(narrow_pull) != bool:
+        warn("parameter 'narrow_pull' must be a boolean. Value defaults to false", telemetry)
+        narrow_pull = False
 
     # If expanded is false, simplify the df
     if type(expanded) != bool:
-        print("parameter 'expanded' must be a boolean. Value defaults to false.")
-    if not expanded:
-        df = cleanup_ev(df, ev_type=ev_type)
+        warn("parameter 'expanded' must be a boolean. Value defaults to false.", telemetry)
+
+    # Pull and calculate only what the filters need (unless expanded is true, the df is simplified at the end)
+    query = Query(api_key=api_key, filename=filename, store=store, sports=sports, regions=regions, markets=markets, ev_type=ev_type, expanded=expanded, max_workers=max_workers, cache=cache, chunk_size=chunk_size, session=session, telemetry=telemetry, processes=processes, shard_by=shard_by, devig=devig, consensus_weights=consensus_weights, narrow_pull=narrow_pull)
+    query.filter(pref_ev_filter=pref_ev_filter, days_from_now=days_from_now, books=books, min_odds=min_odds, max_odds=max_odds, max_width=max_width, max_vig_pct=max_vig_pct, min_ev_pct=min_ev_pct, min_num_books=min_num_books)
+    query.sort(sortby=sortby, ascending=ascending, pref_ev_sort=pref_ev_sort, top_k=top_k, top_per=top_per)
+
+    # Return the planned API requests and their quota cost without pulling any odds
+    if dry_run:
+        return query.requests(query.commence_to())
+
+    df = query.collect()
+
+    if telemetry is not None:
+        telemetry.emit('stage', stage='data', seconds=time.perf_counter() - start, rows=len(df))
 
     return df
\ No newline at end of file
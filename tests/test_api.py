@@ -0,0 +1,84 @@
+import json
+import threading
+import collections
+import http.server
+import urllib.parse
+
+import pytest
+
+import ev
+import synthetic
+
+SPORTS = ['americanfootball_nfl', 'basketball_nba', 'baseball_mlb', 'icehockey_nhl', 'soccer_epl']
+
+# A stub of the Odds API whose every path first answers 429, then 503, then 200 with the events of its sport
+class StubAPI(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        with self.server.lock:
+            self.server.requests[url.path] += 1
+            attempt = self.server.requests[url.path]
+        if attempt == 1:
+            self.answer(429, {'message': 'too many requests'}, {'Retry-After': '0'})
+        elif attempt == 2:
+            self.answer(503, {'message': 'unavailable'})
+        elif url.path == '/v4/sports':
+            self.answer(200, [{'key': sport, 'active': True, 'has_outrights': False} for sport in SPORTS] + [{'key': 'golf_masters_tournament_winner', 'active': True, 'has_outrights': True}])
+        else:
+            sport = url.path.split('/')[3]
+            self.answer(200, [event for event in self.server.events if event['sport_key'] == sport], {'x-requests-remaining': '100', 'x-requests-used': str(sum(self.server.requests.values()))})
+
+    def answer(self, status, value, headers={}):
+        body = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, header in headers.items():
+            self.send_header(name, header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def stub():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubAPI)
+    server.lock = threading.Lock()
+    server.requests = collections.Counter()
+    server.events = synthetic.snapshot(num_events=20, num_books=3)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+# Every sport is retried past its 429 and 503 and collected, in the order of the sports
+def test_retries_and_gathers_every_sport(stub):
+    base_url = f'http://127.0.0.1:{stub.server_address[1]}/v4'
+    events = []
+    odds_json = ev.api_to_json('key', base_url=base_url, backoff=0.01, max_workers=4, telemetry=ev.Telemetry(events.append))
+    expected = [event for sport in SPORTS for event in stub.events if event['sport_key'] == sport]
+    assert odds_json == expected
+    assert stub.requests == {'/v4/sports': 3, **{f'/v4/sports/{sport}/odds': 3 for sport in SPORTS}}
+    statuses = collections.Counter(event['status'] for event in events if event['event'] == 'http')
+    assert statuses == {429: 6, 503: 6, 200: 6}
+
+# A request that keeps failing gives up after max_retries retries
+def test_gives_up_after_max_retries(stub):
+    base_url = f'http://127.0.0.1:{stub.server_address[1]}/v4'
+    assert ev.api_to_json('key', sports=SPORTS[:2], base_url=base_url, backoff=0.01, max_retries=1) == []
+    assert stub.requests == {f'/v4/sports/{sport}/odds': 2 for sport in SPORTS[:2]}
+
+# Failed requests and the quota are printed without telemetry, and only sent as events with it
+def test_failures_go_to_telemetry_instead_of_stdout(stub, capsys):
+    base_url = f'http://127.0.0.1:{stub.server_address[1]}/v4'
+    ev.api_to_json('key', sports=SPORTS[:1], base_url=base_url, backoff=0.01, max_retries=0)
+    assert 'Failed to get odds for americanfootball_nfl: status_code 429' in capsys.readouterr().out
+
+    events = []
+    ev.api_to_json('key', sports=SPORTS[:1], base_url=base_url, backoff=0.01, max_retries=0, telemetry=ev.Telemetry(events.append))
+    ev.api_to_json('key', sports=SPORTS[:1], base_url=base_url, backoff=0.01, max_retries=0, telemetry=ev.Telemetry(events.append))
+    assert capsys.readouterr().out == ''
+    assert [event['message'].split(' response body')[0] for event in events if event['event'] == 'warning'] == ['Failed to get odds for americanfootball_nfl: status_code 503,']
+    assert [event.get('requests_remaining') for event in events if event['event'] == 'quota'] == [None, 100]
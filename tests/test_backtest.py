@@ -0,0 +1,46 @@
+import json
+
+import numpy
+import pytest
+
+import ev
+
+# Prices of the home and away side of every book in the two snapshots
+PRICES = [
+    {'pinnacle': (-110, -110), 'fanduel': (120, -140), 'draftkings': (-105, -115)},
+    {'pinnacle': (-120, 100), 'fanduel': (150, -170), 'draftkings': (-110, -110)},
+]
+CAPTURES = ['2030-01-01T12:00:00Z', '2030-01-02T12:00:00Z']
+
+def decimal(price):
+    return 1 + (price / 100 if price > 0 else 100 / -price)
+
+# Writes one snapshot of a single h2h event per capture time, the event starts after both
+@pytest.fixture
+def directory(tmp_path):
+    for i, (prices, capture) in enumerate(zip(PRICES, CAPTURES)):
+        bookmakers = [{'key': book, 'title': book.title(), 'last_update': capture, 'markets': [{'key': 'h2h', 'last_update': capture, 'outcomes': [{'name': 'Home', 'price': home}, {'name': 'Away', 'price': away}]}]} for book, (home, away) in prices.items()]
+        event = {'id': 'e1', 'sport_key': 'basketball_nba', 'sport_title': 'NBA', 'commence_time': '2030-01-03T00:00:00Z', 'home_team': 'Home', 'away_team': 'Away', 'bookmakers': bookmakers}
+        (tmp_path / f'snapshot_{i}.json').write_text(json.dumps([event]))
+    return str(tmp_path)
+
+def test_bets_and_closing_line_value(directory):
+    report = ev.backtest(directory, grid={'min_odds': [None, 130], 'pref_ev_filter': ['avg']}, max_workers=1)
+
+    # Without a filter every line is a bet in the first snapshot, judged against its price in the second
+    every_line = report.loc[report['min_odds'].isna()].iloc[0]
+    clv = [decimal(first[side]) / decimal(PRICES[1][book][side]) - 1 for book, first in PRICES[0].items() for side in [0, 1]]
+    assert every_line['num_bets'] == 6
+    assert every_line['clv_pct'] == pytest.approx(numpy.mean(clv) * 100)
+
+    # With min_odds 130 only fanduel's home line passes, in the closing snapshot, so it has no closing line value
+    longshots = report.loc[report['min_odds'] == 130].iloc[0]
+    assert longshots['num_bets'] == 1
+    assert longshots['clv_pct'] == pytest.approx(0)
+
+# The closing line is the last snapshot's however the snapshots are named
+def test_closing_line_is_the_last_snapshot(directory, tmp_path):
+    (tmp_path / 'snapshot_0.json').rename(tmp_path / 'z.json')
+    report = ev.backtest(directory, grid={'min_odds': [None], 'pref_ev_filter': ['avg']}, max_workers=1)
+    clv = [decimal(first[side]) / decimal(PRICES[1][book][side]) - 1 for book, first in PRICES[0].items() for side in [0, 1]]
+    assert report['clv_pct'].iloc[0] == pytest.approx(numpy.mean(clv) * 100)
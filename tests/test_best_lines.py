@@ -0,0 +1,81 @@
+import pytest
+
+import ev
+
+UPDATE = '2030-01-01T00:00:00Z'
+
+# Returns one bookmaker of the event with its h2h line and a spread of point for the home team
+def bookmaker(key, home, away, point):
+    markets = [
+        {'key': 'h2h', 'last_update': UPDATE, 'outcomes': [{'name': 'Home', 'price': home}, {'name': 'Away', 'price': away}]},
+        {'key': 'spreads', 'last_update': UPDATE, 'outcomes': [{'name': 'Home', 'price': -110, 'point': point}, {'name': 'Away', 'price': -110, 'point': -point}]},
+    ]
+    return {'key': key, 'title': key.title(), 'last_update': UPDATE, 'markets': markets}
+
+# Returns the processed lines of one event offered by bookmakers
+def book_odds(*bookmakers):
+    event = {'id': 'e1', 'sport_key': 'basketball_nba', 'sport_title': 'NBA', 'commence_time': '2030-01-02T00:00:00Z', 'home_team': 'Home', 'away_team': 'Away', 'bookmakers': list(bookmakers)}
+    return ev.processed_data(ev.flattened_data([event]))
+
+# Returns the best line of a position of the event
+def best_line(lines, market, position):
+    return lines.loc[(lines['market'] == market) & (lines['position'] == position)].iloc[0]
+
+def decimal(price):
+    return 1 + (price / 100 if price > 0 else 100 / -price)
+
+# fanduel has the best home price and draftkings the best away price, together they cost less than they pay out
+# fanduel's home -2.5 and draftkings' away +3.5 overlap, so a home win by exactly 3 wins both
+FANDUEL = bookmaker('fanduel', 110, -120, -2.5)
+DRAFTKINGS = bookmaker('draftkings', -130, 115, -3.5)
+
+@pytest.fixture
+def index():
+    return ev.BestLineIndex(book_odds(FANDUEL, DRAFTKINGS))
+
+def test_best_lines(index):
+    lines = index.best_lines()
+    assert best_line(lines, 'h2h', 'Home')['book_key'] == 'fanduel'
+    assert best_line(lines, 'h2h', 'Away')['book_key'] == 'draftkings'
+    assert best_line(lines, 'h2h', 'Away')['decimal'] == pytest.approx(decimal(115))
+    assert lines.groupby('market')['num_books'].max().to_dict() == {'h2h': 2, 'spreads': 1}
+
+def test_two_way_arbitrage(index):
+    legs = index.arbitrage()
+    implied_sum = 1 / decimal(110) + 1 / decimal(115)
+    assert legs[['market', 'position', 'book_key']].values.tolist() == [['h2h', 'Home', 'fanduel'], ['h2h', 'Away', 'draftkings']]
+    assert (legs['opportunity'] == 0).all()
+    assert legs['profit_pct'].tolist() == pytest.approx([(1 / implied_sum - 1) * 100] * 2)
+    assert legs['stake_pct'].tolist() == pytest.approx([100 / decimal(110) / implied_sum, 100 / decimal(115) / implied_sum])
+    assert index.arbitrage(min_profit_pct=10).empty
+
+def test_overlapping_spread_middle(index):
+    legs = index.middles()
+    assert legs[['position', 'point', 'book_key']].values.tolist() == [['Home', -2.5, 'fanduel'], ['Away', 3.5, 'draftkings']]
+    assert legs['middle_from'].tolist() == [2.5, 2.5]
+    assert legs['middle_to'].tolist() == [3.5, 3.5]
+    assert legs['profit_pct'].tolist() == pytest.approx([(decimal(-110) / 2 - 1) * 100] * 2)
+    assert legs['middle_profit_pct'].tolist() == pytest.approx([(decimal(-110) - 1) * 100] * 2)
+    assert index.middles(min_profit_pct=0).empty
+
+# Removing a book's markets drops the opportunities it was part of, and gives the same index as building it without them
+def test_incremental_removal(index):
+    index.update(book_odds(FANDUEL).iloc[:0], removed=[('e1', 'draftkings', 'h2h'), ('e1', 'draftkings', 'spreads')])
+    assert index.arbitrage().empty
+    assert index.middles().empty
+    lines = index.best_lines()
+    assert set(lines['book_key']) == {'fanduel'}
+    assert len(lines) == 4
+    rebuilt = ev.BestLineIndex(book_odds(FANDUEL)).best_lines()
+    assert lines.sort_values(['market', 'position']).reset_index(drop=True).equals(rebuilt.sort_values(['market', 'position']).reset_index(drop=True))
+
+    # Removing the last book of a market removes its positions
+    index.update(book_odds(FANDUEL).iloc[:0], removed=[('e1', 'fanduel', 'spreads')])
+    assert index.best_lines()['market'].tolist() == ['h2h', 'h2h']
+
+# A changed line replaces the book's earlier line of the same market
+def test_changed_line(index):
+    index.update(book_odds(bookmaker('draftkings', -130, -150, -3.5)).query("market == 'h2h'"))
+    assert index.arbitrage().empty
+    assert best_line(index.best_lines(), 'h2h', 'Away')['book_key'] == 'fanduel'
+    assert len(index.middles()) == 2
@@ -0,0 +1,13 @@
+import pytest
+
+import cli
+
+# --top-k below 1 is rejected by the parser, whether the query would run on the worker or in this process
+@pytest.mark.parametrize('value', ['0', '-1', 'two'])
+def test_top_k_must_be_positive(value, capsys):
+    with pytest.raises(SystemExit):
+        cli.parser().parse_args(['query', '--filename', 'odds.json', '--top-k', value])
+    assert "--top-k: must be an integer >= 1" in capsys.readouterr().err
+
+def test_top_k():
+    assert cli.parser().parse_args(['query', '--filename', 'odds.json', '--top-k', '3']).top_k == 3
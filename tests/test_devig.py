@@ -0,0 +1,105 @@
+import numpy
+import pandas
+import pytest
+
+import ev
+import synthetic
+
+# Fair probabilities of one market by plain bisection, the reference for the vectorized solvers
+def scalar_devig(probs, method):
+    probs = numpy.array(probs, dtype=numpy.float64)
+    total = probs.sum()
+    if method == 'power':
+        # sum(p^k) falls as k grows
+        fair, lo, hi = lambda k: probs**k, 0.0, 1.0
+        while fair(hi).sum() > 1:
+            hi *= 2
+    else:
+        # sum(p_i(z)) falls as z grows
+        fair = lambda z: (numpy.sqrt(z**2 + 4*(1 - z)*probs**2/total) - z)/(2*(1 - z))
+        lo, hi = 0.0, 1.0 - 1e-15
+    for _ in range(200):
+        middle = (lo + hi)/2
+        if fair(middle).sum() > 1:
+            lo = middle
+        else:
+            hi = middle
+    return fair((lo + hi)/2)
+
+# De-vigs a list of markets (lists of implied win probabilities) at once, returns the fair probabilities per market
+def devig(markets, method):
+    vig_win_dec = numpy.array([prob for market in markets for prob in market], dtype=numpy.float64)
+    market_code = numpy.repeat(numpy.arange(len(markets)), [len(market) for market in markets])
+    fair = ev.devig_probabilities(vig_win_dec, market_code, len(markets), method)
+    return numpy.split(fair, numpy.cumsum([len(market) for market in markets])[:-1])
+
+MARKETS = [
+    [0.5238, 0.5238],
+    [0.6, 0.45],
+    [0.35, 0.33, 0.37],
+    [0.92, 0.12],
+    [0.985, 0.03],
+    [0.995, 0.0099, 0.0099],
+    [0.4, 0.3, 0.2, 0.1, 0.08, 0.02],
+]
+
+@pytest.mark.parametrize('method', ['power', 'shin'])
+def test_sums_to_one(method):
+    for market, fair in zip(MARKETS, devig(MARKETS, method)):
+        assert fair.sum() == pytest.approx(1, abs=1e-10)
+        assert (fair > 0).all() and (fair < 1).all()
+
+# The vectorized solvers match a scalar bisection, including heavily lopsided markets
+@pytest.mark.parametrize('method', ['power', 'shin'])
+def test_matches_scalar_bisection(method):
+    for market, fair in zip(MARKETS, devig(MARKETS, method)):
+        assert fair == pytest.approx(scalar_devig(market, method), abs=1e-9)
+
+# Power and shin both take more of the vig off the longshot than multiplicative does
+@pytest.mark.parametrize('method', ['power', 'shin'])
+def test_longshot_bias(method):
+    favorite, longshot = devig([[0.92, 0.12]], method)[0]
+    assert favorite > 0.92/1.04
+    assert longshot < 0.12/1.04
+
+@pytest.mark.parametrize('method', ['multiplicative', 'power', 'shin'])
+def test_no_vig_unchanged(method):
+    markets = [[0.5, 0.5], [0.25, 0.75], [0.2, 0.3, 0.5]]
+    for market, fair in zip(markets, devig(markets, method)):
+        assert fair == pytest.approx(market, abs=1e-12)
+
+# A single-outcome market has nothing to solve, it is de-vigged multiplicatively
+@pytest.mark.parametrize('method', ['power', 'shin'])
+def test_single_outcome(method):
+    fair = devig([[0.8], [0.6, 0.45]], method)
+    assert fair[0] == pytest.approx([1])
+    assert fair[1].sum() == pytest.approx(1, abs=1e-10)
+
+@pytest.mark.parametrize('method', ['power', 'shin'])
+def test_no_markets(method):
+    assert len(ev.devig_probabilities(numpy.zeros(0), numpy.zeros(0, dtype=numpy.int64), 0, method)) == 0
+
+# Every market of a whole snapshot converges within the solver's tolerance
+@pytest.mark.parametrize('method', ['power', 'shin'])
+def test_snapshot_converges(method):
+    book_odds = ev.processed_data(ev.flattened_data(synthetic.snapshot(num_events=200, num_books=10)), method)
+    sums = book_odds.groupby('market_code', observed=True)['fair_win_dec'].sum()
+    assert numpy.abs(sums - 1).max() < 1e-10
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        devig([[0.6, 0.45]], 'additive')
+
+# Unlisted books weigh the 'default' weight, and are left out without one
+def test_consensus_default_weight():
+    book_keys = pandas.Series(['pinnacle', 'fanduel', 'draftkings', 'pinnacle'])
+    assert ev.book_weights(book_keys, {'pinnacle': 3}).tolist() == [3, 0, 0, 3]
+    assert ev.book_weights(book_keys, {'pinnacle': 3, 'default': 1}).tolist() == [3, 1, 1, 3]
+    assert ev.book_weights(book_keys, {'pinnacle': 3, 'fanduel': 2, 'default': 0.5}).tolist() == [3, 2, 0.5, 3]
+
+# Equal weights for every book are the plain average
+def test_consensus_equal_weights():
+    book_odds = ev.processed_data(ev.flattened_data(synthetic.snapshot(num_events=20, num_books=6)))
+    plain = ev.ev_data(book_odds)
+    weighted = ev.ev_data(book_odds, consensus_weights={'default': 2})
+    assert numpy.allclose(plain['fair_win_dec_avg'], weighted['fair_win_dec_avg'])
@@ -0,0 +1,20 @@
+import os
+
+import pandas
+import pytest
+
+import ev
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+KEY = ['id', 'book_key', 'market', 'position']
+
+# The reference files were written by the merge-based data() of the first release on tests/data/snapshot.json
+# (Pinnacle has no totals for the first event and no odds at all for the second)
+@pytest.mark.parametrize('ev_type', ['avg', 'pinnacle', 'both'])
+def test_matches_merge_based_reference(ev_type):
+    reference = pandas.read_csv(os.path.join(DATA, f'reference_{ev_type}.csv'), dtype={field: str for field in KEY})
+    odds = ev.data(filename=os.path.join(DATA, 'snapshot.json'), ev_type=ev_type, pref_ev_sort='pinnacle' if ev_type == 'pinnacle' else 'avg', expanded=True)
+    odds = odds[list(reference.columns)].astype({field: str for field in KEY}).sort_values(KEY).reset_index(drop=True)
+    odds = odds.astype({field: 'float64' for field in reference.columns if field not in KEY})
+    reference = reference.astype({field: 'float64' for field in reference.columns if field not in KEY})
+    pandas.testing.assert_frame_equal(odds, reference.sort_values(KEY).reset_index(drop=True), check_exact=False, rtol=1e-8, atol=1e-8)
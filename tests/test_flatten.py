@@ -0,0 +1,49 @@
+import json
+
+import numpy
+import pandas
+import pytest
+
+import ev
+import synthetic
+
+FIELDS = ['id', 'sport_key', 'sport_title', 'commence_time', 'home_team', 'away_team', 'book_key', 'book_title', 'last_update', 'market', 'position', 'line', 'point']
+KEY = ['id', 'book_key', 'market', 'position']
+
+# Returns the rows of a flattener in a comparable form: the API's strings and times, sorted by their key
+def comparable(df):
+    df = df[FIELDS].copy()
+    for field in FIELDS:
+        if isinstance(df[field].dtype, pandas.DatetimeTZDtype):
+            df[field] = df[field].dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+        elif field not in ['line', 'point']:
+            df[field] = df[field].astype(str)
+    return df.astype({'line': numpy.int64}).sort_values(KEY).reset_index(drop=True)
+
+# A snapshot with 2 and 3 way markets, spreads and totals, a book without one of the markets and an event without any books
+def snapshot():
+    events = synthetic.snapshot(num_events=30, num_books=6, market_updates=False)
+    events[0]['bookmakers'][1]['markets'] = events[0]['bookmakers'][1]['markets'][:2]
+    events[1]['bookmakers'] = []
+    return events
+
+def test_same_rows_as_unpacked_data():
+    odds_json = snapshot()
+    pandas.testing.assert_frame_equal(comparable(ev.flattened_data(odds_json)), comparable(ev.unpacked_data(pandas.DataFrame(odds_json))))
+
+# The processed fields are the same whether they are calculated from either flattener's rows
+def test_same_processed_fields():
+    odds_json = snapshot()
+    flattened = ev.processed_data(ev.flattened_data(odds_json)).sort_values(KEY).reset_index(drop=True)
+    unpacked = ev.processed_data(ev.unpacked_data(pandas.DataFrame(odds_json))).sort_values(KEY).reset_index(drop=True)
+    fields = ['num_outcomes', 'width', 'num_books', 'fair_win_dec', 'fair_line', 'vig_pct']
+    pandas.testing.assert_frame_equal(flattened[fields].astype('float64'), unpacked[fields].astype('float64'))
+
+# Expanded output keeps every field, but not the internal group codes
+@pytest.mark.parametrize('processes', [None, 2])
+def test_expanded_has_no_codes(tmp_path, processes):
+    filename = tmp_path / 'odds.json'
+    filename.write_text(json.dumps(snapshot()))
+    odds = ev.data(filename=str(filename), expanded=True, processes=processes)
+    assert len(odds) > 0
+    assert not set(ev.CODE_FIELDS) & set(odds.columns)
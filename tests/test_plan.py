@@ -0,0 +1,32 @@
+import ev
+
+SPORTS = ['basketball_nba', 'icehockey_nhl']
+
+# Without narrow every book of the regions is pulled, so num_books counts all of them
+def test_not_narrowed_by_default():
+    plan = ev.plan_requests('key', sports=SPORTS, regions=['us', 'uk', 'au'], markets=['h2h'], ev_type='pinnacle', books=['fanduel'])
+    assert plan['request'].tolist() == ['odds', 'pinnacle'] * 2
+    assert plan['regions'].iloc[0] == 'us,uk,au'
+    assert plan['cost'].sum() == 2 * (3 + 1)
+
+def test_narrowed():
+    plan = ev.plan_requests('key', sports=SPORTS, regions=['us', 'uk', 'au'], markets=['h2h'], ev_type='pinnacle', books=['fanduel'], narrow=True)
+    assert plan['request'].tolist() == ['odds'] * 2
+    assert plan['bookmakers'].tolist() == ['fanduel,pinnacle'] * 2
+    assert plan['cost'].sum() == 2
+
+# A narrowed pull has to keep every book that an ev or a filter needs
+def test_needed_bookmakers():
+    assert ev.needed_bookmakers('pinnacle', ['fanduel'], None, None) == ['fanduel', 'pinnacle']
+    assert ev.needed_bookmakers('both', ['fanduel'], {'circasports': 2, 'lowvig': 0}, None) == ['circasports', 'fanduel', 'pinnacle']
+    assert ev.needed_bookmakers('avg', ['fanduel'], {'circasports': 2}, None) == ['circasports', 'fanduel']
+    assert ev.needed_bookmakers('both', ['fanduel'], None, None) is None
+    assert ev.needed_bookmakers('both', ['fanduel'], {'pinnacle': 3, 'default': 1}, None) is None
+    assert ev.needed_bookmakers('pinnacle', ['fanduel'], None, 4) is None
+    assert ev.needed_bookmakers('pinnacle', None, None, None) is None
+
+# Books are only sent as the bookmakers parameter when they look like bookmaker keys
+def test_needed_bookmakers_invalid_books():
+    assert ev.needed_bookmakers('pinnacle', ['fanduel', 'draft kings'], None, None) is None
+    assert ev.needed_bookmakers('pinnacle', ['fanduel&regions=eu'], None, None) is None
+    assert ev.needed_bookmakers('pinnacle', [3], None, None) is None
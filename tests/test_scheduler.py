@@ -0,0 +1,104 @@
+import random
+import datetime
+
+import pytest
+
+import ev
+
+DAY = 86400
+START = datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+SPORTS = ['basketball_nba', 'icehockey_nhl', 'baseball_mlb', 'soccer_epl']
+
+# A clock that only moves when the scheduler sleeps
+class FakeClock:
+    def __init__(self):
+        self.now = START
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+class FakeResponse:
+    def __init__(self, value, headers={}):
+        self.status_code = 200
+        self.value = value
+        self.headers = headers
+        self.text = ''
+
+    def json(self):
+        return self.value
+
+# A fake Odds API: every sport has an event every 6 hours, the events listing is free and every odds request costs regions x markets of a monthly quota
+class FakeAPI:
+    def __init__(self, clock, quota):
+        self.clock = clock
+        self.remaining = quota
+        self.used = 0
+        self.odds_requests = []
+        self.rng = random.Random(0)
+
+    def events(self, sport):
+        return [{'id': f'{sport}-{i}', 'sport_key': sport, 'commence_time': datetime.datetime.fromtimestamp(START + i * 6 * 3600, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')} for i in range(1, 4 * 40)]
+
+    def get(self, url, params, timeout):
+        sport = url.split('/')[-2]
+        events = [event for event in self.events(sport) if 0 <= datetime.datetime.fromisoformat(event['commence_time']).timestamp() - self.clock.now <= 3 * DAY]
+        if url.endswith('/events'):
+            return FakeResponse(events)
+        cost = len(params['regions'].split(',')) * len(params['markets'].split(','))
+        self.remaining -= cost
+        self.used += cost
+        self.odds_requests.append(self.clock.now)
+        odds = [{**event, 'bookmakers': [{'key': 'fanduel', 'markets': [{'key': 'h2h', 'outcomes': [{'name': 'Home', 'price': self.rng.choice([-110, -115])}, {'name': 'Away', 'price': -105}]}]}]} for event in events]
+        return FakeResponse(odds, {'x-requests-remaining': str(self.remaining), 'x-requests-used': str(self.used)})
+
+def scheduler(clock, api, **params):
+    return ev.PollScheduler('key', sports=SPORTS, regions=['us'], markets=['h2h'], session=api, clock=clock.time, sleep=clock.sleep, **params)
+
+# Returns the number of odds requests made in each day of the simulation
+def requests_per_day(api, days):
+    counts = [0] * days
+    for time in api.odds_requests:
+        counts[min(int((time - START) // DAY), days - 1)] += 1
+    return counts
+
+# The monthly quota lasts the whole quota period instead of being spent in the first few days
+def test_quota_lasts_the_quota_period():
+    clock = FakeClock()
+    api = FakeAPI(clock, quota=3000)
+    scheduler(clock, api).run(until=START + 30 * DAY)
+    per_day = requests_per_day(api, 30)
+    assert 2500 <= api.used <= 3000
+    assert sum(per_day[:3]) <= 2 * 3 * 3000 / 30
+    assert all(count > 0 for count in per_day)
+
+# A daily budget caps every day on top of the quota
+def test_daily_budget():
+    clock = FakeClock()
+    api = FakeAPI(clock, quota=100_000)
+    scheduler(clock, api, budget=50).run(until=START + 5 * DAY)
+    per_day = requests_per_day(api, 5)
+    assert all(40 <= count <= 50 for count in per_day)
+
+# Out of quota, polling stops until the quota period starts over instead of polling past 0
+def test_out_of_quota_waits_for_the_next_period():
+    clock = FakeClock()
+    api = FakeAPI(clock, quota=20)
+    poller = scheduler(clock, api, quota_period=DAY)
+    poller.run(until=START + DAY - 1)
+    assert api.used <= 20
+    api.remaining = 20
+    poller.run(until=START + 2 * DAY)
+    assert any(time >= START + DAY for time in api.odds_requests)
+
+# A sport is polled polls_to_start times before its event, more often when its lines move
+def test_interval():
+    clock = FakeClock()
+    poller = scheduler(clock, FakeAPI(clock, quota=1000), min_interval=1, max_interval=DAY, polls_to_start=24, volatility_weight=2)
+    state = {'next_commence': START + DAY, 'volatility': 0.0}
+    assert poller.interval(state) == pytest.approx(3600)
+    state['volatility'] = 0.5
+    assert poller.interval(state) == pytest.approx(1800)
+    assert poller.interval({'next_commence': None, 'volatility': 0.0}) == DAY
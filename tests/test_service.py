@@ -0,0 +1,128 @@
+import os
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import ev
+import synthetic
+
+# Sends a request to a running service, returns the status and the parsed JSON body
+def request(service, path, method='GET'):
+    try:
+        with urllib.request.urlopen(urllib.request.Request(f'http://127.0.0.1:{service.port}{path}', method=method), timeout=30) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+# Writes a snapshot of num_events events and moves its modification time forward, so the service sees every rewrite
+def write_snapshot(filename, num_events, mtime):
+    with open(filename, 'w') as file:
+        json.dump(synthetic.snapshot(num_events=num_events, num_books=6), file)
+    os.utime(filename, (mtime, mtime))
+
+@pytest.fixture
+def snapshot(tmp_path):
+    filename = str(tmp_path / 'odds.json')
+    write_snapshot(filename, 40, 1_000_000_000)
+    return filename
+
+# A service on an ephemeral port over the snapshot, which only refreshes when asked to
+@pytest.fixture
+def service(snapshot):
+    with ev.EVService(filename=snapshot, port=0, refresh_interval=3600) as service:
+        yield service
+
+# /ev returns the same rows as data() with the same parameters
+@pytest.mark.parametrize('params, query_string', [
+    ({}, ''),
+    ({'books': ['fanduel', 'draftkings'], 'min_ev_pct': 0, 'sortby': 'ev_pct'}, '?books=fanduel,draftkings&min_ev_pct=0&sortby=ev_pct'),
+    ({'sports': ['basketball_nba'], 'markets': ['h2h'], 'expanded': True}, '?sports=basketball_nba&markets=h2h&expanded=true'),
+    ({'sortby': 'ev_pct', 'top_k': 5}, '?sortby=ev_pct&top_k=5'),
+])
+def test_ev(service, snapshot, params, query_string):
+    status, body = request(service, '/ev' + query_string)
+    assert status == 200
+    expected = ev.data(filename=snapshot, **params)
+    assert body['columns'] == list(expected.columns)
+    assert body['rows'] == len(expected) == len(body['data'])
+    # Rows that tie on the sort key can come in another order
+    rows = lambda data: sorted(json.dumps(row) for row in data)
+    assert rows(body['data']) == rows(json.loads(expected.to_json(orient='split', index=False, date_format='iso'))['data'])
+
+def test_fields(service):
+    status, body = request(service, '/ev?fields=sport_title,book_title,ev_pct_avg')
+    assert status == 200
+    assert body['columns'] == ['sport_title', 'book_title', 'ev_pct_avg']
+
+def test_status(service, snapshot):
+    status, body = request(service, '/status')
+    assert status == 200
+    assert body['filename'] == snapshot
+    assert body['pid'] == os.getpid()
+    assert body['rows'] == len(service.table) > 0
+    assert body['refreshes'] == 1
+    assert body['error'] is None
+
+@pytest.mark.parametrize('query_string', ['?top_k=0', '?top_k=-1', '?top_k=two', '?sortby=odds', '?expanded=maybe', '?unknown=1', '?fields=nope', '?format=xml', '?ev_type=closing'])
+def test_bad_parameters(service, query_string):
+    status, body = request(service, '/ev' + query_string)
+    assert status == 400
+    assert body['error']
+
+def test_unknown_path(service):
+    assert request(service, '/nope')[0] == 404
+
+# An error the parameters didn't cause still gets an answer
+def test_query_error(service, monkeypatch):
+    def fail(**params):
+        raise ValueError('broken table')
+    monkeypatch.setattr(service, 'query', fail)
+    status, body = request(service, '/ev')
+    assert status == 500
+    assert 'broken table' in body['error']
+
+# The file is only reloaded when it changed
+def test_refresh(service, snapshot):
+    rows = request(service, '/status')[1]['rows']
+    status, body = request(service, '/refresh', method='POST')
+    assert status == 200 and not body['refreshed']
+
+    write_snapshot(snapshot, 80, 1_000_000_100)
+    status, body = request(service, '/refresh', method='POST')
+    assert status == 200 and body['refreshed']
+    assert body['refreshes'] == 2
+    assert body['rows'] > rows
+    assert request(service, '/ev')[1]['rows'] == len(ev.data(filename=snapshot))
+
+def test_refresh_error(service, snapshot):
+    os.remove(snapshot)
+    status, body = request(service, '/refresh', method='POST')
+    assert status == 500
+    assert request(service, '/status')[0] == 200
+
+# serve() inside a with block keeps the server the block started
+def test_serve_in_with_block(service):
+    errors = []
+    def serve():
+        try:
+            service.serve()
+        except Exception as error:
+            errors.append(error)
+    thread = threading.Thread(target=serve)
+    thread.start()
+    assert request(service, '/status')[0] == 200
+    service.stop()
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+    assert errors == []
+
+# A service polling the API with no sport to poll idles instead of failing on every refresh
+def test_api_service_without_sports():
+    events = []
+    with ev.EVService(api_key='key', sports=[], port=0, refresh_interval=0.01, telemetry=events.append) as service:
+        service.stopped.wait(0.2)
+        assert request(service, '/status')[1]['error'] is None
+    assert [event for event in events if event['event'] == 'warning'] == []
@@ -0,0 +1,73 @@
+import copy
+
+import numpy
+import pandas
+import pytest
+
+import ev
+import synthetic
+
+KEY = ['id', 'book_key', 'market', 'position']
+
+# Moves one book's prices of an event and its last_update, like a new poll of the API would
+def move_prices(event, book_index, shift, update):
+    bookmaker = event['bookmakers'][book_index]
+    bookmaker['last_update'] = update
+    for market in bookmaker['markets']:
+        market['last_update'] = update
+        for outcome in market['outcomes']:
+            outcome['price'] += shift if outcome['price'] > 0 else -shift
+
+# A stream of snapshots with changed prices, added and removed books, markets and events
+def snapshots():
+    first = synthetic.snapshot(num_events=30, num_books=8, seed=3)
+    extra = synthetic.snapshot(num_events=4, num_books=8, seed=4)
+    second = copy.deepcopy(first)
+    move_prices(second[0], 1, 7, '2030-01-01T00:00:00Z')
+    move_prices(second[5], 0, 5, '2030-01-01T00:00:00Z')
+    second[2]['bookmakers'] = second[2]['bookmakers'][:-2]
+    second[3]['bookmakers'].append({**copy.deepcopy(second[3]['bookmakers'][1]), 'key': 'newbook', 'title': 'New Book'})
+    second[3]['bookmakers'][-1]['markets'] = second[3]['bookmakers'][-1]['markets'][1:]
+    move_prices(second[3], -1, 9, '2030-01-01T00:00:00Z')
+    del second[7]
+    second.append(extra[0])
+
+    third = copy.deepcopy(second)
+    third[0]['bookmakers'][2]['last_update'] = '2030-01-02T00:00:00Z'
+    third[0]['bookmakers'][2]['markets'] = third[0]['bookmakers'][2]['markets'][1:]
+    move_prices(third[1], 3, 11, '2030-01-02T00:00:00Z')
+    third = third[10:] + extra[1:]
+    return [first, second, third, copy.deepcopy(first)]
+
+# Returns the comparable fields of an ev table, sorted by the key of its lines
+def comparable(odds):
+    fields = KEY + [field for field in odds.columns if field.startswith(('num_', 'line', 'fair_', 'width', 'vig_', 'ev_pct', 'kelly_'))]
+    return odds[fields].astype({field: str for field in KEY}).sort_values(KEY).reset_index(drop=True)
+
+# Every incremental update gives the same table as a full recompute of its snapshot
+@pytest.mark.parametrize('ev_type', ['avg', 'pinnacle', 'both'])
+def test_update_equals_full_recompute(ev_type):
+    session = ev.EVSession(ev_type=ev_type)
+    for odds_json in snapshots():
+        incremental = session.update(odds_json)
+        full = ev.ev_data(ev.processed_data(ev.flattened_data(odds_json)), ev_type=ev_type)
+        assert len(incremental) == len(full)
+        pandas.testing.assert_frame_equal(comparable(incremental), comparable(full), check_dtype=False)
+
+# Only the markets that changed are processed again
+def test_update_counts():
+    session = ev.EVSession()
+    first, second = snapshots()[:2]
+    session.update(first)
+    session.update(first)
+    assert session.changed_markets == 0 and session.removed_markets == 0
+    session.update(second)
+    assert session.changed_markets == 3 + 3 + 2 + 3 * 8
+    assert session.removed_markets == 3 * 2 + 3 * 8
+
+def test_weighted_consensus_and_devig():
+    session = ev.EVSession(devig='shin', consensus_weights={'pinnacle': 3, 'default': 1})
+    for odds_json in snapshots():
+        incremental = session.update(odds_json)
+        full = ev.ev_data(ev.processed_data(ev.flattened_data(odds_json), 'shin'), consensus_weights={'pinnacle': 3, 'default': 1})
+        numpy.testing.assert_allclose(comparable(incremental)['ev_pct_avg'], comparable(full)['ev_pct_avg'])
@@ -0,0 +1,45 @@
+import gzip
+import json
+
+import pytest
+
+import ev
+import synthetic
+
+# Writes text to a snapshot file, gzipped when the name ends in .gz
+def write(path, text):
+    if str(path).endswith('.gz'):
+        with gzip.open(path, 'wt') as file:
+            file.write(text)
+    else:
+        path.write_text(text)
+
+# A single JSON list is read in full, also when the buffer cuts events in half
+@pytest.mark.parametrize('name', ['odds.json', 'odds.json.gz'])
+def test_json_list(tmp_path, name):
+    events = synthetic.snapshot(num_events=30, num_books=3)
+    write(tmp_path / name, json.dumps(events))
+    assert list(ev.iter_events(str(tmp_path / name), buffer_size=1000)) == events
+
+# Newline-delimited lists of events are read line by line
+@pytest.mark.parametrize('name', ['odds.jsonl', 'odds.jsonl.gz'])
+def test_newline_delimited(tmp_path, name):
+    events = synthetic.snapshot(num_events=30, num_books=3)
+    write(tmp_path / name, ''.join(json.dumps(events[i:i + 10]) + '\n' for i in range(0, 30, 10)))
+    assert list(ev.iter_events(str(tmp_path / name), buffer_size=1000)) == events
+
+# A newline-delimited file named .json keeps the lines after the first list
+@pytest.mark.parametrize('name', ['odds.json', 'odds.json.gz'])
+@pytest.mark.parametrize('buffer_size', [1000, 1 << 20])
+def test_newline_delimited_named_json(tmp_path, name, buffer_size):
+    events = synthetic.snapshot(num_events=30, num_books=3)
+    lines = [json.dumps(events[:10]), json.dumps(events[10:20]), ''] + [json.dumps(event) for event in events[20:]]
+    write(tmp_path / name, '\n'.join(lines) + '\n\n')
+    assert list(ev.iter_events(str(tmp_path / name), buffer_size=buffer_size)) == events
+
+# Content after the first list that is not JSON is an error, not dropped
+def test_trailing_garbage(tmp_path):
+    events = synthetic.snapshot(num_events=5, num_books=3)
+    write(tmp_path / 'odds.json', json.dumps(events) + '\nnot json\n')
+    with pytest.raises(json.JSONDecodeError):
+        list(ev.iter_events(str(tmp_path / 'odds.json')))